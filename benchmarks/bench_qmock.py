@@ -0,0 +1,432 @@
+#!/usr/bin/env python
+"""
+    micro-benchmarks for qmock's per-call hot path.
+
+    usage:
+        python benchmarks/bench_qmock.py [scenario ...]
+
+    each scenario reports the best per-operation time over several
+    repeats. run with no arguments to list and run every scenario.
+"""
+from __future__ import print_function
+
+import sys
+import threading
+import timeit
+
+import qmock
+from qmock._python_compat import mock
+
+SCENARIOS = []
+
+def scenario(func):
+    SCENARIOS.append(func)
+    return func
+
+def best_per_op(run, setup=None, ops=10000, repeat=7):
+    """
+        return the best time (in seconds) per operation of `run(ops)`,
+        calling `setup(ops)` before each repeat (untimed).
+    """
+    timings = []
+    for _ in range(repeat):
+        if setup is not None:
+            setup(ops)
+        timings.append(timeit.Timer(lambda: run(ops)).timeit(number=1))
+    return min(timings) / ops
+
+def actual_call():
+    """
+        the parent-less `call` that mock.Mock builds for qm.foo(1) and
+        passes to CallQueue._pop().
+    """
+    return mock._Call(("foo", (1,), {}))
+
+def push_calls(cq, ops):
+    kall = qmock.call.foo(1)
+    for _ in range(ops):
+        cq.push(kall, 7357)
+
+@scenario
+def push():
+    qm = qmock.QMock()
+    cq = qm.call_queue
+    def run(ops):
+        push_calls(cq, ops)
+        cq._queue.clear()
+    return best_per_op(run)
+
+@scenario
+def pop():
+    """ CallQueue._pop() alone, without mock.Mock call dispatch. """
+    qm = qmock.QMock()
+    cq = qm.call_queue
+    kall = actual_call()
+    def run(ops):
+        for _ in range(ops):
+            cq._pop(kall)
+    return best_per_op(run, lambda ops: push_calls(cq, ops))
+
+@scenario
+def script_pop():
+    """ same as `pop`, consuming an attached Script instead. """
+    qm = qmock.QMock()
+    push_calls(qm.call_queue, 10000)
+    script = qm.call_queue.freeze()
+    qm = qmock.QMock()
+    cq = qm.call_queue
+    kall = actual_call()
+    def run(ops):
+        for _ in range(ops):
+            cq._pop(kall)
+    return best_per_op(run, lambda ops: cq.attach(script))
+
+@scenario
+def unordered_pop():
+    """
+        CallQueue._pop() from one big unordered group, consumed in reverse
+        push order. should stay flat as the group grows.
+    """
+    qm = qmock.QMock()
+    cq = qm.call_queue
+    kalls = [mock._Call(("foo", (i,), {})) for i in range(10000)]
+    def setup(ops):
+        with cq.unordered():
+            for i in range(ops):
+                cq.push(qmock.call.foo(i), i)
+    def run(ops):
+        for i in range(ops - 1, -1, -1):
+            cq._pop(kalls[i])
+    return best_per_op(run, setup)
+
+@scenario
+def subset_pop():
+    """
+        CallQueue._pop() of a call with a 1000-key payload, matched by a
+        two-key qmock.Subset.
+    """
+    qm = qmock.QMock()
+    cq = qm.call_queue
+    payload = dict(("field{0}".format(i), i) for i in range(1000))
+    kall = mock._Call(("foo", (payload,), {}))
+    expected = qmock.call.foo(
+        qmock.Subset({"field1": 1, "field2": qmock.InstanceOf(int)})
+    )
+    def setup(ops):
+        for _ in range(ops):
+            cq.push(expected, 7357)
+    def run(ops):
+        for _ in range(ops):
+            cq._pop(kall)
+    return best_per_op(run, setup)
+
+@scenario
+def sampled_subset_pop():
+    """ same as `subset_pop`, validating 1 in 100 calls. """
+    qm = qmock.QMock()
+    cq = qm.call_queue
+    cq.enable_sampling(every=100)
+    payload = dict(("field{0}".format(i), i) for i in range(1000))
+    kall = mock._Call(("foo", (payload,), {}))
+    expected = qmock.call.foo(
+        qmock.Subset({"field1": 1, "field2": qmock.InstanceOf(int)})
+    )
+    def setup(ops):
+        for _ in range(ops):
+            cq.push(expected, 7357)
+    def run(ops):
+        for _ in range(ops):
+            cq._pop(kall)
+    return best_per_op(run, setup)
+
+@scenario
+def push_all_deep():
+    """ push_all() of a 20-deep fluent chain, repeated. """
+    qm = qmock.QMock()
+    cq = qm.call_queue
+    kall = qmock.call
+    for i in range(20):
+        kall = getattr(kall, "step{0}".format(i))(i)
+    def run(ops):
+        for _ in range(ops):
+            cq.push_all(kall, 7357)
+        cq._queue.clear()
+    return best_per_op(run, ops=200)
+
+@scenario
+def chain_push_all():
+    """ build and push_all() a 5-call query chain with varying args. """
+    qm = qmock.QMock()
+    cq = qm.call_queue
+    call = qmock.call
+    def run(ops):
+        for i in range(ops):
+            cq.push_all(
+                call.query().filter(x=i).order_by("name").limit(10).all(),
+                7357
+            )
+        cq._queue.clear()
+    return best_per_op(run, ops=2000)
+
+@scenario
+def chain_template_push():
+    """ same as `chain_push_all`, with a CallQueue.chain() template. """
+    qm = qmock.QMock()
+    cq = qm.call_queue
+    call = qmock.call
+    query = cq.chain(call.query().filter().order_by().limit().all())
+    def run(ops):
+        for i in range(ops):
+            query.push([None, call(x=i), call("name"), call(10), None], 7357)
+        cq._queue.clear()
+    return best_per_op(run, ops=2000)
+
+class NoOpListener(object):
+    def on_match(self, event):
+        pass
+
+@scenario
+def pop_with_listener():
+    """ same as `pop`, with one no-op on_match listener. """
+    qm = qmock.QMock()
+    cq = qm.call_queue
+    cq.add_listener(NoOpListener())
+    kall = actual_call()
+    def run(ops):
+        for _ in range(ops):
+            cq._pop(kall)
+    return best_per_op(run, lambda ops: push_calls(cq, ops))
+
+@scenario
+def call():
+    """ a full qm.foo(1) call through the QMock attribute tree. """
+    qm = qmock.QMock()
+    cq = qm.call_queue
+    def run(ops):
+        foo = qm.foo
+        for _ in range(ops):
+            foo(1)
+    return best_per_op(run, lambda ops: push_calls(cq, ops))
+
+@scenario
+def stub_call():
+    """ a full qm.foo(1) call answered by a stub. """
+    qm = qmock.QMock()
+    qm.call_queue.stub(qmock.call.foo(1), 7357)
+    def run(ops):
+        foo = qm.foo
+        for _ in range(ops):
+            foo(1)
+    return best_per_op(run)
+
+@scenario
+def native_call():
+    """ same as `call`, with QMock(engine="native"). """
+    qm = qmock.QMock(engine="native")
+    cq = qm.call_queue
+    def run(ops):
+        foo = qm.foo
+        for _ in range(ops):
+            foo(1)
+    return best_per_op(run, lambda ops: push_calls(cq, ops))
+
+@scenario
+def native_stub_call():
+    """ same as `stub_call`, with QMock(engine="native"). """
+    qm = qmock.QMock(engine="native")
+    qm.call_queue.stub(qmock.call.foo(1), 7357)
+    def run(ops):
+        foo = qm.foo
+        for _ in range(ops):
+            foo(1)
+    return best_per_op(run)
+
+@scenario
+def native_nested_call():
+    """ a qm.foo().bar.baz(1) call, attribute lookups included. """
+    qm = qmock.QMock(engine="native")
+    qm.call_queue.stub(qmock.call.foo().bar.baz(1), 7357)
+    def run(ops):
+        foo = qm.foo
+        for _ in range(ops):
+            foo.return_value.bar.baz(1)
+    return best_per_op(run)
+
+def pickle_roundtrip_with(engine):
+    import pickle
+    qm = qmock.QMock(engine=engine)
+    qm.config.retries = 3
+    qm.connect.return_value = qm.session
+    cq = qm.call_queue
+    for i in range(20):
+        cq.push_all(qmock.call.session.query(i).filter(x=i).all(), [i])
+    for i in range(40):
+        cq.push(qmock.call.foo(i), i)
+    def run(ops):
+        for _ in range(ops):
+            pickle.loads(pickle.dumps(qm, pickle.HIGHEST_PROTOCOL))
+    return best_per_op(run, ops=100)
+
+@scenario
+def pickle_roundtrip():
+    """
+        pickle.loads(pickle.dumps(qm)) of a QMock with assigned attributes
+        and 100 pending expectations, including fluent chains.
+    """
+    return pickle_roundtrip_with("mock")
+
+@scenario
+def native_pickle_roundtrip():
+    """ same as `pickle_roundtrip`, with QMock(engine="native"). """
+    return pickle_roundtrip_with("native")
+
+def expectation_file(directory, entries):
+    """ write an expectation file of `entries` calls and chains. """
+    import json
+    import os
+    expectations = []
+    for i in range(entries // 2):
+        expectations.append({"call": "foo", "args": [i], "result": i})
+        expectations.append({
+            "chain": [
+                {"call": "session.query", "args": [i]},
+                {"call": "filter", "kwargs": {"x": i}},
+                {"call": "all"}
+            ],
+            "result": [i]
+        })
+    path = os.path.join(directory, "expectations.json")
+    with open(path, "w") as f:
+        json.dump({"expectations": expectations}, f)
+    return path
+
+@scenario
+def script_push():
+    """
+        push() and push_all() the calls in `load_cached`'s file from
+        python code, per entry.
+    """
+    call = qmock.call
+    def run(ops):
+        qm = qmock.QMock()
+        cq = qm.call_queue
+        for i in range(ops // 2):
+            cq.push(call.foo(i), i)
+            cq.push_all(call.session.query(i).filter(x=i).all(), [i])
+    return best_per_op(run, ops=1000)
+
+@scenario
+def script_attach():
+    """
+        attach a frozen Script of the same calls as `script_push` to a new
+        QMock, per entry.
+    """
+    call = qmock.call
+    qm = qmock.QMock()
+    cq = qm.call_queue
+    for i in range(500):
+        cq.push(call.foo(i), i)
+        cq.push_all(call.session.query(i).filter(x=i).all(), [i])
+    script = cq.freeze()
+    def run(ops):
+        qmock.QMock().call_queue.attach(script)
+    return best_per_op(run, ops=1000)
+
+@scenario
+def load_cached():
+    """ CallQueue.load() of an already cached expectation file, per entry. """
+    import shutil
+    import tempfile
+    directory = tempfile.mkdtemp()
+    try:
+        path = expectation_file(directory, 1000)
+        qmock.QMock().call_queue.load(path)
+        def run(ops):
+            qmock.QMock().call_queue.load(path)
+        return best_per_op(run, ops=1000)
+    finally:
+        shutil.rmtree(directory)
+
+def patched_tests_with(pooled):
+    import json
+    methods = 100
+    def test(self, qm):
+        qm.call_queue.push(qmock.call.loads("[]"), [])
+        json.loads("[]")
+    def run(ops):
+        for _ in range(ops // methods):
+            klass = type("Tests", (object,), dict(
+                ("test_{0}".format(i), test) for i in range(methods)
+            ))
+            klass = qmock.patch(loads="json.loads", pooled=pooled)(klass)
+            tests = klass()
+            for i in range(methods):
+                getattr(tests, "test_{0}".format(i))()
+    return best_per_op(run, ops=1000)
+
+@scenario
+def patched_tests():
+    """
+        decorate a class of 100 tests with qmock.patch() and run them,
+        per test.
+    """
+    return patched_tests_with(False)
+
+@scenario
+def pooled_patched_tests():
+    """ same as `patched_tests`, with `pooled=True`. """
+    return patched_tests_with(True)
+
+def threaded_call(threads):
+    """
+        `native_call` split across `threads` threads consuming one shared
+        queue. on free-threaded builds, ns/op should drop as threads are
+        added; with the GIL, it should at least not grow much.
+    """
+    def threaded_call():
+        qm = qmock.QMock(engine="native")
+        cq = qm.call_queue
+        foo = qm.foo
+        def work(ops):
+            for _ in range(ops):
+                foo(1)
+        def run(ops):
+            workers = [
+                threading.Thread(target=work, args=(ops // threads,))
+                for _ in range(threads)
+            ]
+            for worker in workers:
+                worker.start()
+            for worker in workers:
+                worker.join()
+        return best_per_op(run, lambda ops: push_calls(cq, ops), ops=40000)
+    threaded_call.__name__ = "threaded_call_{0}".format(threads)
+    return threaded_call
+
+for _threads in (1, 2, 4, 8):
+    scenario(threaded_call(_threads))
+
+def gil_enabled():
+    # sys._is_gil_enabled() only exists on python 3.13+.
+    return getattr(sys, "_is_gil_enabled", lambda: True)()
+
+def main(names):
+    by_name = dict((func.__name__, func) for func in SCENARIOS)
+    unknown = [name for name in names if name not in by_name]
+    if unknown:
+        print("unknown scenarios: {0}".format(", ".join(unknown)))
+        print("available: {0}".format(", ".join(sorted(by_name))))
+        return 2
+    print("python {0}, GIL {1}".format(
+        sys.version.split()[0],
+        "enabled" if gil_enabled() else "disabled"
+    ))
+    for func in SCENARIOS:
+        if names and func.__name__ not in names:
+            continue
+        seconds = func()
+        print("{0:<30} {1:>10.0f} ns/op".format(func.__name__, seconds * 1e9))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -1,11 +1,28 @@
+from ._expectation_files import (
+    # exceptions
+    ExpectationFileError
+)
+from ._matchers import (
+    # argument matchers
+    InstanceOf,
+    Matcher,
+    Predicate,
+    Regex,
+    Subset
+)
 from ._qmock import (
     # tools
     call,
+    LatencyProfile,
     patch,
     QMock,
+    Script,
+    Stream,
     # exceptions
     BadCall,
+    CallQueueFull,
     CallQueueNotEmpty,
+    PatchTimeout,
     QMockErrorsInThreads,
     UnexpectedCall
 )
@@ -0,0 +1,349 @@
+import hashlib
+import json
+import os
+import re
+import sys
+
+# bump whenever the compiled form changes, so stale caches are ignored.
+_FORMAT_VERSION = 2
+
+_CACHE_DIR_NAME = "__qmock_cache__"
+
+_NAME = re.compile(r"^[A-Za-z_][A-Za-z0-9_]*$")
+
+_EXPECTATION_KEYS = frozenset(
+    ("call", "args", "kwargs", "chain", "result", "result_node", "raise",
+     "latency", "awaitable", "stub", "id", "after")
+)
+
+# the keys allowed in each step of a `chain`.
+_STEP_KEYS = frozenset(("call", "args", "kwargs"))
+
+_RESULT_KINDS = frozenset(("value", "node", "raise"))
+
+if sys.version_info[0] < 3:
+    # python 2.7
+    import __builtin__ as builtins
+    _STRING_TYPES = (basestring,)
+    _NUMBER_TYPES = (int, long, float)
+else:
+    import builtins
+    _STRING_TYPES = (str,)
+    _NUMBER_TYPES = (int, float)
+
+class ExpectationFileError(ValueError):
+    pass
+
+def load_compiled(path, cache_dir=None):
+    """
+        return the compiled form of the expectation file at `path`,
+        from the cache if it holds the file's current content.
+
+        the cache is plain JSON, checked like the file itself when read,
+        since anyone who can write to the cache directory could otherwise
+        run code in the test process (as with a pickle).
+
+        the compiled form is a list of plain tuples, one per top-level
+        entry:
+            ("push", expectation)
+            ("stub", expectation)
+            ("unordered", [expectation, ...])
+        where each expectation is
+            (path, args, kwargs, result, latency, awaitable, after)
+        with a call path like "foo().bar", `after` indices into the same
+        unordered list, and `result` one of
+            ("value", value)
+            ("node", path)
+            ("raise", builtin exception name, args)
+    """
+    with open(path, "rb") as f:
+        content = f.read()
+    digest = hashlib.sha256(
+        "{0}:{1}:".format(_FORMAT_VERSION, sys.version_info[0]).encode()
+        + content
+    ).hexdigest()
+    if cache_dir is None:
+        cache_dir = os.path.join(
+            os.path.dirname(os.path.abspath(path)), _CACHE_DIR_NAME
+        )
+    cache_path = os.path.join(cache_dir, digest + ".json")
+    compiled = _read_cache(cache_path)
+    if compiled is None:
+        compiled = compile_expectations(json.loads(content.decode("utf-8")))
+        _write_cache(cache_dir, cache_path, compiled)
+    return compiled
+
+def _read_cache(cache_path):
+    """ the compiled form cached at `cache_path`, or None. """
+    try:
+        with open(cache_path, "rb") as f:
+            cached = json.loads(f.read().decode("utf-8"))
+        compiled = list()
+        for kind, cached_entry in cached:
+            if kind == "unordered":
+                compiled.append(
+                    (kind, [_cached_expectation(item) for item in cached_entry])
+                )
+            elif kind in ("push", "stub"):
+                compiled.append((kind, _cached_expectation(cached_entry)))
+            else:
+                return None
+        return compiled
+    except Exception:
+        # missing, unreadable or malformed cache, eg: written by an older
+        # qmock or tampered with.
+        return None
+
+def _cached_expectation(cached):
+    """
+        rebuild a compiled expectation from its JSON form (with lists for
+        tuples), raising if it isn't one.
+    """
+    path, args, kwargs, result, latency, awaitable, after = cached
+    kind = result[0]
+    if (
+        not isinstance(path, _STRING_TYPES)
+        or not isinstance(args, list)
+        or not isinstance(kwargs, dict)
+        or kind not in _RESULT_KINDS
+        or not _valid_latency(latency)
+        or not all(isinstance(index, int) for index in after)
+    ):
+        raise ValueError("malformed cache entry")
+    if kind == "value":
+        result = (kind, result[1])
+    elif kind == "node":
+        if not isinstance(result[1], _STRING_TYPES):
+            raise ValueError("malformed cache entry")
+        result = (kind, result[1])
+    else:
+        # never look up anything but a builtin exception type.
+        if _exception_type(result[1]) is None:
+            raise ValueError("malformed cache entry")
+        result = (kind, result[1], tuple(result[2]))
+    return (
+        path, tuple(args), kwargs, result, latency, bool(awaitable),
+        tuple(after)
+    )
+
+def _write_cache(cache_dir, cache_path, compiled):
+    # write to a temporary file first, so concurrent test runs never read
+    # a partial cache. failures (eg: read-only checkouts) only cost the
+    # next run a recompile.
+    temp_path = "{0}.{1}.tmp".format(cache_path, os.getpid())
+    try:
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        with open(temp_path, "wb") as f:
+            f.write(json.dumps(compiled, separators=(",", ":")).encode("utf-8"))
+        getattr(os, "replace", os.rename)(temp_path, cache_path)
+    except (IOError, OSError):
+        try:
+            os.remove(temp_path)
+        except (IOError, OSError):
+            pass
+
+def compile_expectations(document):
+    """
+        validate a parsed expectation file and return its compiled form.
+        see load_compiled().
+    """
+    if (
+        not isinstance(document, dict)
+        or not isinstance(document.get("expectations"), list)
+    ):
+        raise ExpectationFileError(
+            "Expectation files must be an object with an `expectations` list."
+        )
+    compiled = list()
+    for index, entry in enumerate(document["expectations"]):
+        where = "expectations[{0}]".format(index)
+        if isinstance(entry, dict) and "unordered" in entry:
+            compiled.append(
+                ("unordered", _compile_group(entry["unordered"], where))
+            )
+            continue
+        for kind, expectation in _compile_entry(entry, where):
+            compiled.append((kind, expectation))
+    return compiled
+
+def _compile_group(entries, where):
+    if not isinstance(entries, list):
+        raise ExpectationFileError(
+            "{0}: `unordered` must be a list.".format(where)
+        )
+    expectations = list()
+    ids = dict()
+    for index, entry in enumerate(entries):
+        entry_where = "{0}.unordered[{1}]".format(where, index)
+        compiled = list(
+            _compile_entry(entry, entry_where, ids, len(expectations))
+        )
+        if "id" in entry:
+            # `after` an id means after its last call.
+            ids[entry["id"]] = len(expectations) + len(compiled) - 1
+        expectations.extend(expectation for _, expectation in compiled)
+    return expectations
+
+def _compile_entry(entry, where, ids=None, base=0):
+    """
+        yield (kind, expectation) for one entry, several for chains.
+        inside an unordered list, `ids` maps ids to indices and `base` is
+        the index of the entry's first expectation.
+    """
+    _check_object(entry, _EXPECTATION_KEYS, where)
+    if not _valid_latency(entry.get("latency")):
+        raise ExpectationFileError(
+            "{0}: `latency` must be a non-negative number of seconds."
+            .format(where)
+        )
+    if "id" in entry and (
+        ids is None or not isinstance(entry["id"], _STRING_TYPES)
+    ):
+        raise ExpectationFileError(
+            "{0}: `id` must be a string, in an unordered list.".format(where)
+        )
+    stub = bool(entry.get("stub", False))
+    if stub and ids is not None:
+        raise ExpectationFileError(
+            "{0}: stubs can't be unordered.".format(where)
+        )
+    after = entry.get("after", [])
+    if not (
+        isinstance(after, list)
+        and all(isinstance(handle, _STRING_TYPES) for handle in after)
+    ):
+        raise ExpectationFileError(
+            "{0}: `after` must be a list of ids.".format(where)
+        )
+    if after and ids is None:
+        raise ExpectationFileError(
+            "{0}: `after` is only allowed in unordered lists.".format(where)
+        )
+    try:
+        after = tuple(ids[handle] for handle in after)
+    except KeyError as ex:
+        raise ExpectationFileError(
+            "{0}: unknown `after` id: {1}".format(where, ex.args[0])
+        )
+    if "chain" in entry:
+        if "call" in entry or stub:
+            raise ExpectationFileError(
+                "{0}: use either `call` or `chain`, and don't stub chains."
+                .format(where)
+            )
+        steps = entry["chain"]
+        if not isinstance(steps, list) or not steps:
+            raise ExpectationFileError(
+                "{0}: `chain` must be a non-empty list.".format(where)
+            )
+    else:
+        steps = [entry]
+    path = ""
+    last = len(steps) - 1
+    for index, step in enumerate(steps):
+        if step is not entry:
+            step_where = "{0}.chain[{1}]".format(where, index)
+            _check_object(step, _STEP_KEYS, step_where)
+        else:
+            step_where = where
+        path = _join_path(path, step.get("call"), step_where)
+        args = step.get("args", [])
+        kwargs = step.get("kwargs", {})
+        if not isinstance(args, list) or not isinstance(kwargs, dict):
+            raise ExpectationFileError(
+                "{0}: `args` must be a list and `kwargs` an object."
+                .format(step_where)
+            )
+        if index == last:
+            result = _compile_result(entry, where)
+            latency = entry.get("latency")
+            awaitable = bool(entry.get("awaitable", False))
+        else:
+            # like push_all(): each parent call returns the next node.
+            result = ("node", path + "()")
+            latency = None
+            awaitable = False
+        yield (
+            "stub" if stub else "push",
+            (path, tuple(args), kwargs, result, latency, awaitable, after)
+        )
+        path += "()"
+        if ids is not None:
+            # like push_all(): each later call waits for the one before.
+            after = (base + index,)
+
+def _check_object(value, keys, where):
+    """ raise unless `value` is an object with only the given `keys`. """
+    if not isinstance(value, dict):
+        raise ExpectationFileError("{0}: must be an object.".format(where))
+    unknown = set(value) - keys
+    if unknown:
+        raise ExpectationFileError(
+            "{0}: unknown keys: {1}".format(where, ", ".join(sorted(unknown)))
+        )
+
+def _join_path(path, name, where):
+    if not isinstance(name, _STRING_TYPES):
+        raise ExpectationFileError("{0}: `call` is required.".format(where))
+    parts = name.split(".")
+    if not all(_NAME.match(part) for part in parts):
+        raise ExpectationFileError(
+            "{0}: `call` must be dotted attribute names, got {1!r}"
+            .format(where, name)
+        )
+    return path + "." + name if path else name
+
+def _compile_result(entry, where):
+    given = [key for key in ("result", "result_node", "raise") if key in entry]
+    if len(given) > 1:
+        raise ExpectationFileError(
+            "{0}: use only one of `result`, `result_node` and `raise`."
+            .format(where)
+        )
+    if "result_node" in entry:
+        return ("node", _join_path("", entry["result_node"], where))
+    if "raise" in entry:
+        spec = entry["raise"]
+        name = spec.get("type") if isinstance(spec, dict) else None
+        if _exception_type(name) is None:
+            raise ExpectationFileError(
+                "{0}: `raise` needs the `type` of a builtin exception."
+                .format(where)
+            )
+        _check_object(spec, frozenset(("type", "args")), where + ".raise")
+        args = spec.get("args", [])
+        if not isinstance(args, list):
+            raise ExpectationFileError(
+                "{0}: `raise` `args` must be a list.".format(where)
+            )
+        return ("raise", name, tuple(args))
+    return ("value", entry.get("result"))
+
+def _exception_type(name):
+    """ the builtin exception type called `name`, or None. """
+    if not isinstance(name, _STRING_TYPES):
+        return None
+    error_type = getattr(builtins, name, None)
+    if isinstance(error_type, type) and issubclass(error_type, BaseException):
+        return error_type
+    return None
+
+def _valid_latency(latency):
+    return latency is None or (
+        isinstance(latency, _NUMBER_TYPES)
+        and not isinstance(latency, bool)
+        and latency >= 0
+    )
+
+def decode_result(result, node):
+    """
+        the result object for a compiled result. `node(path)` returns the
+        QMock node at a call path.
+    """
+    kind = result[0]
+    if kind == "value":
+        return result[1]
+    if kind == "node":
+        return node(result[1])
+    return _exception_type(result[1])(*result[2])
@@ -0,0 +1,315 @@
+import mmap
+import re
+import sys
+
+try:
+    from collections.abc import Mapping
+except ImportError:
+    # python 2.7
+    from collections import Mapping
+
+class Matcher(object):
+    """
+        base class for argument matchers.
+
+        matchers can be used anywhere inside the args of a pushed `call`,
+        including nested inside tuples, lists and dicts:
+
+            qm.call_queue.push(
+                call.save(qmock.InstanceOf(int), {"ts": qmock.Predicate(valid)}),
+                None
+            )
+
+        CallQueue compiles each pushed call into a comparison function
+        when it is pushed (see compile_call()), so only the parts of an
+        incoming call that are actually checked cost anything to match.
+
+        subclasses implement matches(). they can override compile() to
+        return a faster, specialized function.
+    """
+    # matchers are never hashed, so calls containing them are compared
+    # one by one instead of being indexed by hash.
+    __hash__ = None
+
+    def matches(self, value):
+        raise NotImplementedError
+
+    def compile(self):
+        """ return a function(value) -> bool equivalent to matches(). """
+        return self.matches
+
+    def __eq__(self, other):
+        return bool(self.matches(other))
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+class Predicate(Matcher):
+    """ matches any value for which `func(value)` is truthy. """
+    def __init__(self, func, description=None):
+        self._func = func
+        self._description = description or getattr(func, "__name__", func)
+
+    def matches(self, value):
+        return bool(self._func(value))
+
+    def __repr__(self):
+        return "Predicate({0})".format(self._description)
+
+class Regex(Matcher):
+    """
+        matches strings containing a match for `pattern` (ie:
+        re.search()). anchor the pattern with ^ and $ to match the whole
+        string. non-strings never match.
+    """
+    def __init__(self, pattern, flags=0):
+        self._regex = re.compile(pattern, flags)
+
+    def matches(self, value):
+        try:
+            return self._regex.search(value) is not None
+        except TypeError:
+            return False
+
+    def compile(self):
+        search = self._regex.search
+        def matches(value):
+            try:
+                return search(value) is not None
+            except TypeError:
+                return False
+        return matches
+
+    def __repr__(self):
+        return "Regex({0!r})".format(self._regex.pattern)
+
+class InstanceOf(Matcher):
+    """ matches instances of any of the given types. """
+    def __init__(self, *types):
+        self._types = types
+
+    def matches(self, value):
+        return isinstance(value, self._types)
+
+    def compile(self):
+        types = self._types
+        return lambda value: isinstance(value, types)
+
+    def __repr__(self):
+        return "InstanceOf({0})".format(
+            ", ".join(t.__name__ for t in self._types)
+        )
+
+class Subset(Matcher):
+    """
+        matches mappings containing (at least) the given keys with
+        matching values. for values that aren't mappings, the keys are
+        checked as attribute names instead. expected values may be
+        matchers themselves.
+
+        only the given keys are checked, so matching a large payload
+        costs no more than matching a small one.
+    """
+    def __init__(self, fields):
+        self._fields = dict(fields)
+        self._compiled = None
+
+    def matches(self, value):
+        if self._compiled is None:
+            self._compiled = self.compile()
+        return self._compiled(value)
+
+    def __getstate__(self):
+        # the compiled function can't be pickled.
+        return {"_fields": self._fields, "_compiled": None}
+
+    def compile(self):
+        checks = [
+            (key, compile_value(expected) or _equals(expected))
+            for key, expected in self._fields.items()
+        ]
+        def matches(value):
+            if isinstance(value, Mapping):
+                for key, check in checks:
+                    if key not in value or not check(value[key]):
+                        return False
+                return True
+            for key, check in checks:
+                try:
+                    field = getattr(value, key)
+                except AttributeError:
+                    return False
+                if not check(field):
+                    return False
+            return True
+        return matches
+
+    def __repr__(self):
+        return "Subset({0!r})".format(self._fields)
+
+def _equals(expected):
+    def matches(value):
+        # `expected` on the left, so mock.ANY and matchers keep working.
+        try:
+            return bool(expected == value)
+        except ValueError:
+            # eg: an unexpected numpy array, whose elementwise `==` can't
+            # be reduced to a single bool.
+            return False
+    return matches
+
+# types compared as raw buffers instead of with `==`. on python 2.7,
+# `bytes` is `str`, which is left to plain equality.
+if sys.version_info[0] < 3:
+    _BUFFER_TYPES = (bytearray, memoryview, mmap.mmap)
+else:
+    _BUFFER_TYPES = (bytes, bytearray, memoryview, mmap.mmap)
+
+# types that never contain matchers or buffers.
+_PLAIN_TYPES = frozenset(
+    (type(None), bool, int, float, complex, str)
+    + ((long, unicode) if sys.version_info[0] < 3 else ())
+)
+
+# ndarray dtype kinds whose elements are equal iff their bytes are
+# (bool, ints, bytes, void). floats are excluded because of nan and -0.0.
+_BITWISE_DTYPE_KINDS = frozenset("biuSV")
+
+def _flat_bytes(view):
+    """ a flat, zero-copy byte view of `view` where possible. """
+    if view.c_contiguous:
+        return view.cast("B")
+    return view.tobytes()
+
+def _same_buffer(expected, value):
+    try:
+        expected_view = memoryview(expected)
+        value_view = memoryview(value)
+    except TypeError:
+        return False
+    if (
+        expected_view.format != value_view.format
+        or expected_view.shape != value_view.shape
+    ):
+        return False
+    if not hasattr(expected_view, "cast"):
+        # python 2.7
+        return expected_view.tobytes() == value_view.tobytes()
+    return _flat_bytes(expected_view) == _flat_bytes(value_view)
+
+def _compile_buffer(expected):
+    # don't hold on to a memoryview of `expected` between calls: it would
+    # stop the test from closing an mmap or resizing a bytearray.
+    return lambda value: value is expected or _same_buffer(expected, value)
+
+def _compile_ndarray(numpy, expected):
+    ndarray = numpy.ndarray
+    shape = expected.shape
+    dtype = expected.dtype
+    bitwise = dtype.kind in _BITWISE_DTYPE_KINDS
+    def matches(value):
+        if value is expected:
+            return True
+        if (
+            not isinstance(value, ndarray)
+            or value.shape != shape
+            or value.dtype != dtype
+        ):
+            return False
+        if bitwise and expected.flags.c_contiguous and value.flags.c_contiguous:
+            return _same_buffer(expected, value)
+        return bool(numpy.array_equal(expected, value))
+    return matches
+
+def compile_value(expected):
+    """
+        return a function(value) -> bool checking `value` against
+        `expected`, or None if `expected` contains no matchers and plain
+        equality is all that's needed.
+
+        numpy arrays and buffers (bytes, bytearray, memoryview, mmap) are
+        compared by shape and type first, then with a single vectorized
+        (and where possible zero-copy) comparison of their contents.
+    """
+    expected_type = type(expected)
+    if expected_type in _PLAIN_TYPES:
+        # the common case, checked first to keep push() cheap.
+        return None
+    if isinstance(expected, Matcher):
+        return expected.compile()
+    if isinstance(expected, _BUFFER_TYPES):
+        return _compile_buffer(expected)
+    # only look for ndarrays if numpy has already been imported.
+    numpy = sys.modules.get("numpy")
+    if numpy is not None and isinstance(expected, numpy.ndarray):
+        return _compile_ndarray(numpy, expected)
+    if expected_type in (tuple, list):
+        checks = [compile_value(item) for item in expected]
+        if not any(checks):
+            return None
+        checks = [
+            check or _equals(item)
+            for check, item in zip(checks, expected)
+        ]
+        size = len(checks)
+        def matches(value):
+            if type(value) is not expected_type or len(value) != size:
+                return False
+            for check, item in zip(checks, value):
+                if not check(item):
+                    return False
+            return True
+        return matches
+    if expected_type is dict:
+        checks = dict(
+            (key, compile_value(value))
+            for key, value in expected.items()
+        )
+        if not any(checks.values()):
+            return None
+        return _compile_kwargs(expected, checks)
+    return None
+
+def _compile_kwargs(expected, checks):
+    keys = frozenset(expected)
+    checks = [
+        (key, check or _equals(expected[key]))
+        for key, check in checks.items()
+    ]
+    def matches(value):
+        if not isinstance(value, dict) or len(value) != len(keys):
+            return False
+        for key, check in checks:
+            if key not in value or not check(value[key]):
+                return False
+        return True
+    return matches
+
+def _all_plain(values):
+    for value in values:
+        if type(value) not in _PLAIN_TYPES:
+            return False
+    return True
+
+def compile_call(expected_call):
+    """
+        return a function(actual_call) -> bool for an expected `call`
+        containing matchers, or None if plain `call` equality is enough.
+    """
+    name, args, kwargs = expected_call
+    if _all_plain(args) and _all_plain(kwargs.values()):
+        return None
+    args_check = compile_value(tuple(args))
+    kwargs_check = compile_value(dict(kwargs))
+    if args_check is None and kwargs_check is None:
+        return None
+    args_check = args_check or _equals(tuple(args))
+    kwargs_check = kwargs_check or _equals(dict(kwargs))
+    def matches(actual_call):
+        actual_name, actual_args, actual_kwargs = actual_call
+        return (
+            actual_name == name
+            and args_check(tuple(actual_args))
+            and kwargs_check(actual_kwargs)
+        )
+    return matches
@@ -1,17 +1,43 @@
 import sys
+import threading
 
 if sys.version_info[0] < 3:
     # python 2.7
     from thread import get_ident as get_thread_id
+    from time import time as monotonic
     import mock
     if hasattr(mock, "mock"):
         # mock>=1.1
         mock = mock.mock
+
+    def wait_for(condition, predicate, timeout):
+        """
+            threading.Condition.wait_for() doesn't exist in python 2.7.
+            the caller must hold `condition`'s lock.
+        """
+        result = predicate()
+        if timeout is None:
+            while not result:
+                condition.wait()
+                result = predicate()
+            return result
+        deadline = monotonic() + timeout
+        while not result:
+            remaining = deadline - monotonic()
+            if remaining <= 0:
+                break
+            condition.wait(remaining)
+            result = predicate()
+        return result
 else:
     # python 3.4+
     from threading import get_ident as get_thread_id
+    from time import monotonic
     from unittest import mock
 
+    def wait_for(condition, predicate, timeout):
+        return condition.wait_for(predicate, timeout)
+
 if (sys.version_info < (3, 6, 8)
         or (3, 7, 0) <= sys.version_info < (3, 7, 2)):
     def call_parts(kall):
@@ -19,3 +45,44 @@ if (sys.version_info < (3, 6, 8)
 else:
     def call_parts(kall):
         return kall._mock_name, kall._mock_parent, kall._mock_from_kall
+
+try:
+    # python 3.7+
+    from contextvars import ContextVar
+except ImportError:
+    class ContextVar(object):
+        """
+            a thread-local stand-in for contextvars.ContextVar, for
+            pythons without it. each thread is its own context.
+        """
+        def __init__(self, name, default=None):
+            self.name = name
+            self._default = default
+            self._local = threading.local()
+
+        def get(self):
+            return getattr(self._local, "value", self._default)
+
+        def set(self, value):
+            self._local.value = value
+
+try:
+    import ctypes
+    _set_async_exc = ctypes.pythonapi.PyThreadState_SetAsyncExc
+except (ImportError, AttributeError):
+    # not cpython
+    _set_async_exc = None
+
+def set_async_exc(thread_id, exc_type):
+    """
+        schedule `exc_type` to be raised in another thread the next time it
+        runs python code, or clear a scheduled one if `exc_type` is None.
+        returns False where this isn't supported.
+    """
+    if _set_async_exc is None:
+        return False
+    if exc_type is None:
+        _set_async_exc(ctypes.c_ulong(thread_id), None)
+    else:
+        _set_async_exc(ctypes.c_ulong(thread_id), ctypes.py_object(exc_type))
+    return True
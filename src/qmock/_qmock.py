@@ -1,12 +1,25 @@
-from collections import deque, namedtuple
+import bisect
+from collections import deque, namedtuple, OrderedDict
+import contextlib
 import functools
+import itertools
+import random
+import re
 import sys
 import threading
+import time
+import traceback
 
+from ._expectation_files import decode_result, load_compiled
+from ._matchers import compile_call, Matcher
 from ._python_compat import (
     call_parts,
+    ContextVar,
     get_thread_id,
-    mock
+    mock,
+    monotonic,
+    set_async_exc,
+    wait_for
 )
 
 # alias so consumers don't need to import base `mock` too
@@ -25,6 +38,9 @@ class BadCall(ValueError):
 class CallQueueNotEmpty(AssertionError):
     pass
 
+class CallQueueFull(AssertionError):
+    pass
+
 class QMockErrorsInThreads(AssertionError):
     def __init__(self, errors):
         self.errors = errors
@@ -35,11 +51,43 @@ class QMockErrorsInThreads(AssertionError):
             .format(self.errors)
         )
 
+class PatchTimeout(AssertionError):
+    pass
+
 ErrorRecord = namedtuple(
     "ErrorRecord",
     ("thread_id", "error")
 )
 
+# a consumed expectation. see CallQueue.enable_history().
+HistoryRecord = namedtuple(
+    "HistoryRecord",
+    ("call", "result", "thread_id", "timestamp")
+)
+
+# events passed to CallQueue listeners. see CallQueue.add_listener().
+PushEvent = namedtuple(
+    "PushEvent",
+    ("expected_call", "result")
+)
+# duration: seconds spent finding the match, including any blocking wait.
+MatchEvent = namedtuple(
+    "MatchEvent",
+    ("actual_call", "expected_call", "thread_id", "duration")
+)
+MismatchEvent = namedtuple(
+    "MismatchEvent",
+    ("actual_call", "expected_call", "thread_id", "error")
+)
+EmptyEvent = namedtuple(
+    "EmptyEvent",
+    ("actual_call", "thread_id", "error")
+)
+AssertEmptyEvent = namedtuple(
+    "AssertEmptyEvent",
+    ("remaining",)
+)
+
 class patch(object):
     """
         A not-quite-drop-in replacement for unittest.mock.patch.
@@ -163,6 +211,72 @@ class patch(object):
         reported if uncaught, but still only the most-recently raised
         (QMockErrorsInThreads) will be catchable.
 
+        -- Context-Local Patching --
+        unittest.mock.patch changes module attributes for the whole
+        process, so tests patching the same targets can't run in parallel
+        threads. With `context_local=True`:
+
+            @qmock.patch(fizz="foo.bar", context_local=True)
+            def my_test(qm):
+                ...
+
+        each target is instead replaced once, by a dispatcher shared by
+        every context_local patch of that target. The dispatcher forwards
+        attribute access, calls and magic methods to the Mock patched in by
+        the current thread or contextvars context (or to the original
+        object, where there is none), so independent tests can run
+        concurrently in one process. The target is restored when the last
+        context unpatches it.
+
+        Threads started by the patched scope start in a fresh context and
+        see the original objects. Run them in a copy of the patched
+        context (eg: `contextvars.copy_context().run`) to route them to
+        the scope's QMock. Dispatchers are not classes, so isinstance()
+        checks against a context_local patched class won't work.
+
+        -- Fail-Fast --
+        With `fail_fast=True`, the QMock's CallQueue is put in fail-fast
+        mode (see CallQueue.enable_fail_fast()): the first UnexpectedCall
+        in any thread makes every later mocked call (and anything blocked
+        in the CallQueue) raise, so a failure in a worker thread aborts the
+        patched scope promptly, instead of at scope exit after other
+        threads have waited for timeouts.
+
+        -- Timeouts --
+        With `timeout=seconds`, a watchdog thread enforces a wall-clock
+        budget on each run of the patched scope. If it runs out, the
+        watchdog aborts the CallQueue (waking anything blocked in it, like
+        fail-fast mode) and raises PatchTimeout in the scope's thread. Its
+        message has the remaining expectations, the last consumed calls
+        (if CallQueue.enable_history() is on), any pop errors, and the
+        stacks of all threads currently inside qmock calls.
+
+        The watchdog costs nothing per mocked call. PatchTimeout is raised
+        as soon as the scope's thread runs python code, so a thread stuck
+        in a blocking call outside qmock (eg: joining a hung thread) only
+        sees it once that call returns. On pythons without
+        PyThreadState_SetAsyncExc (eg: PyPy), only the abort happens.
+
+        -- Pooling --
+        A class decorator builds a separate QMock (and patch stack) for
+        every test method. With `pooled=True`:
+
+            @qmock.patch(fizz="foo.bar", pooled=True)
+            class MyTests(unittest.TestCase):
+                ...
+
+        all test methods without their own @qmock.patch() share one QMock
+        and one set of patches, and the QMock is reset (see
+        QMock.mock_reset()) at the start of every test, so each test still
+        starts from an empty CallQueue with no assigned attributes. The
+        settings made by the decorators (eg: `fail_fast`) are restored
+        after each reset. Applied to a function, `pooled=True` resets the
+        function's QMock at the start of every call. Pooling only applies
+        to decorators, and pooled tests can't run concurrently.
+
+        `context_local`, `fail_fast`, `timeout` and `pooled` are reserved
+        keywords, so they can't be used as patch attribute names.
+
         -- WARNING --
         Do not mix decorators and context managers or nest multiple context
         managers. This will create mutiple QMock instances which negates
@@ -170,6 +284,12 @@ class patch(object):
     """
 
     def __init__(self, **patches):
+        # options are popped out of the patches, which can't be passed
+        # separately as keyword-only arguments in python 2.7.
+        self._context_local = bool(patches.pop("context_local", False))
+        self._fail_fast = bool(patches.pop("fail_fast", False))
+        self._timeout = patches.pop("timeout", None)
+        self._pooled = bool(patches.pop("pooled", False))
         self._patches = patches
 
     def __call__(self, func_or_klass):
@@ -180,6 +300,7 @@ class patch(object):
 
     def _decorate_class(self, klass):
         """ borrowed from unittest.mock._patch.decorate_class() """
+        pool = _QMockPool() if self._pooled else None
         for attr in dir(klass):
             if not attr.startswith(mock.patch.TEST_PREFIX):
                 continue
@@ -188,33 +309,55 @@ class patch(object):
             if not hasattr(attr_value, "__call__"):
                 continue
 
-            setattr(klass, attr, self(attr_value))
+            setattr(klass, attr, self._decorate_callable(attr_value, pool))
         return klass
 
-    def _decorate_callable(self, func):
+    def _decorate_callable(self, func, pool=None):
         # if func already has a .qmock, then keep using that. this allows
         # consumers to stack or mix @patch() decorators.
         if hasattr(func, "qmock"):
             qpatched = func
             qm = qpatched.qmock
+            pool = None
         else:
-            qm = QMock()
+            if pool is None and self._pooled:
+                pool = _QMockPool()
+            qm = QMock() if pool is None else pool.qmock
             @functools.wraps(func)
             def qpatched(*args, **kwargs):
+                if pool is not None:
+                    pool.reset()
                 args += (qm,)
+                watchdog = _Watchdog.start(qm)
                 try:
                     res = func(*args, **kwargs)
                 except:
-                    self._check_final_state(qm, handling_exception=True)
+                    self._exit_scope(qm, watchdog, handling_exception=True)
                     raise # if check passes with no new exception
                 else:
-                    self._check_final_state(qm, handling_exception=False)
+                    self._exit_scope(qm, watchdog, handling_exception=False)
                 return res
-        for attr, target in self._patches.items():
-            mpatching = self._new_mock_patch(qm, attr, target)
+        if self._fail_fast:
+            qm.call_queue.enable_fail_fast()
+        if self._timeout is not None:
+            # on the QMock, so stacked decorators can set it too.
+            qm.call_queue._patch_timeout = self._timeout
+        if pool is None:
+            mpatchings = self._new_mock_patches(qm)
+        else:
+            # patches are stateless between runs, so pooled functions
+            # share them too.
+            if pool.patchings is None:
+                pool.patchings = self._new_mock_patches(qm)
+                # the patches keep these nodes, so resets put them back.
+                pinned = qm._mock_pinned = qm._mock_pinned or dict()
+                for attr in self._patches:
+                    pinned[attr] = getattr(qm, attr)
+            mpatchings = pool.patchings
+        for mpatching in mpatchings:
             # if qpatched has no patches, this will return a new wrapper.
             # else, it will update and return the same qpatched object.
-            qpatched= mpatching(qpatched)
+            qpatched = mpatching(qpatched)
         # in python2.x, this assignment will fail if qpatched is an
         # instancemethod. that can only happen if func is an instancemethod
         # and it doesn't get replaced with a wrapper (because it already
@@ -224,13 +367,22 @@ class patch(object):
         return qpatched
 
     def __enter__(self):
-        self._active_qm = QMock()
-        self._active_patches = list()
+        if self._pooled:
+            raise ValueError("`pooled` only applies to decorators.")
+        qm = QMock()
+        if self._fail_fast:
+            qm.call_queue.enable_fail_fast()
+        qm.call_queue._patch_timeout = self._timeout
+        patchings = list()
+        scope = (self, qm, patchings, _Watchdog.start(qm))
+        _patch_scopes.set(_patch_scopes.get() + (scope,))
+        with _open_scopes_lock:
+            _open_scopes.append(scope)
         try:
             for attr, target in self._patches.items():
-                mpatching = self._new_mock_patch(self._active_qm, attr, target)
+                mpatching = self._new_mock_patch(qm, attr, target)
                 mpatching.__enter__()
-                self._active_patches.append(mpatching)
+                patchings.append(mpatching)
         except:
             # as long as we never use mock.patch.multiple(), the above
             # mock._patch.__enter__() will be atomic: if it raises, then
@@ -239,18 +391,48 @@ class patch(object):
             # __exit__() any successfully activated patches.
             self.__exit__(*sys.exc_info())
             raise
-        return self._active_qm
+        return qm
 
     def __exit__(self, exc_type, exc_value, traceback):
-        for mpatching in reversed(self._active_patches):
-            mpatching.__exit__()
-        del self._active_patches
-
-        self._check_final_state(
-            self._active_qm,
+        scopes = _patch_scopes.get()
+        with _open_scopes_lock:
+            # also drops scopes of this context that were exited elsewhere.
+            scopes = tuple(other for other in scopes if _is_open_scope(other))
+            # the innermost scope of this patch. scopes are exited
+            # innermost first, so it's normally the last one.
+            scope = _last_scope_of(self, scopes)
+            if scope is None:
+                # exited in another thread or context than the one that
+                # entered it (eg: from an asyncio task, or by an ExitStack
+                # closed elsewhere), which can't see the scope. undo this
+                # patch's latest open scope anyway.
+                scope = _last_scope_of(self, _open_scopes)
+            if scope is not None:
+                _open_scopes[:] = [
+                    other for other in _open_scopes if other is not scope
+                ]
+        _patch_scopes.set(
+            tuple(other for other in scopes if other is not scope)
+        )
+        if scope is None:
+            return
+        _, qm, patchings, watchdog = scope
+        for mpatching in reversed(patchings):
+            mpatching.__exit__(None, None, None)
+
+        self._exit_scope(
+            qm,
+            watchdog,
             handling_exception=exc_type is not None
         )
-        del self._active_qm
+
+    def _exit_scope(self, qm, watchdog, handling_exception):
+        if watchdog is not None:
+            timeout_error = watchdog.stop()
+            if timeout_error is not None:
+                # the diagnostic already covers the final state.
+                raise timeout_error
+        self._check_final_state(qm, handling_exception)
 
     def _check_final_state(self, qm, handling_exception):
         thread_id = get_thread_id()
@@ -265,18 +447,350 @@ class patch(object):
         if not handling_exception:
             qm.call_queue.assert_empty()
 
+    def _new_mock_patches(self, qm):
+        return [
+            self._new_mock_patch(qm, attr, target)
+            for attr, target in self._patches.items()
+        ]
+
     def _new_mock_patch(self, qm, attr, target):
         new_attr = getattr(qm, attr)
+        if self._context_local:
+            return _ContextPatch(target, new_attr)
         return mock.patch(target, new=new_attr)
 
+# (patch, qm, patchings, watchdog) for each active `with` scope, innermost
+# last. kept per thread/context, so one patch can be entered concurrently.
+# every ContextVar that's ever set stays in the context, so there is one
+# for all patches rather than one per patch.
+_patch_scopes = ContextVar("qmock.patch scopes", default=())
+
+# every active `with` scope, in any thread or context. only needed for
+# scopes exited in another context than the one that entered them.
+_open_scopes = list()
+_open_scopes_lock = threading.Lock()
+
+def _last_scope_of(patch, scopes):
+    for scope in reversed(scopes):
+        if scope[0] is patch:
+            return scope
+    return None
+
+def _is_open_scope(scope):
+    """ call with _open_scopes_lock held. """
+    for other in _open_scopes:
+        if other is scope:
+            return True
+    return False
+
+class _QMockPool(object):
+    """
+        the QMock shared by the functions of a pooled qmock.patch()
+        decorator. see patch's "Pooling" notes.
+    """
+    def __init__(self):
+        self.qmock = QMock()
+        # mock patches shared by the pooled functions.
+        self.patchings = None
+        # the CallQueue settings made by the decorators, restored after
+        # each reset.
+        self._settings = None
+
+    def reset(self):
+        call_queue = self.qmock.call_queue
+        if self._settings is None:
+            # decorators only configure the QMock while decorating, so
+            # before the first run it holds exactly their settings.
+            self._settings = (
+                call_queue._fail_fast, call_queue._patch_timeout
+            )
+        self.qmock.mock_reset()
+        call_queue._fail_fast, call_queue._patch_timeout = self._settings
+
+class _ContextPatch(object):
+    """
+        a context_local patch of one target, used like a mock._patch:
+        either as a context manager or as a (stackable) decorator. see
+        patch's "Context-Local Patching" notes.
+    """
+    def __init__(self, target, new):
+        self._target = target
+        self._new = new
+        # the routes this patch entered and hasn't exited yet, in any
+        # context. guarded by _dispatchers_lock.
+        self._open_routes = list()
+
+    def __call__(self, func):
+        """ decorate `func`, like mock._patch.decorate_callable(). """
+        if hasattr(func, "qmock_context_patches"):
+            func.qmock_context_patches.append(self)
+            return func
+
+        @functools.wraps(func)
+        def patched(*args, **kwargs):
+            entered = list()
+            try:
+                for patching in patched.qmock_context_patches:
+                    patching.__enter__()
+                    entered.append(patching)
+                return func(*args, **kwargs)
+            finally:
+                for patching in reversed(entered):
+                    patching.__exit__(None, None, None)
+        patched.qmock_context_patches = [self]
+        return patched
+
+    def __enter__(self):
+        _acquire_dispatcher(self._target)
+        # a route is a one-item list, emptied when it's exited.
+        route = [self._new]
+        with _dispatchers_lock:
+            self._open_routes.append(route)
+        routes = dict(_context_routes.get())
+        routes[self._target] = routes.get(self._target, ()) + (route,)
+        _context_routes.set(routes)
+        return self._new
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        routes = dict(_context_routes.get())
+        context_routes = routes.pop(self._target, ())
+        with _dispatchers_lock:
+            open_routes = self._open_routes
+            # the innermost route of this patch in this context. scopes
+            # are exited innermost first, so it's normally the last one.
+            route = None
+            for candidate in reversed(context_routes):
+                if any(candidate is other for other in open_routes):
+                    route = candidate
+                    break
+            if route is None and open_routes:
+                # exited in another thread or context than the one that
+                # entered it, which can't see the route. close this
+                # patch's latest route anyway.
+                route = open_routes[-1]
+            if route is not None:
+                open_routes[:] = [
+                    other for other in open_routes if other is not route
+                ]
+                # closed for every context still holding it.
+                del route[:]
+        # also drops routes of this context that were exited elsewhere.
+        context_routes = tuple(other for other in context_routes if other)
+        if context_routes:
+            routes[self._target] = context_routes
+        _context_routes.set(routes)
+        if route is not None:
+            _release_dispatcher(self._target)
+
+# target -> the routes to the Mocks patched in by the current context,
+# innermost last. see _ContextPatch.
+# like _patch_scopes, one ContextVar is shared by all dispatchers.
+_context_routes = ContextVar("qmock context routes", default={})
+
+class _ContextDispatcher(object):
+    """
+        stands in for a context_local patched target for as long as any
+        context has it patched, forwarding everything to _qmock_current():
+        the innermost Mock patched in by the current thread/context, or the
+        original object if there is none.
+
+        the slots are prefixed, since any other attribute name could be one
+        the code under test expects the target to have.
+    """
+    __slots__ = ("_qmock_target", "_qmock_original", "_qmock_patching")
+
+    def __init__(self, target):
+        set_slot = object.__setattr__
+        set_slot(self, "_qmock_target", target)
+        patching = mock.patch(target, new=self)
+        set_slot(
+            self,
+            "_qmock_original",
+            getattr(patching.getter(), patching.attribute)
+        )
+        set_slot(self, "_qmock_patching", patching)
+
+    def _qmock_current(self):
+        routes = _context_routes.get().get(self._qmock_target)
+        if routes:
+            for route in reversed(routes):
+                # skips routes exited by another context.
+                if route:
+                    return route[0]
+        return self._qmock_original
+
+    def __getattr__(self, name):
+        return getattr(self._qmock_current(), name)
+
+    def __setattr__(self, name, value):
+        setattr(self._qmock_current(), name, value)
+
+    def __delattr__(self, name):
+        delattr(self._qmock_current(), name)
+
+    def __call__(self, *args, **kwargs):
+        return self._qmock_current()(*args, **kwargs)
+
+    def __repr__(self):
+        return repr(self._qmock_current())
+
+# target -> [_ContextDispatcher, number of active patches of the target]
+_dispatchers = dict()
+_dispatchers_lock = threading.Lock()
+
+def _acquire_dispatcher(target):
+    with _dispatchers_lock:
+        entry = _dispatchers.get(target)
+        if entry is None:
+            dispatcher = _ContextDispatcher(target)
+            dispatcher._qmock_patching.__enter__()
+            entry = _dispatchers[target] = [dispatcher, 0]
+        entry[1] += 1
+        return entry[0]
+
+def _release_dispatcher(target):
+    with _dispatchers_lock:
+        entry = _dispatchers[target]
+        entry[1] -= 1
+        if entry[1] == 0:
+            del _dispatchers[target]
+            entry[0]._qmock_patching.__exit__(None, None, None)
+
+class _Watchdog(object):
+    """ enforces a qmock.patch() timeout. see patch's "Timeouts" notes. """
+    @classmethod
+    def start(cls, qm):
+        """ return a running _Watchdog, or None if qm has no timeout. """
+        timeout = qm.call_queue._patch_timeout
+        if timeout is None:
+            return None
+        return cls(qm, timeout)
+
+    def __init__(self, qm, timeout):
+        self._qm = qm
+        self._timeout = timeout
+        self._thread_id = get_thread_id()
+        # guards _stopped and _expired, so the timer can't fire into a
+        # scope that has already exited.
+        self._lock = threading.Lock()
+        self._stopped = False
+        self._expired = None
+        self._timer = threading.Timer(timeout, self._expire)
+        self._timer.daemon = True
+        self._timer.start()
+
+    def stop(self):
+        """ return the PatchTimeout to raise, or None if still in time. """
+        self._timer.cancel()
+        with self._lock:
+            self._stopped = True
+            if self._expired is not None:
+                # in case the scope exited before the exception landed.
+                set_async_exc(self._thread_id, None)
+            return self._expired
+
+    def _expire(self):
+        error = PatchTimeout(self._diagnostic())
+        with self._lock:
+            if self._stopped:
+                return
+            self._expired = error
+            set_async_exc(self._thread_id, PatchTimeout)
+        self._qm.call_queue._abort_with(error)
+
+    def _diagnostic(self):
+        call_queue = self._qm.call_queue
+        lines = [
+            "qmock.patch() scope timed out after {0}s.".format(self._timeout)
+        ]
+        remaining = list()
+        for item in list(call_queue._queue):
+            if item.__class__ is _UnorderedGroup:
+                remaining.append(
+                    "unordered group, ready: {0}".format(", ".join(
+                        str(kall) for kall in item.ready_calls()
+                    ))
+                )
+            elif item.__class__ is _ScriptCursor:
+                remaining.append(
+                    "attached script, {0} expected calls remaining"
+                    .format(item.remaining)
+                )
+            else:
+                remaining.append(str(item.call))
+        lines.append(
+            "queue position: {0} expected calls remaining.".format(
+                len(remaining)
+            )
+        )
+        lines.extend("    " + line for line in remaining[:10])
+        if len(remaining) > 10:
+            lines.append("    ... and {0} more".format(len(remaining) - 10))
+        records = call_queue.history()
+        if records:
+            lines.append(
+                "last consumed call: {0} -> {1!r} (thread {2})"
+                .format(*records[-1])
+            )
+        else:
+            lines.append(
+                "last consumed call: unknown (see CallQueue.enable_history())"
+            )
+        if call_queue.pop_errors:
+            lines.append("pop errors: {0!r}".format(call_queue.pop_errors))
+        lines.extend(_format_qmock_stacks())
+        return "\n".join(lines)
+
+def _format_qmock_stacks():
+    """ the stacks of all threads currently inside a qmock call. """
+    names = dict(
+        (thread.ident, thread.name) for thread in threading.enumerate()
+    )
+    lines = list()
+    for thread_id, frame in sys._current_frames().items():
+        inner = frame
+        while inner is not None and inner.f_code not in _QMOCK_CALL_CODES:
+            inner = inner.f_back
+        if inner is None:
+            continue
+        lines.append("thread {0} ({1}) inside a mocked call:".format(
+            thread_id, names.get(thread_id, "?")
+        ))
+        lines.extend(
+            line.rstrip("\n") for line in traceback.format_stack(frame)
+        )
+    if not lines:
+        lines.append("no threads inside mocked calls.")
+    return lines
+
+def _new_routed_magic(name):
+    def magic(self, *args, **kwargs):
+        # looked up on the instance, so QMock attributes record the call
+        # exactly as if their own magic method had been used.
+        return getattr(self._qmock_current(), name)(*args, **kwargs)
+    magic.__name__ = name
+    return magic
+
+# identity and size stay the dispatcher's own.
+for _name in mock._magics - frozenset(
+    ("__eq__", "__ne__", "__hash__", "__sizeof__")
+):
+    setattr(_ContextDispatcher, _name, _new_routed_magic(_name))
+del _name
+
 _QMOCK_INST_ATTRS = frozenset(
     ("call_queue", "_mock_name", "_mock_parent", "_mock_new_name",
-     "_mock_new_parent", "_mock_call_proxy", "_last_mock_result")
+     "_mock_new_parent", "_mock_call_proxy", "_mock_results",
+     "_proxy_lock", "_mock_return_cache", "_mock_assigned",
+     "_mock_pinned")
 )
 # __class__ is included to avoid unexpected results from isinstance().
+# __copy__ and __deepcopy__ aren't defined, so the copy module falls back
+# to __reduce_ex__() instead of calling a mock.
 _QMOCK_CLASS_ATTRS = frozenset(
     ("__class__", "__setattr__", "__call__", "__slots__", "__eq__",
-     "mock_return", "_pop_mock_call_queue")
+     "__reduce_ex__", "__setstate__", "__copy__", "__deepcopy__",
+     "mock_return", "mock_reset", "_pop_mock_call_queue")
 )
 
 class QMock(object):
@@ -362,6 +876,23 @@ class QMock(object):
 
         TODO? we could allow users to opt-in to `__eq__` mocking, in cases
         where they know there are no mocks being passed as call arguments.
+
+        -- Engines --
+        By default, QMock is built on a tree of mock.MagicMock objects
+        (`engine="mock"`). For tight loops and soak tests, use
+            qm = QMock(engine="native")
+        which builds the call path with qmock's own lightweight attribute
+        tree instead. It is an order of magnitude faster per call and
+        supports the same attribute, return_value, mock_return() and magic
+        method behavior. However, its attributes are not mock.Mock
+        objects, so mock.Mock-specific features (spec, side_effect,
+        assert_called_with(), etc) are not available.
+
+        -- Resetting --
+        `QMock.mock_reset()` makes a QMock as good as new (an empty
+        CallQueue with default settings, and no assigned attributes) while
+        keeping its attribute tree, so reusing one QMock across tests
+        skips rebuilding it. See qmock.patch's `pooled` option.
     """
     """
         # how it works
@@ -403,23 +934,29 @@ class QMock(object):
         1) store the result somewhere during mock.Mock.__call__();
         2) fetch the result afterward and return it to the caller.
 
-        if we ignore thread-safety (like the std mock library does), then
-        (1) is easy: store the result of CallQueue.pop() in a QMock member.
-        but again, (2) is a little trickier. we need to wrap
+        (1) is easy: store the result of CallQueue.pop() in a thread-local
+        QMock member, so concurrent calls from other threads (or other
+        cores, on free-threaded builds) can't overwrite it before it's
+        returned. but again, (2) is a little trickier. we need to wrap
         mock.Mock.__call_() with a proxy that knows the root QMock so it
         can:
             - run mock.Mock.__call(),
             - get the result from the QMock, and
             - return to the caller.
-        this is what QMock._last_mock_result and _CallProxy do.
+        this is what QMock._mock_results and _CallProxy do.
     """
     __slots__ = _QMOCK_INST_ATTRS
     _ALL_ATTRIBUTES = _QMOCK_INST_ATTRS.union(_QMOCK_CLASS_ATTRS)
 
-    def __new__(cls):
+    def __new__(cls, engine="mock"):
         return _new_clone_with_magic_methods(cls)
 
-    def __init__(self):
+    def __init__(self, engine="mock"):
+        """
+            engine: "mock" (default) or "native". see "Engines" above.
+        """
+        if engine not in ("mock", "native"):
+            raise ValueError("Unknown QMock engine: {0!r}".format(engine))
         self.call_queue = CallQueue(root_qmock=self)
 
         # mock.Mock needs these 4 attrs to exist on all parents.
@@ -428,14 +965,57 @@ class QMock(object):
         self._mock_new_name = ""
         self._mock_new_parent = None
 
-        # `name=""` prevents real_mock from adding an extra component to
-        # the path of the final mock.call object.
-        real_mock = mock.MagicMock(parent=self, name="")
-        self._mock_call_proxy = _CallProxy(root_qmock=self, real_mock=real_mock)
+        if engine == "native":
+            self._mock_call_proxy = _NativeProxy(self, "", self)
+        else:
+            # `name=""` prevents real_mock from adding an extra component
+            # to the path of the final mock.call object.
+            real_mock = _HistorylessMagicMock(parent=self, name="")
+            self._mock_call_proxy = _CallProxy(
+                root_qmock=self,
+                real_mock=real_mock
+            )
+
+        # `.last` is set by self._pop_mock_call_queue(), per thread.
+        self._mock_results = threading.local()
+        # guards the first wrapping of each child mock in a _CallProxy.
+        self._proxy_lock = threading.Lock()
+        # call path (eg: "foo().bar") -> proxy. see mock_return().
+        self._mock_return_cache = dict()
+        # (node path, attribute name) -> value, for every attribute
+        # assigned anywhere in the tree, in assignment order. this is all
+        # __reduce_ex__() needs to rebuild the tree.
+        self._mock_assigned = OrderedDict()
+        # attribute name -> the root node mock_reset() puts back if it was
+        # replaced, or None. set by pooled patches, whose patch targets
+        # keep the nodes they were created with.
+        self._mock_pinned = None
+
+    def __reduce_ex__(self, protocol):
+        """
+            pickle and copy.deepcopy() support.
+
+            the attribute tree is never reduced node by node (or through
+            mock.MagicMock): nodes are rebuilt on demand from their call
+            paths, so only the assigned attributes and the CallQueue are
+            stored. nodes reduce to (root QMock, path) and come back as the
+            same nodes of the rebuilt tree.
+        """
+        if isinstance(self._mock_call_proxy, _NativeProxy):
+            engine = "native"
+        else:
+            engine = "mock"
+        return (
+            QMock,
+            (engine,),
+            (list(self._mock_assigned.items()), self.call_queue)
+        )
 
-        # set by self._pop_mock_call_queue()
-        #TODO? would threading.local solve the thread-safety issue?
-        self._last_mock_result = None
+    def __setstate__(self, state):
+        assigned, call_queue = state
+        self.call_queue = call_queue
+        for (path, name), value in assigned:
+            setattr(_qmock_node(self, path), name, value)
 
     def __getattribute__(self, name):
         if name == "_ALL_ATTRIBUTES" or name in self._ALL_ATTRIBUTES:
@@ -465,7 +1045,44 @@ class QMock(object):
 
     def _pop_mock_call_queue(self, actual_call):
         """ only called by _MockCallsProxy.append() """
-        self._last_mock_result = self.call_queue._pop(actual_call)
+        self._mock_results.last = self.call_queue._pop(actual_call)
+
+    def mock_reset(self):
+        """
+            clear the CallQueue (expectations, stubs, pop errors, history,
+            listeners and modes) and undo every attribute assignment (eg:
+            return_value, side_effect, magic methods or configure_mock()),
+            keeping the attribute tree. nodes keep their identity, except
+            those that were replaced by an assignment and the return values
+            below assigned nodes, which are rebuilt on their next access.
+            nodes patched in by a pooled qmock.patch() are put back
+            instead, so the patch targets still hold them.
+
+            the CallQueue object is reset in place, so references to it
+            stay valid. don't reset while other threads are using the
+            QMock.
+        """
+        call_queue = self.call_queue
+        # also drops any method shadowed by a mode, like _pop.
+        call_queue.__dict__.clear()
+        call_queue.__init__(self)
+        # in reverse, so nodes inside replaced subtrees are found before
+        # the nodes replacing them are undone.
+        touched = OrderedDict()
+        pinned = self._mock_pinned or {}
+        for path, name in reversed(list(self._mock_assigned)):
+            real_mock = _undo_assignment(self, path, name)
+            if real_mock is not None:
+                touched[id(real_mock)] = real_mock
+            if not path and name in pinned:
+                # before undoing any assignment inside the pinned node.
+                _restore_node(self._mock_call_proxy, name, pinned[name])
+        # assignments aren't the only way to configure a mock.Mock, eg:
+        # side_effect is stored in _mock_side_effect, not in __dict__.
+        for real_mock in touched.values():
+            real_mock.reset_mock(return_value=True, side_effect=True)
+        self._mock_assigned.clear()
+        self._mock_return_cache.clear()
 
     def mock_return(self, kall):
         """
@@ -475,9 +1092,21 @@ class QMock(object):
             then
                 return self.foo.bar.return_value.baz.return_value
 
+            every `call` object carries its full path (eg:
+            "foo.bar().baz()"), so proxies found along the way are cached
+            by path. each prefix of a chain is resolved at most once, and
+            repeating a chain (eg: in push_all()) is a single dict lookup.
+            assigning or deleting any QMock attribute clears the cache.
+
             kall: a `call` object.
         """
         name, parent, from_kall = call_parts(kall)
+        cache = self._mock_return_cache
+        if name:
+            try:
+                return cache[name]
+            except KeyError:
+                pass
 
         if from_kall:
             attr = "return_value"
@@ -487,7 +1116,12 @@ class QMock(object):
             mock_obj = self
         else:
             mock_obj = self.mock_return(parent)
-        return getattr(mock_obj, attr)
+        value = getattr(mock_obj, attr)
+        # only cache proxies: other values (eg: assigned objects) can
+        # change their attributes without going through QMock.
+        if name and isinstance(value, _PROXY_TYPES):
+            cache[name] = value
+        return value
 
 class CallQueue(object):
     def __init__(self, root_qmock):
@@ -496,7 +1130,303 @@ class CallQueue(object):
         self.pop_errors = list()
         self._pop_errors_lock = threading.Lock()
 
-    def push(self, expected_call, result):
+        # only used in blocking mode. see enable_blocking().
+        self._blocking = False
+        self._maxsize = 0
+        self._timeout = None
+        self._queue_changed = threading.Condition(threading.Lock())
+
+        # while False, the front of the queue is always a plain
+        # _Expectation and _pop() can use a lock-free popleft(). this
+        # becomes True (and stays True) in blocking mode or once an
+        # _UnorderedGroup, a Script or a Stream of items is queued.
+        self._locked = False
+        # the group being filled by an active unordered() block.
+        self._open_group = None
+
+        # only used in stub mode. see stub().
+        self._stubs = None
+
+        # a tuple while any listeners are registered. see add_listener().
+        self._listeners = None
+
+        # a fixed-size ring buffer once enabled. see enable_history().
+        self._history = None
+        self._history_counter = None
+
+        # only used in scheduling mode. see enable_scheduling().
+        self._scheduler = None
+
+        # only used in sampling mode. see enable_sampling().
+        self._sampler = None
+
+        # only used in fail-fast mode. see enable_fail_fast().
+        self._fail_fast = False
+        # the pop error that aborted the queue.
+        self._abort_error = None
+
+        # the budget of the qmock.patch() scope owning this queue. see
+        # patch's "Timeouts" notes.
+        self._patch_timeout = None
+
+    def __getstate__(self):
+        """
+            the script and configuration, for pickle and copy.deepcopy().
+            locks, listeners, scheduling and the patch timeout belong to
+            the running process, so they aren't copied.
+        """
+        state = dict(self.__dict__)
+        for name in _CALL_QUEUE_PROCESS_ATTRS:
+            state.pop(name, None)
+        if self._history is not None:
+            # `call` objects can't be pickled.
+            state["_history"] = [
+                None if entry is None else
+                (entry[0], tuple(entry[1])) + entry[2:]
+                for entry in self._history
+            ]
+        return state
+
+    def __setstate__(self, state):
+        self.__init__(state.pop("_qmock"))
+        self.__dict__.update(state)
+        if self._history is not None:
+            self._history = [
+                None if entry is None else
+                (entry[0], mock._Call(entry[1])) + entry[2:]
+                for entry in self._history
+            ]
+            self._history_counter = itertools.count(max(
+                [entry[0] + 1 for entry in self._history if entry] or [0]
+            ))
+        if self._sampler is not None:
+            self._pop = self._pop_sampled
+        if self._abort_error is not None:
+            self._pop = self._raise_aborted
+
+    def enable_blocking(self, maxsize=0, timeout=None):
+        """
+            switch the queue into producer/consumer mode.
+
+            by default, the whole script must be pushed before the target
+            code starts, and a call that finds the queue empty raises
+            UnexpectedCall immediately. in blocking mode:
+            - a call that finds the queue empty waits up to `timeout`
+              seconds for a feeder thread to push the next expectation
+              before raising UnexpectedCall;
+            - if `maxsize` is positive, push() waits up to `timeout`
+              seconds for the target code to consume an expectation
+              before raising CallQueueFull. this keeps memory bounded when
+              a feeder thread streams a very long script.
+
+            `timeout=None` waits forever, just like queue.Queue.
+
+            maxsize: int.
+            timeout: float (seconds) or None.
+        """
+        self._maxsize = maxsize
+        self._timeout = timeout
+        self._blocking = True
+        self._locked = True
+
+    def enable_fail_fast(self):
+        """
+            abort the whole queue on the first pop error (ie: the first
+            UnexpectedCall raised by a mocked call, in any thread).
+
+            by default, an UnexpectedCall in a worker thread is only stored
+            in pop_errors, and the test doesn't find out until its patched
+            scope exits, often after other threads have waited for
+            timeouts. in fail-fast mode, once a pop error is stored:
+            - every later mocked call, in every thread, raises
+              UnexpectedCall straight away;
+            - calls and pushes blocked in this queue (see enable_blocking()
+              and enable_scheduling()) wake up and raise too.
+            so the patched scope aborts promptly.
+
+            these follow-on errors aren't stored in pop_errors, which only
+            keeps the errors that caused the abort.
+        """
+        self._fail_fast = True
+
+    def enable_scheduling(self, threads, seed=None, settle=0.05,
+                          timeout=None):
+        """
+            make every mocked call a scheduling point, so multi-threaded
+            target code runs in a deterministic interleaving.
+
+            a thread making a mocked call is parked until the scheduler
+            gives it the turn. the scheduler only decides once `threads`
+            threads are parked (or, when fewer are still making calls, once
+            nothing has happened for `settle` seconds). it then releases
+            one thread whose call the queue can accept right now, and the
+            other threads stay parked until that thread makes its next
+            call or finishes. so between scheduling points, only one
+            thread runs.
+
+            the released thread is picked:
+            - if `seed` is None, in queue order: the call the queue
+              expects next (the one matching the earliest ready
+              expectation, in unordered() groups);
+            - else, at random with random.Random(seed). push the calls
+              that may happen in any order inside unordered() blocks and
+              run the test once per seed to explore their interleavings
+              systematically. the same seed always gives the same
+              interleaving.
+            calls that the same expectation accepts are released in
+            thread name order, numbers compared as numbers, so give the
+            threads stable names (the default "Thread-N" names follow
+            creation order).
+
+            if no parked call can be accepted after all `threads` threads
+            are parked, or after a call has waited `timeout` seconds, the
+            longest-waiting call is released anyway and raises
+            UnexpectedCall instead of deadlocking.
+
+            threads: int, the number of threads making mocked calls
+                concurrently, eg: the size of a thread pool under test.
+            seed: hashable or None.
+            settle: float (seconds).
+            timeout: float (seconds) or None.
+        """
+        if threads < 1:
+            raise ValueError("Scheduling needs at least 1 thread.")
+        self._scheduler = _Scheduler(self, threads, seed, settle, timeout)
+        # each call now goes through the scheduler first. shadowing the
+        # method keeps the unscheduled _pop() free of any extra checks.
+        self._pop = self._scheduler.pop
+
+    def enable_sampling(self, every=None, paths=(), seed=None):
+        """
+            only validate a deterministic sample of calls, for long soak
+            runs where comparing every call costs more than it's worth.
+
+            a call is validated as usual if its path (eg: "db.query" or
+            "session().commit") is in `paths`, or if it's one in every
+            `every` of the other calls. the sample starts at an offset
+            picked with random.Random(seed) (or at the first call, if
+            `seed` is None), so the same seed always validates the same
+            calls. mismatches among them raise UnexpectedCall and are
+            stored in pop_errors, as usual.
+
+            the other calls aren't compared at all: each one takes the next
+            expectation (or a matching stub) and returns its result, so
+            results still come back in queue order. they don't send
+            on_match events to listeners.
+
+            while the queue is locked (in blocking mode, or once an
+            unordered group or Script is queued), every call is validated,
+            since finding its expectation takes a comparison anyway.
+
+            enable sampling before scheduling, if both are used.
+
+            every: int, or None to only validate `paths`.
+            paths: iterable of call paths.
+            seed: hashable or None.
+        """
+        if every is None and not paths:
+            raise ValueError("Sampling needs `every` or `paths`.")
+        if every is not None and every < 1:
+            raise ValueError("`every` must be at least 1.")
+        if self._scheduler is not None:
+            raise ValueError("Enable sampling before scheduling.")
+        self._sampler = _Sampler(every, paths, seed)
+        # like enable_scheduling(), shadow the method, so _pop() itself
+        # never has to check for sampling.
+        self._pop = self._pop_sampled
+
+    def _pop_sampled(self, actual_call):
+        """ _pop() in sampling mode. see enable_sampling(). """
+        if self._locked or self._sampler.validates(actual_call):
+            return CallQueue._pop(self, actual_call)
+        if self._stubs is not None:
+            stub = self._stubs.find(actual_call)
+            if stub is not None:
+                if self._history is not None:
+                    self._record_history(actual_call, stub)
+                return stub.deliver(actual_call)
+        try:
+            expectation = self._queue.popleft()
+        except IndexError:
+            self._raise_empty(
+                actual_call,
+                "Queue is empty. call: {0}".format(actual_call)
+            )
+        if self._history is not None:
+            self._record_history(actual_call, expectation)
+        return expectation.deliver(actual_call)
+
+    def _accepting_index(self, actual_call):
+        """
+            the position of the expectation that _pop(actual_call) would
+            consume right now, without consuming anything, or None if it
+            would fail. stubs come first, at 0. only used by _Scheduler.
+        """
+        if (self._stubs is not None
+                and self._stubs.find(actual_call) is not None):
+            return 0
+        with self._queue_changed:
+            if not self._queue:
+                return None
+            front = self._queue[0]
+            if front.__class__ is _ScriptCursor:
+                front = self._unroll_script(front)
+            if front.__class__ is _UnorderedGroup:
+                index = front.accepting_index(actual_call)
+                return None if index is None else index + 1
+            return 1 if front.matches(actual_call) else None
+
+    def enable_history(self, size=100):
+        """
+            keep the last `size` consumed expectations (including stub
+            matches) in a ring buffer, and include them in the message of
+            every UnexpectedCall raised afterwards. memory stays bounded
+            however long the run is, and each pop costs one slot write.
+
+            enabling history again clears it.
+
+            size: int.
+        """
+        if size < 1:
+            raise ValueError("History size must be at least 1.")
+        self._history = [None] * size
+        # next() on itertools.count is atomic, so concurrent pops never
+        # get the same slot.
+        self._history_counter = itertools.count()
+
+    def history(self):
+        """
+            return the recorded HistoryRecords, oldest first. `result` is
+            the pushed result (None for factories). see enable_history().
+        """
+        if self._history is None:
+            return []
+        entries = sorted(
+            (entry for entry in self._history if entry is not None),
+            key=lambda entry: entry[0]
+        )
+        return [HistoryRecord(*entry[1:]) for entry in entries]
+
+    def _record_history(self, actual_call, expectation):
+        seq = next(self._history_counter)
+        self._history[seq % len(self._history)] = (
+            seq, actual_call, expectation.result, get_thread_id(), time.time()
+        )
+
+    def _format_history(self):
+        records = self.history()
+        if not records:
+            return ""
+        return "\nlast {0} consumed calls (oldest first):\n{1}".format(
+            len(records),
+            "\n".join(
+                "    {0} -> {1!r} (thread {2}, at {3:.6f})".format(*record)
+                for record in records
+            )
+        )
+
+    def push(self, expected_call, result=None, latency=None, awaitable=False,
+             after=(), factory=None):
         """
             push expected_call onto the queue with the intended result.
 
@@ -505,8 +1435,31 @@ class CallQueue(object):
             it cannot represent an attribute:
                 call.foo.barf
 
+            if `latency` is given, the matching call blocks for that long
+            before returning (or raising) the result. it can be a fixed
+            number of seconds or a zero-arg callable returning seconds,
+            such as a LatencyProfile.
+
+            if `awaitable` is True, the matching call returns an awaitable
+            which (after `await asyncio.sleep(latency)`) returns or raises
+            the result. use this to mock coroutine functions.
+
+            if `factory` is given instead of `result`, the result is built
+            by calling `factory(*args, **kwargs)` with the matching call's
+            arguments, only once the expectation is consumed. use this for
+            results that are expensive to build.
+
+            returns a handle for the new expectation. inside an
+            unordered() block, handles of earlier expectations in the same
+            block can be passed as `after` to make this expectation wait
+            for them.
+
             expected_call: a `call` object.
             result: anything.
+            latency: float (seconds), callable, or None.
+            awaitable: bool.
+            after: iterable of handles returned by push().
+            factory: callable or None.
         """
         _, _, from_kall = call_parts(expected_call)
         if not from_kall:
@@ -515,20 +1468,150 @@ class CallQueue(object):
                 .format(expected_call)
             )
 
-        # wrap result in a mock.Mock to handle raising when the result is
-        # an exception or exception type.
-        mock_result = mock.Mock()
-        # also box result in a tuple so mock.Mock doesn't try to unpack
-        # result into multiple responses if it happens to be iterable.
-        mock_result.side_effect = (result,)
-        self._queue.append((expected_call, mock_result))
+        expectation = _Expectation(
+            expected_call, result, latency, awaitable, factory
+        )
+        self._push_expectation(expectation, after)
+        if self._listeners is not None:
+            self._notify(
+                "on_push",
+                PushEvent(expected_call=expected_call, result=result)
+            )
+        return expectation
+
+    def _push_expectation(self, expectation, after):
+        if self._open_group is not None:
+            if expectation.stream_items:
+                raise ValueError(
+                    "Streams inside an unordered() block are only allowed"
+                    " as `__iter__` results."
+                )
+            self._open_group.add(expectation, after)
+        elif after:
+            raise ValueError(
+                "`after` is only allowed inside an unordered() block."
+            )
+        else:
+            if expectation.stream_items:
+                # a Stream stays at the front while it's advanced, which
+                # only _locked_popleft() can do atomically.
+                self._locked = True
+            self._append(expectation)
+
+    @contextlib.contextmanager
+    def unordered(self):
+        """
+            expectations pushed inside this block may be consumed in any
+            order, but all of them must be consumed before anything pushed
+            after the block. use this for calls that the target code may
+            legitimately make concurrently:
+
+                with qm.call_queue.unordered():
+                    qm.call_queue.push(call.warm("a"), None)
+                    qm.call_queue.push(call.warm("b"), None)
+                qm.call_queue.push(call.write(), None)
+
+            to express a dependency DAG instead of a plain set, pass
+            handles returned by push() as `after`:
+
+                with qm.call_queue.unordered():
+                    a = qm.call_queue.push(call.read("a"), 1)
+                    b = qm.call_queue.push(call.read("b"), 2)
+                    qm.call_queue.push(call.merge(), 3, after=(a, b))
+                    qm.call_queue.push(call.log(), None)
+
+            incoming calls are matched against the expectations whose
+            dependencies have all been consumed. if a call only matches an
+            expectation that is still waiting, the UnexpectedCall names the
+            dependencies it is waiting for.
+
+            unordered() blocks cannot be nested.
+        """
+        if self._open_group is not None:
+            raise ValueError("unordered() blocks cannot be nested.")
+        group = _UnorderedGroup()
+        self._open_group = group
+        try:
+            yield group
+        finally:
+            self._open_group = None
+        if group.remaining:
+            self._locked = True
+            self._append(group)
+
+    def stub(self, expected_call, result=None, latency=None, awaitable=False,
+             factory=None):
+        """
+            register a canned result for expected_call which is returned
+            every time a matching call comes in. unlike push(), stubs are
+            never consumed and are checked before the queue, so they are
+            meant for high-throughput benchmarks rather than strict call
+            sequences. calls matching no stub still fall through to the
+            queue (and raise UnexpectedCall if nothing matches there).
+
+            stubs with plain arguments (str, int, tuples of those, etc) are
+            found by a single hash lookup. stubs with other arguments (eg,
+            mock.ANY, QMocks, lists) are compared one by one, in order of
+            registration. stubbing the same plain call twice replaces the
+            first result.
+
+            a stub's `factory` (see push()) is called for every matching
+            call, so one stub can compute a different result per call.
 
-    def push_all(self, expected_call, result):
+            expected_call: a `call` object.
+            result: anything.
+            latency: see push().
+            awaitable: see push().
+            factory: see push().
+        """
+        _, _, from_kall = call_parts(expected_call)
+        if not from_kall:
+            raise BadCall(
+                "Call object represents attribute fetch, not function: {0}"
+                .format(expected_call)
+            )
+
+        if self._stubs is None:
+            self._stubs = _StubIndex()
+        self._stubs.add(
+            _Expectation(expected_call, result, latency, awaitable, factory)
+        )
+
+    def _append(self, expectation):
+        if not self._blocking:
+            self._queue.append(expectation)
+            return
+        with self._queue_changed:
+            if self._maxsize > 0 and not wait_for(
+                    self._queue_changed,
+                    lambda: (
+                        len(self._queue) < self._maxsize
+                        or self._abort_error is not None
+                    ),
+                    self._timeout):
+                raise CallQueueFull(
+                    "Queue is full after waiting {0}s; {1} expected calls"
+                    " remaining."
+                    .format(self._timeout, len(self._queue))
+                )
+            if self._abort_error is not None:
+                raise self._aborted(expectation.call)
+            self._queue.append(expectation)
+            self._queue_changed.notify_all()
+
+    def push_all(self, expected_call, result=None, latency=None,
+                 awaitable=False, after=(), factory=None):
         """
             push expected_call and all its parent calls onto the queue.
 
-            `result` is expected_call's result. parent call results are
-            generated dynamically from the attached QMock.
+            `result` (or `factory`) is expected_call's result. parent call
+            results are generated dynamically from the attached QMock.
+            `latency`, `awaitable` and `factory` only apply to
+            expected_call, not its parents.
+            `after` applies to the first parent; inside an unordered()
+            block, each call in the chain waits for the one before it.
+
+            returns the handle for expected_call.
 
             just like push(), expected_call must represent a function call:
                 call.foo.bar().baz()
@@ -537,49 +1620,1320 @@ class CallQueue(object):
 
             expected_call: a `call` object.
             result: anything.
+            latency: float (seconds), callable, or None.
+            awaitable: bool.
+            after: iterable of handles returned by push().
+            factory: callable or None.
         """
+        in_group = self._open_group is not None
         # parent calls are call_list[:-1]; expected_call is call_list[-1].
         for call in expected_call.call_list()[:-1]:
-            self.push(call, self._qmock.mock_return(call))
-        self.push(expected_call, result)
+            handle = self.push(call, self._qmock.mock_return(call), after=after)
+            if in_group:
+                after = (handle,)
+        return self.push(
+            expected_call, result, latency, awaitable, after, factory
+        )
+
+    def chain(self, template_call):
+        """
+            compile the shape of a fluent call chain once, for pushing
+            many times with different args. this is push_all() for
+            chain-heavy scripts (ORMs, query builders, etc), without
+            building a new `call` chain and call_list() for every push:
+
+                query = qm.call_queue.chain(
+                    call.query().filter().order_by().limit().all()
+                )
+                query.push([None, call(x=1), call("name"), call(10), None],
+                           rows)
+
+            returns a template whose push(steps, result, ...) takes one
+            `call(...)` per call in the chain, giving that call's args, or
+            None to reuse the args from template_call. the other arguments
+            are the same as push_all(). parent results still come from
+            QMock.mock_return(), so assigned attributes are honored.
+
+            just like push(), template_call must represent a function call.
+
+            template_call: a `call` object.
+        """
+        _, _, from_kall = call_parts(template_call)
+        if not from_kall:
+            raise BadCall(
+                "Call object represents attribute fetch, not function: {0}"
+                .format(template_call)
+            )
+        return _ChainTemplate(self, template_call.call_list())
+
+    def load(self, path, cache_dir=None):
+        """
+            push (and stub) the expectations in the JSON expectation file
+            at `path`, in order. see the README for the file format.
+
+            the file is compiled once into a compact list of plain tuples,
+            which is cached as JSON in `cache_dir` (default: a __qmock_cache__
+            directory next to the file) under the sha256 of the file's
+            content. later loads of the same content skip parsing and
+            validating the calls, and build the expectations directly.
+            editing the file simply compiles it again.
+
+            path: str.
+            cache_dir: str or None.
+        """
+        nodes = dict()
+        def node(node_path):
+            # parent results of chains share their prefixes.
+            try:
+                return nodes[node_path]
+            except KeyError:
+                value = nodes[node_path] = _qmock_node(self._qmock, node_path)
+                return value
+        for kind, compiled in load_compiled(path, cache_dir):
+            if kind == "push":
+                self._push_loaded(compiled, node, ())
+            elif kind == "stub":
+                if self._stubs is None:
+                    self._stubs = _StubIndex()
+                self._stubs.add(_loaded_expectation(compiled, node))
+            else:
+                with self.unordered():
+                    handles = list()
+                    for item in compiled:
+                        handles.append(self._push_loaded(
+                            item, node, [handles[i] for i in item[-1]]
+                        ))
+
+    def freeze(self):
+        """
+            return an immutable Script of the expectations and stubs
+            currently in this queue, which can then be attached to any
+            number of QMocks (see attach()). the queue itself is left as
+            it is.
+
+            results that are nodes of this queue's QMock (eg: the parent
+            results of push_all()) are recorded by call path, so each
+            attached QMock gets its own nodes. Stream results can't be
+            frozen, since each QMock would advance the same iterator.
+        """
+        if self._open_group is not None:
+            raise ValueError("Can't freeze inside an unordered() block.")
+        steps = list()
+        for item in tuple(self._queue):
+            if item.__class__ is _ScriptCursor:
+                steps.extend(item.remaining_steps())
+            elif item.__class__ is _UnorderedGroup:
+                members = item.__getstate__()["members"]
+                indices = dict(
+                    (id(expectation), index)
+                    for index, (expectation, _) in enumerate(members)
+                )
+                steps.append((None, tuple(
+                    self._script_step(expectation)
+                    + (tuple(indices[id(dep)] for dep in deps),)
+                    for expectation, deps in members
+                )))
+            else:
+                steps.append(self._script_step(item))
+        stubs = () if self._stubs is None else tuple(
+            self._script_step(stub) for stub in self._stubs.expectations()
+        )
+        return Script(steps, stubs)
+
+    def _script_step(self, expectation):
+        """ (expectation, node path or None) for freeze(). """
+        result = expectation.result
+        if issubclass(type(result), Stream):
+            raise ValueError(
+                "Can't freeze Stream results: {0}".format(expectation.call)
+            )
+        if result is self._qmock:
+            return (_with_result(expectation, None), "")
+        if isinstance(result, _PROXY_TYPES):
+            _, (root, path) = result.__reduce_ex__(2)
+            if root is self._qmock:
+                return (_with_result(expectation, None), path)
+        return (expectation, None)
+
+    def attach(self, script):
+        """
+            queue a Script (see freeze() and Script.load()) after anything
+            already pushed. the QMock consumes it through its own cursor,
+            one step at a time, so attaching costs the same however long
+            the script is, and the script is never copied. the script's
+            stubs are registered right away.
+
+            script: a Script.
+        """
+        if self._open_group is not None:
+            raise ValueError("Scripts can't be attached inside an"
+                             " unordered() block.")
+        cursor = _ScriptCursor(script, self._qmock)
+        for stub in script._stubs:
+            if self._stubs is None:
+                self._stubs = _StubIndex()
+            self._stubs.add(cursor.bind(*stub))
+        if cursor.remaining:
+            # like unordered groups, the cursor is unrolled in
+            # _locked_popleft().
+            self._locked = True
+            self._append(cursor)
+
+    def _unroll_script(self, cursor):
+        """
+            replace the cursor at the front of the queue with its next
+            step, followed by the cursor unless it's done. only called
+            with _queue_changed held. returns the new front.
+        """
+        step = cursor.next_step()
+        if not cursor.remaining:
+            self._queue.popleft()
+        self._queue.appendleft(step)
+        return step
+
+    def _push_loaded(self, compiled, node, after):
+        expectation = _loaded_expectation(compiled, node)
+        self._push_expectation(expectation, after)
+        if self._listeners is not None:
+            self._notify(
+                "on_push",
+                PushEvent(
+                    expected_call=expectation.call, result=expectation.result
+                )
+            )
+        return expectation
 
     def _pop(self, actual_call):
         """ only called by QMock._pop_mock_call_queue() """
+        listeners = self._listeners
+        if listeners is not None:
+            start = monotonic()
+        if self._stubs is not None:
+            stub = self._stubs.find(actual_call)
+            if stub is not None:
+                if listeners is not None:
+                    self._notify_match(actual_call, stub, start)
+                if self._history is not None:
+                    self._record_history(actual_call, stub)
+                return stub.deliver(actual_call)
+        if self._locked:
+            expectation = self._locked_popleft(actual_call)
+        else:
+            # deque.popleft() is atomic (also on free-threaded builds), so
+            # each expectation goes to exactly one thread, which can then
+            # compare it without holding any lock.
+            try:
+                expectation = self._queue.popleft()
+            except IndexError as ex:
+                self._raise_empty(
+                    actual_call,
+                    "Queue is empty. call: {0}".format(actual_call)
+                )
+            try:
+                if expectation.matcher is None:
+                    mismatch = not (
+                        expectation.plain is not None
+                        and _tuple_eq(expectation.plain, actual_call)
+                    ) and actual_call != expectation.call
+                else:
+                    mismatch = not expectation.matcher(actual_call)
+            except ValueError:
+                # see _Expectation.matches()
+                mismatch = True
+            if mismatch:
+                self._raise_mismatch(actual_call, expectation)
+        if listeners is not None:
+            self._notify_match(actual_call, expectation, start)
+        if self._history is not None:
+            self._record_history(actual_call, expectation)
+        return expectation.deliver(actual_call)
+
+    def _can_pop(self):
+        return bool(self._queue) or self._abort_error is not None
+
+    def _locked_popleft(self, actual_call):
+        """
+            _pop() for blocking mode and queues with unordered groups,
+            Scripts or Streams. returns the matching expectation or raises
+            UnexpectedCall.
+        """
+        group = None
+        stream_error = None
+        with self._queue_changed:
+            if self._blocking:
+                not_empty = wait_for(
+                    self._queue_changed,
+                    self._can_pop,
+                    self._timeout
+                )
+                if self._abort_error is not None:
+                    raise self._aborted(actual_call)
+            else:
+                not_empty = bool(self._queue)
+            if not not_empty:
+                expectation = None
+            else:
+                front = self._queue[0]
+                if front.__class__ is _ScriptCursor:
+                    front = self._unroll_script(front)
+                if front.__class__ is _UnorderedGroup:
+                    group = front
+                    expectation = group.take(actual_call)
+                    if not group.remaining:
+                        self._queue.popleft()
+                elif front.stream_items and front.matches(actual_call):
+                    expectation, stream_error = self._take_stream_item(front)
+                else:
+                    expectation = self._queue.popleft()
+            if expectation is not None:
+                # wake any feeder waiting for space.
+                self._queue_changed.notify_all()
+
+        if group is not None:
+            if expectation is None:
+                self._raise_group_mismatch(actual_call, group)
+        elif expectation is None:
+            if self._blocking:
+                message = (
+                    "Queue is empty after waiting {0}s. call: {1}"
+                    .format(self._timeout, actual_call)
+                )
+            else:
+                message = "Queue is empty. call: {0}".format(actual_call)
+            self._raise_empty(actual_call, message)
+        elif stream_error is not None:
+            # like a mismatch, a failed validation is a pop error.
+            self._store_pop_error(stream_error)
+        elif not expectation.matches(actual_call):
+            self._raise_mismatch(actual_call, expectation)
+        return expectation
+
+    def _take_stream_item(self, expectation):
+        """
+            advance the Stream of the matching expectation at the front of
+            the queue, with _queue_changed held, so concurrent calls each
+            get their own item and nothing else can be popped in between.
+
+            returns an expectation delivering the item, and the validation
+            error, if any. the call after the last item (or a failed
+            validation) consumes the expectation and delivers the error.
+        """
+        stream_error = None
         try:
-            expected_call, mock_result = self._queue.popleft()
-        except IndexError as ex:
-            error = UnexpectedCall(
-                "Queue is empty. call: {0}"
-                .format(actual_call)
+            item = _with_result(expectation, next(expectation.result))
+        except (StopIteration, AssertionError) as ex:
+            self._queue.popleft()
+            if isinstance(ex, AssertionError):
+                stream_error = ex
+            item = _with_result(expectation, ex)
+            # raised right away, like next() would.
+            item.latency = None
+            item.awaitable = False
+        item.stream_items = False
+        return item, stream_error
+
+    def _unexpected_call(self, message):
+        if self._history is not None:
+            message += self._format_history()
+        return UnexpectedCall(message)
+
+    def _raise_empty(self, actual_call, message):
+        error = self._unexpected_call(message)
+        if self._listeners is not None:
+            self._notify("on_empty", EmptyEvent(
+                actual_call=actual_call,
+                thread_id=get_thread_id(),
+                error=error
+            ))
+        self._store_pop_error(error)
+        raise error
+
+    def _raise_mismatch(self, actual_call, expectation):
+        error = self._unexpected_call(
+            "Call does not match expectation. actual: {0}; expected: {1}"
+            .format(actual_call, expectation.call)
+        )
+        if self._listeners is not None:
+            self._notify("on_mismatch", MismatchEvent(
+                actual_call=actual_call,
+                expected_call=expectation.call,
+                thread_id=get_thread_id(),
+                error=error
+            ))
+        self._store_pop_error(error)
+        raise error
+
+    def _raise_group_mismatch(self, actual_call, group):
+        blocked_by = group.blocked_by(actual_call)
+        if blocked_by:
+            error = self._unexpected_call(
+                "Call is blocked by unconsumed dependencies. actual: {0};"
+                " waiting for: {1}"
+                .format(actual_call, ", ".join(str(c) for c in blocked_by))
             )
-            self._store_pop_error(error)
-            raise error
-        if actual_call != expected_call:
-            error =  UnexpectedCall(
-                "Call does not match expectation. actual: {0}; expected: {1}"
-                .format(actual_call, expected_call)
+        else:
+            error = self._unexpected_call(
+                "Call does not match any expectation in unordered group."
+                " actual: {0}; expected one of: {1}"
+                .format(
+                    actual_call,
+                    ", ".join(str(c) for c in group.ready_calls())
+                )
             )
-            self._store_pop_error(error)
-            raise error
-        # let it raise if the result is an exception or exception type.
-        return mock_result()
+        if self._listeners is not None:
+            self._notify("on_mismatch", MismatchEvent(
+                actual_call=actual_call,
+                expected_call=None,
+                thread_id=get_thread_id(),
+                error=error
+            ))
+        self._store_pop_error(error)
+        raise error
 
     def _store_pop_error(self, error):
         thread_id = get_thread_id()
         record = ErrorRecord(thread_id=thread_id, error=error)
         with self._pop_errors_lock:
             self.pop_errors.append(record)
+            if not self._fail_fast or self._abort_error is not None:
+                return
+            self._abort_error = record
+        self._abort()
+
+    def _abort_with(self, error):
+        """ abort the queue for a reason other than a pop error. """
+        with self._pop_errors_lock:
+            if self._abort_error is not None:
+                return
+            self._abort_error = ErrorRecord(
+                thread_id=get_thread_id(),
+                error=error
+            )
+        self._abort()
+
+    def _abort(self):
+        """ see enable_fail_fast(). """
+        # like enable_scheduling(), shadow the method, so _pop() itself
+        # never has to check for an abort.
+        self._pop = self._raise_aborted
+        with self._queue_changed:
+            self._queue_changed.notify_all()
+        if self._scheduler is not None:
+            self._scheduler.wake()
+
+    def _aborted(self, actual_call):
+        """ the error for calls made (or woken) after an abort. """
+        return UnexpectedCall(
+            "Queue aborted by a QMock error in thread {0}: {1}. call: {2}"
+            .format(
+                self._abort_error.thread_id,
+                self._abort_error.error,
+                actual_call
+            )
+        )
+
+    def _raise_aborted(self, actual_call):
+        raise self._aborted(actual_call)
+
+    def add_listener(self, listener):
+        """
+            register an object to receive structured events from this
+            queue. the listener may define any of these methods, each
+            taking a single event (see the namedtuples of the same name):
+                on_push(PushEvent)
+                on_match(MatchEvent)
+                on_mismatch(MismatchEvent)
+                on_empty(EmptyEvent)
+                on_assert_empty(AssertEmptyEvent)
+
+            on_match() and on_push() are called in the thread making the
+            call or push, so listeners must be thread-safe if the target
+            code is multi-threaded. any exception raised by a listener
+            propagates to the caller.
+
+            while no listeners are registered, the cost to the per-call
+            hot path is one local `is None` check.
+        """
+        self._listeners = (self._listeners or ()) + (listener,)
+
+    def remove_listener(self, listener):
+        listeners = tuple(
+            registered
+            for registered in self._listeners or ()
+            if registered is not listener
+        )
+        self._listeners = listeners or None
+
+    def _notify(self, method_name, event):
+        for listener in self._listeners or ():
+            handler = getattr(listener, method_name, None)
+            if handler is not None:
+                handler(event)
+
+    def _notify_match(self, actual_call, expectation, start):
+        self._notify("on_match", MatchEvent(
+            actual_call=actual_call,
+            expected_call=expectation.call,
+            thread_id=get_thread_id(),
+            duration=monotonic() - start
+        ))
 
     def assert_empty(self):
         """
             call this at the end of each TestCase to verify that all
             expected calls were consumed.
         """
-        if self._queue:
+        remaining = sum(
+            1 if step.__class__ is _Expectation else step.remaining
+            for step in tuple(self._queue)
+        )
+        if self._listeners is not None:
+            self._notify(
+                "on_assert_empty",
+                AssertEmptyEvent(remaining=remaining)
+            )
+        if remaining:
             raise CallQueueNotEmpty(
                 "Queue is not empty; {0} expected calls remaining."
-                .format(len(self._queue))
+                .format(remaining)
+            )
+
+# CallQueue attributes tied to the running process. see __getstate__().
+_CALL_QUEUE_PROCESS_ATTRS = frozenset(
+    ("_pop", "_pop_errors_lock", "_queue_changed", "_open_group",
+     "_listeners", "_scheduler", "_history_counter", "_patch_timeout")
+)
+
+class _Expectation(object):
+    """ one (expected call, result) pair sitting in a CallQueue. """
+    __slots__ = (
+        "call", "result", "latency", "awaitable", "factory", "matcher",
+        "plain", "stream_items"
+    )
+
+    def __init__(self, call, result, latency, awaitable, factory=None):
+        if factory is not None and result is not None:
+            raise ValueError("Pass either `result` or `factory`, not both.")
+        self.call = call
+        self.result = result
+        self.latency = latency
+        self.awaitable = awaitable
+        self.factory = factory
+        # None unless `call` contains Matchers. see _matchers.compile_call().
+        self.matcher = compile_call(call)
+        # a plain tuple copy of `call` if all its args are plain values.
+        # comparing that with tuple.__eq__ gives the same answer as the
+        # (much slower) `call` comparison whenever they are equal.
+        if self.matcher is None and _call_key(call) is not None:
+            self.plain = tuple(call)
+        else:
+            self.plain = None
+        # True if each matching call takes one item from a Stream result.
+        self.stream_items = (
+            # type() avoids __class__, which proxies forward to mocks.
+            issubclass(type(result), Stream) and not _is_iter_call(call)
+        )
+
+    def __reduce__(self):
+        # `call` objects can't be pickled, and matchers are recompiled.
+        return (
+            _restore_expectation,
+            (
+                tuple(self.call), self.result, self.latency, self.awaitable,
+                self.factory
+            )
+        )
+
+    def matches(self, actual_call):
+        try:
+            if self.matcher is not None:
+                return self.matcher(actual_call)
+            if self.plain is not None and _tuple_eq(self.plain, actual_call):
+                return True
+            return not actual_call != self.call
+        except ValueError:
+            # an unexpected numpy array (or similar) in the actual call
+            # that can't be reduced to a single bool, eg: in a Predicate.
+            return False
+
+    def deliver(self, actual_call):
+        """
+            return the result to the caller, after any simulated latency.
+            raises if the result is an exception or exception type.
+        """
+        result = self.result
+        if self.factory is not None:
+            _, args, kwargs = actual_call
+            result = self.factory(*args, **kwargs)
+        elif self.stream_items:
+            result = next(result)
+        delay = self.latency
+        if delay is not None and callable(delay):
+            delay = delay()
+        if self.awaitable:
+            return _DelayedResult(delay or 0, result)
+        if delay:
+            time.sleep(delay)
+        return _resolve_result(result)
+
+def _restore_expectation(call_tuple, result, latency, awaitable, factory):
+    return _Expectation(
+        mock._Call(call_tuple), result, latency, awaitable, factory
+    )
+
+def _resolve_result(result):
+    """
+        mimic mock.Mock.side_effect: raise the result if it's an exception
+        or exception type, else return it.
+    """
+    if (isinstance(result, BaseException)
+            or (isinstance(result, type) and issubclass(result, BaseException))):
+        raise result
+    return result
+
+class _DelayedResult(object):
+    """
+        the awaitable returned for `awaitable=True` expectations.
+
+        `await` drives asyncio.sleep(delay) and then returns (or raises)
+        the result. this is written as a plain iterator instead of a
+        coroutine function so the module still imports on python 2.7.
+    """
+    def __init__(self, delay, result):
+        self._delay = delay
+        self._result = result
+
+    def __await__(self):
+        import asyncio
+        sleep = asyncio.sleep(self._delay)
+        # on python 3.5 and 3.6, asyncio.sleep() is a generator-based
+        # coroutine, which has no __await__() and is its own iterator.
+        sleep_iter = getattr(sleep, "__await__", lambda: sleep)()
+        return _DelayedResultIterator(sleep_iter, self._result)
+
+class _DelayedResultIterator(object):
+    def __init__(self, sleep_iter, result):
+        self._sleep_iter = sleep_iter
+        self._result = result
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return self.send(None)
+
+    def send(self, value):
+        try:
+            return self._sleep_iter.send(value)
+        except StopIteration:
+            raise StopIteration(_resolve_result(self._result))
+
+    def throw(self, *exc_info):
+        try:
+            return self._sleep_iter.throw(*exc_info)
+        except StopIteration:
+            raise StopIteration(_resolve_result(self._result))
+
+class LatencyProfile(object):
+    """
+        a seeded latency distribution described by percentiles, for use
+        as the `latency` of pushed expectations:
+
+            profile = LatencyProfile({50: 0.01, 90: 0.05, 99: 0.25}, seed=7)
+            qm.call_queue.push(call.fetch(), rows, latency=profile)
+
+        each sample draws a uniform percentile and interpolates linearly
+        between the given points. below the lowest given percentile,
+        latency interpolates from 0s at the 0th percentile. above the
+        highest, latency is clamped to the highest given value.
+
+        share one profile between expectations to draw a single,
+        reproducible sequence of latencies. for other distributions, any
+        zero-arg callable works as a latency, eg:
+            functools.partial(random.Random(seed).expovariate, 20)
+    """
+    def __init__(self, percentiles, seed=None):
+        """
+            percentiles: mapping of percentile (0-100) to seconds.
+            seed: anything accepted by random.seed().
+        """
+        points = sorted(percentiles.items())
+        if not points:
+            raise ValueError("LatencyProfile needs at least one percentile.")
+        for percentile, seconds in points:
+            if not 0 <= percentile <= 100 or seconds < 0:
+                raise ValueError(
+                    "Bad latency percentile: {0} -> {1}s"
+                    .format(percentile, seconds)
+                )
+        if points[0][0] > 0:
+            points.insert(0, (0, 0.0))
+        self._percentiles = [percentile for percentile, _ in points]
+        self._seconds = [seconds for _, seconds in points]
+        self._random = random.Random(seed)
+
+    def __call__(self):
+        percentile = self._random.random() * 100
+        i = bisect.bisect_right(self._percentiles, percentile)
+        if i >= len(self._percentiles):
+            return self._seconds[-1]
+        lo_p, hi_p = self._percentiles[i - 1], self._percentiles[i]
+        lo_s, hi_s = self._seconds[i - 1], self._seconds[i]
+        return lo_s + (hi_s - lo_s) * (percentile - lo_p) / (hi_p - lo_p)
+
+class Stream(object):
+    """
+        a lazy result that yields items from `iterable` one at a time,
+        for mocking dependencies that return large iterables (cursor
+        rows, paginated results, file lines) without materializing them:
+
+            qm.call_queue.push(call.cursor.__iter__(qm.cursor),
+                               Stream(read_rows(), validate=row_is_valid))
+
+        pushed for an `__iter__` call, the Stream is returned as the
+        iterator itself. pushed (or stubbed) for any other call, such as
+        `__next__` or `fetchone()`, each matching call returns the next
+        item and the expectation stays at the front of the queue until
+        the iterable is exhausted; the call after the last item consumes
+        the expectation and raises StopIteration.
+
+        if `validate` is given, each item is checked with it as it is
+        produced. it can be a callable or a Matcher. an item that fails
+        validation raises AssertionError. for a pushed Stream, it also
+        consumes the expectation and is recorded in pop_errors.
+    """
+    def __init__(self, iterable, validate=None):
+        """
+            iterable: anything iterable. it is only iterated on demand.
+            validate: callable, Matcher, or None.
+        """
+        self._iterable = iterable
+        self._iterator = None
+        self._validator = validate
+        if isinstance(validate, Matcher):
+            validate = validate.compile()
+        self._validate = validate
+        # generators can't be advanced by two threads at once.
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        # only Streams over picklable iterables (eg: lists) can be pickled.
+        return (self._iterable, self._iterator, self._validator)
+
+    def __setstate__(self, state):
+        iterable, iterator, validate = state
+        self.__init__(iterable, validate)
+        self._iterator = iterator
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        with self._lock:
+            if self._iterator is None:
+                self._iterator = iter(self._iterable)
+            item = next(self._iterator)
+        if self._validate is not None and not self._validate(item):
+            raise AssertionError(
+                "Streamed item failed validation: {0!r}".format(item)
+            )
+        return item
+
+    # python 2.7
+    next = __next__
+
+def _is_iter_call(kall):
+    name, _, _ = kall
+    return name.rsplit(".", 1)[-1] == "__iter__"
+
+def _loaded_expectation(compiled, node):
+    """ an _Expectation from a compiled expectation file entry. """
+    path, args, kwargs, result, latency, awaitable, _ = compiled
+    return _Expectation(
+        mock._Call((path, args, kwargs)),
+        decode_result(result, node),
+        latency,
+        awaitable
+    )
+
+def _with_result(expectation, result):
+    """ a copy of `expectation` with another result, without recompiling. """
+    copy = _Expectation.__new__(_Expectation)
+    for name in _Expectation.__slots__:
+        setattr(copy, name, getattr(expectation, name))
+    copy.result = result
+    return copy
+
+class Script(object):
+    """
+        an immutable expectation script, shared by any number of QMocks.
+
+        tests that push the same script each pay for building every
+        expectation, and keep their own copy of it. instead, build the
+        script once per process, with CallQueue.freeze() or Script.load(),
+        and attach it to each test's QMock:
+
+            def _build_script():
+                qm = qmock.QMock()
+                qm.call_queue.push_all(call.connect().query("users"), rows)
+                return qm.call_queue.freeze()
+
+            SCRIPT = _build_script()
+
+            qm.call_queue.attach(SCRIPT)
+
+        each QMock consumes the script through its own cursor, so the
+        expectations themselves are never copied. results that are QMock
+        nodes are resolved against the attached QMock when consumed.
+    """
+    def __init__(self, steps, stubs=()):
+        """
+            use CallQueue.freeze() or Script.load() instead.
+
+            steps: sequence of (expectation, node path or None), or
+                (None, tuple of (expectation, node path or None, after
+                indices)) for unordered groups.
+            stubs: sequence of (expectation, node path or None).
+        """
+        steps = tuple(steps)
+        # expected calls from each step to the end, for assert_empty().
+        remaining = [0]
+        for expectation, extra in reversed(steps):
+            remaining.append(
+                remaining[-1] + (1 if expectation is not None else len(extra))
+            )
+        # bypass __setattr__().
+        self.__dict__.update(
+            _steps=steps,
+            _stubs=tuple(stubs),
+            _remaining=tuple(reversed(remaining))
+        )
+
+    @classmethod
+    def load(cls, path, cache_dir=None):
+        """
+            a Script of the expectations in a JSON expectation file, using
+            the same format and cache as CallQueue.load().
+
+            path: str.
+            cache_dir: str or None.
+        """
+        def step(compiled):
+            result = compiled[3]
+            if result[0] == "node":
+                # resolved by each cursor. see _ScriptCursor.bind().
+                return (
+                    _loaded_expectation(compiled, lambda path: None),
+                    result[1]
+                )
+            return (_loaded_expectation(compiled, None), None)
+        steps = list()
+        stubs = list()
+        for kind, compiled in load_compiled(path, cache_dir):
+            if kind == "push":
+                steps.append(step(compiled))
+            elif kind == "stub":
+                stubs.append(step(compiled))
+            else:
+                steps.append((None, tuple(
+                    step(item) + (item[-1],) for item in compiled
+                )))
+        return cls(steps, stubs)
+
+    def __len__(self):
+        """ the number of expected calls, excluding stubs. """
+        return self._remaining[0]
+
+    def __setattr__(self, name, value):
+        raise AttributeError("Scripts are immutable.")
+
+    def __delattr__(self, name):
+        raise AttributeError("Scripts are immutable.")
+
+class _ScriptCursor(object):
+    """ a QMock's position in an attached Script. see CallQueue.attach(). """
+    __slots__ = ("_script", "_qmock", "_index", "_nodes")
+
+    def __init__(self, script, root_qmock, index=0):
+        self._script = script
+        self._qmock = root_qmock
+        self._index = index
+        # node path -> node, for results resolved so far.
+        self._nodes = dict()
+
+    def __reduce__(self):
+        return (_ScriptCursor, (self._script, self._qmock, self._index))
+
+    @property
+    def remaining(self):
+        return self._script._remaining[self._index]
+
+    def remaining_steps(self):
+        return self._script._steps[self._index:]
+
+    def next_step(self):
+        """
+            consume the next step, returning its _Expectation or a new
+            _UnorderedGroup.
+        """
+        expectation, extra = self._script._steps[self._index]
+        self._index += 1
+        if expectation is not None:
+            return self.bind(expectation, extra)
+        group = _UnorderedGroup()
+        handles = list()
+        for member, node_path, after in extra:
+            handle = self.bind(member, node_path)
+            group.add(handle, [handles[i] for i in after])
+            handles.append(handle)
+        return group
+
+    def bind(self, expectation, node_path):
+        """ the expectation with its result resolved for this QMock. """
+        if node_path is None:
+            # shared with every other cursor.
+            return expectation
+        try:
+            node = self._nodes[node_path]
+        except KeyError:
+            if node_path:
+                node = _qmock_node(self._qmock, node_path)
+            else:
+                node = self._qmock
+            self._nodes[node_path] = node
+        return _with_result(expectation, node)
+
+class _ChainTemplate(object):
+    """ returned by CallQueue.chain(). """
+    def __init__(self, call_queue, calls):
+        self._call_queue = call_queue
+        # the template's calls, for mock_return() of the parents.
+        self._calls = list(calls)
+        # (path, args, kwargs) per call, eg: ("query().filter", (), {}).
+        self._defaults = [tuple(kall) for kall in self._calls]
+
+    def push(self, steps, result=None, latency=None, awaitable=False,
+             after=(), factory=None):
+        """
+            push one instance of the chain. see CallQueue.chain().
+
+            steps: sequence of `call(...)` objects or None, one per call.
+            others: see CallQueue.push_all().
+        """
+        defaults = self._defaults
+        if len(steps) != len(defaults):
+            raise ValueError(
+                "Chain has {0} calls but {1} steps were given."
+                .format(len(defaults), len(steps))
+            )
+        call_queue = self._call_queue
+        mock_return = call_queue._qmock.mock_return
+        in_group = call_queue._open_group is not None
+        last = len(defaults) - 1
+        for i, step in enumerate(steps):
+            path, args, kwargs = defaults[i]
+            if step is not None:
+                _, args, kwargs = step
+            kall = mock._Call((path, args, kwargs))
+            if i == last:
+                return call_queue.push(
+                    kall, result, latency, awaitable, after, factory
+                )
+            handle = call_queue.push(
+                kall, mock_return(self._calls[i]), after=after
+            )
+            if in_group:
+                after = (handle,)
+
+class _UnorderedGroup(object):
+    """
+        a set of expectations, built by CallQueue.unordered(), that can be
+        consumed in any order allowed by their `after` dependencies.
+
+        ready expectations (no unconsumed dependencies) with plain
+        arguments are indexed by _call_key(), so matching a call is one
+        hash lookup instead of a scan of everything pending.
+    """
+    def __init__(self):
+        # _call_key -> deque of ready expectations, in push order.
+        self._ready = dict()
+        # ready expectations without a _call_key, in push order.
+        self._ready_unindexed = list()
+        # id(expectation) -> (expectation, its unconsumed dependencies)
+        self._waiting = dict()
+        # id(expectation) -> expectations waiting on it.
+        self._dependents = dict()
+        # id() of every unconsumed expectation.
+        self._members = set()
+        self.remaining = 0
+
+    def add(self, expectation, after):
+        deps = list(after)
+        for dep in deps:
+            if id(dep) not in self._members:
+                raise ValueError(
+                    "`after` handles must be unconsumed expectations from"
+                    " earlier push() calls in the same unordered() block."
+                )
+        self._members.add(id(expectation))
+        self.remaining += 1
+        if deps:
+            self._waiting[id(expectation)] = (expectation, deps)
+            for dep in deps:
+                self._dependents.setdefault(id(dep), []).append(expectation)
+        else:
+            self._make_ready(expectation)
+
+    def _make_ready(self, expectation):
+        key = _call_key(expectation.call)
+        if key is None:
+            self._ready_unindexed.append(expectation)
+        else:
+            self._ready.setdefault(key, deque()).append(expectation)
+
+    def take(self, actual_call):
+        """
+            consume and return a ready expectation matching actual_call,
+            or return None (and consume nothing) if there is none.
+        """
+        key = _call_key(actual_call)
+        if key is not None:
+            bucket = self._ready.get(key)
+            if bucket:
+                expectation = bucket.popleft()
+                if not bucket:
+                    del self._ready[key]
+                self._consume(expectation)
+                return expectation
+        else:
+            # the actual call may still equal an indexed expectation, eg:
+            # if one of its args is a float subclass equal to an int.
+            for key, bucket in self._ready.items():
+                for expectation in bucket:
+                    if expectation.matches(actual_call):
+                        bucket.remove(expectation)
+                        if not bucket:
+                            del self._ready[key]
+                        self._consume(expectation)
+                        return expectation
+        for expectation in self._ready_unindexed:
+            if expectation.matches(actual_call):
+                self._ready_unindexed.remove(expectation)
+                self._consume(expectation)
+                return expectation
+        return None
+
+    def __getstate__(self):
+        # the dicts are keyed by id(), which a copy doesn't keep. instead,
+        # store each unconsumed expectation with its unconsumed
+        # dependencies, dependencies first, to add() them again.
+        members = [
+            (expectation, [])
+            for bucket in self._ready.values()
+            for expectation in bucket
+        ]
+        members.extend((e, []) for e in self._ready_unindexed)
+        added = set(id(expectation) for expectation, _ in members)
+        waiting = list(self._waiting.values())
+        while waiting:
+            for item in waiting:
+                expectation, deps = item
+                if all(id(dep) in added for dep in deps):
+                    members.append((expectation, list(deps)))
+                    added.add(id(expectation))
+                    waiting.remove(item)
+                    break
+        return {"members": members}
+
+    def __setstate__(self, state):
+        self.__init__()
+        for expectation, deps in state["members"]:
+            self.add(expectation, deps)
+
+    def accepting_index(self, actual_call):
+        """
+            like take(), but only returns the position of a matching ready
+            expectation, or None.
+        """
+        index = 0
+        for bucket in self._ready.values():
+            for expectation in bucket:
+                if expectation.matches(actual_call):
+                    return index
+                index += 1
+        for expectation in self._ready_unindexed:
+            if expectation.matches(actual_call):
+                return index
+            index += 1
+        return None
+
+    def _consume(self, expectation):
+        self._members.discard(id(expectation))
+        self.remaining -= 1
+        for dependent in self._dependents.pop(id(expectation), ()):
+            _, deps = self._waiting[id(dependent)]
+            deps.remove(expectation)
+            if not deps:
+                del self._waiting[id(dependent)]
+                self._make_ready(dependent)
+
+    def ready_calls(self):
+        """ only used to build error messages. """
+        calls = [
+            expectation.call
+            for bucket in self._ready.values()
+            for expectation in bucket
+        ]
+        return calls + [e.call for e in self._ready_unindexed]
+
+    def blocked_by(self, actual_call):
+        """
+            if actual_call matches a waiting expectation, return the calls
+            of its unconsumed dependencies. else, return an empty list.
+            only used to build error messages.
+        """
+        for expectation, deps in self._waiting.values():
+            if expectation.matches(actual_call):
+                return [dep.call for dep in deps]
+        return []
+
+class _Sampler(object):
+    """ picks the calls to validate. see CallQueue.enable_sampling(). """
+    def __init__(self, every, paths, seed):
+        self._every = every
+        self._paths = frozenset(paths)
+        self._seed = seed
+        start = 0
+        if every is not None and seed is not None:
+            start = random.Random(seed).randrange(every)
+        # next() on itertools.count is atomic, so concurrent calls never
+        # take the same position.
+        self._positions = itertools.count(start)
+
+    def __reduce__(self):
+        # copies start sampling over, from the same offset.
+        return (_Sampler, (self._every, self._paths, self._seed))
+
+    def validates(self, actual_call):
+        if actual_call[0] in self._paths:
+            return True
+        every = self._every
+        # the offset counts up to the next multiple of `every`.
+        return every is not None and next(self._positions) % every == 0
+
+class _Scheduler(object):
+    """
+        the controller behind CallQueue.enable_scheduling().
+
+        parked calls are [actual_call, granted, thread key] entries. at
+        most one entry is granted at a time, from the moment it's released until its pop
+        finishes, so every decision sees the queue as the previous call
+        left it.
+    """
+    def __init__(self, call_queue, threads, seed, settle, timeout):
+        self._call_queue = call_queue
+        self._unscheduled_pop = call_queue._pop
+        self._threads = threads
+        self._random = None if seed is None else random.Random(seed)
+        self._settle = settle
+        self._timeout = timeout
+        self._changed = threading.Condition(threading.Lock())
+        # parked entries, in arrival order.
+        self._parked = list()
+        self._granted = None
+        # when a call last arrived or finished. see _decide().
+        self._last_event = monotonic()
+
+    def pop(self, actual_call):
+        entry = [
+            actual_call, False, _thread_key(threading.current_thread().name)
+        ]
+        with self._changed:
+            self._parked.append(entry)
+            self._last_event = arrived = monotonic()
+            self._changed.notify_all()
+            while not entry[1]:
+                if self._call_queue._abort_error is not None:
+                    self._parked.remove(entry)
+                    raise self._call_queue._aborted(actual_call)
+                if self._granted is None:
+                    self._decide(arrived)
+                    if entry[1]:
+                        break
+                self._changed.wait(self._settle)
+        try:
+            if self._call_queue._abort_error is not None:
+                raise self._call_queue._aborted(actual_call)
+            return self._unscheduled_pop(actual_call)
+        finally:
+            with self._changed:
+                self._granted = None
+                self._last_event = monotonic()
+                self._changed.notify_all()
+
+    def wake(self):
+        """ wake all parked threads, eg: to see an abort. """
+        with self._changed:
+            self._changed.notify_all()
+
+    def _decide(self, waiter_arrived):
+        """
+            called by a parked thread, holding the lock, while nothing is
+            granted. grants an entry once the run has settled.
+        """
+        parked = self._parked
+        now = monotonic()
+        full = len(parked) >= self._threads
+        timed_out = (
+            self._timeout is not None
+            and now - waiter_arrived >= self._timeout
+        )
+        if not (full or timed_out or now - self._last_event >= self._settle):
+            return
+        accepting_index = self._call_queue._accepting_index
+        candidates = list()
+        for entry in parked:
+            index = accepting_index(entry[0])
+            if index is not None:
+                candidates.append((index, entry))
+        if candidates:
+            # arrival order is up to the OS, so it can't affect the choice:
+            # order by the expectation each call would consume, then by
+            # thread, so tied calls always go to the same threads.
+            candidates.sort(
+                key=lambda candidate: (candidate[0], candidate[1][2])
             )
+            if self._random is None:
+                _, chosen = candidates[0]
+            else:
+                _, chosen = self._random.choice(candidates)
+        elif full or timed_out:
+            # nothing can proceed: fail the longest-waiting call.
+            chosen = parked[0]
+        else:
+            return
+        parked.remove(chosen)
+        chosen[1] = True
+        self._granted = chosen
+        self._changed.notify_all()
+
+def _thread_key(name):
+    """
+        a sort key for thread names, numbers compared as numbers, so
+        threads named by a counter (eg: "Thread-9" and "Thread-10") sort in
+        creation order.
+    """
+    parts = re.split(r"(\d+)", name)
+    parts[1::2] = [int(part) for part in parts[1::2]]
+    return parts
+
+# frames running these are inside a qmock call. see _format_qmock_stacks().
+_QMOCK_CALL_CODES = frozenset((
+    CallQueue.__dict__["_pop"].__code__,
+    CallQueue.__dict__["_append"].__code__,
+    _Scheduler.__dict__["pop"].__code__
+))
+
+class _StubIndex(object):
+    """ the call -> result rules registered by CallQueue.stub(). """
+    def __init__(self):
+        self._indexed = dict()
+        self._unindexed = list()
+
+    def add(self, expectation):
+        key = _call_key(expectation.call)
+        if key is None:
+            self._unindexed.append(expectation)
+        else:
+            self._indexed[key] = expectation
+
+    def expectations(self):
+        return list(self._indexed.values()) + self._unindexed
+
+    def find(self, actual_call):
+        key = _call_key(actual_call)
+        if key is not None:
+            expectation = self._indexed.get(key)
+            if expectation is not None:
+                return expectation
+            candidates = self._unindexed
+        else:
+            # the actual call may still equal an indexed stub, eg: if one
+            # of its args is a float subclass equal to an indexed int.
+            candidates = list(self._indexed.values()) + self._unindexed
+        for expectation in candidates:
+            if expectation.matches(actual_call):
+                return expectation
+        return None
+
+# types whose hash and equality are consistent with each other and can't
+# be hooked by qmock. notably, hashing a QMock or _CallProxy would pop the
+# CallQueue, so only these types are ever hashed.
+_INDEXABLE_TYPES = frozenset(
+    (type(None), bool, int, float, complex, str, bytes)
+    + ((long, unicode) if sys.version_info[0] < 3 else ())
+)
+
+_tuple_eq = tuple.__eq__
+
+def _call_key(kall):
+    """
+        return a hashable key for a `call` whose arguments are all plain
+        values (see _INDEXABLE_TYPES), or None if it has any other args.
+        two calls with keys are equal iff their keys are equal.
+    """
+    name, args, kwargs = kall
+    if not _indexable(args):
+        return None
+    if not kwargs:
+        return (name, args)
+    if not _indexable(kwargs.values()):
+        return None
+    return (name, args, frozenset(kwargs.items()))
+
+def _indexable(values):
+    for value in values:
+        value_type = type(value)
+        if value_type is tuple:
+            if not _indexable(value):
+                return False
+        elif value_type not in _INDEXABLE_TYPES:
+            return False
+    return True
+
+class _NullCallList(mock._CallList):
+    """ an always-empty call list that drops everything appended to it. """
+    def append(self, _item):
+        pass
+
+    def extend(self, _items):
+        pass
+
+_NULL_CALL_LIST = _NullCallList()
+
+class _HistorylessMagicMock(mock.MagicMock):
+    """
+        MagicMock appends every call to call_args_list, mock_calls and
+        method_calls on each mock up the parent chain. qmock only needs
+        the final call passed to _MockCallsProxy.append(), so in a long
+        run that history is just an unbounded leak costing O(depth)
+        allocations per call. this MagicMock (and every child mock it
+        creates, which share its type) records nothing.
+    """
+    def __init__(self, *args, **kwargs):
+        super(_HistorylessMagicMock, self).__init__(*args, **kwargs)
+        self._null_call_history()
+
+    def reset_mock(self, *args, **kwargs):
+        super(_HistorylessMagicMock, self).reset_mock(*args, **kwargs)
+        self._null_call_history()
+
+    def _null_call_history(self):
+        attrs = self.__dict__
+        attrs["_mock_call_args_list"] = _NULL_CALL_LIST
+        attrs["_mock_mock_calls"] = _NULL_CALL_LIST
+        # method_calls isn't a delegating property like the other two.
+        attrs["method_calls"] = _NULL_CALL_LIST
 
 class _MockCallsProxy(object):
     def __init__(self, root_qmock):
@@ -593,7 +2947,8 @@ _CALLPROXY_INST_ATTRS = frozenset(
 )
 # __class__ is included to avoid unexpected results from isinstance().
 _CALLPROXY_CLASS_ATTRS = frozenset(
-    ("__class__", "__setattr__", "__call__", "__slots__", "__eq__")
+    ("__class__", "__setattr__", "__call__", "__slots__", "__eq__",
+     "__reduce_ex__", "__copy__", "__deepcopy__", "configure_mock")
 )
 
 class _CallProxy(object):
@@ -622,20 +2977,53 @@ class _CallProxy(object):
         if not isinstance(child_mock, mock.Base):
             # either already proxied or some not-mock thing
             return child_mock
-        proxy = _CallProxy(root_qmock=self._qmock, real_mock=child_mock)
-        # we want proxies to be persistent, just like mock.Mock instances,
-        # so identity tests work as expected, ie: (qm.foo is qm.foo) == True
-        setattr(self._real_mock, name, proxy)
-        # but mock wraps the proxy with a lambda when setting a magic
-        # method, so we need to re-fetch the thing we just set to ensure we
-        # always return the same object.
-        return getattr(self._real_mock, name)
+        # only the first access of each child gets here. the lock makes
+        # sure racing threads all end up with the same proxy.
+        with self._qmock._proxy_lock:
+            child_mock = getattr(self._real_mock, name)
+            if not isinstance(child_mock, mock.Base):
+                return child_mock
+            if name in _DEFAULT_SIDE_EFFECT_MAGICS:
+                # MagicMock gives these a default side_effect (eg: __iter__
+                # returns iter([])), which would replace the CallQueue
+                # result.
+                child_mock.side_effect = None
+            proxy = _CallProxy(root_qmock=self._qmock, real_mock=child_mock)
+            # we want proxies to be persistent, just like mock.Mock
+            # instances, so identity tests work as expected, ie:
+            # (qm.foo is qm.foo) == True
+            setattr(self._real_mock, name, proxy)
+            # but mock wraps the proxy with a lambda when setting a magic
+            # method, so we need to re-fetch the thing we just set to
+            # ensure we always return the same object.
+            return getattr(self._real_mock, name)
 
     def __setattr__(self, name, value):
         if name in self.__slots__:
             super(_CallProxy, self).__setattr__(name, value)
         else:
             setattr(self._real_mock, name, value)
+            self._qmock._mock_return_cache.clear()
+            _record_assignment(self._qmock, _node_path(self), name, value)
+
+    def __reduce_ex__(self, protocol):
+        """ see QMock.__reduce_ex__(). """
+        return (_qmock_node, (self._qmock, _node_path(self)))
+
+    def configure_mock(self, **kwargs):
+        """
+            mock.Mock.configure_mock(), but setting each attribute through
+            its _CallProxy, so the assignments are recorded like any other.
+        """
+        # set attributes before attributes of attributes, like mock.Mock.
+        for dotted, value in sorted(
+            kwargs.items(), key=lambda item: item[0].count(".")
+        ):
+            names = dotted.split(".")
+            node = self
+            for name in names[:-1]:
+                node = getattr(node, name)
+            setattr(node, names[-1], value)
 
     def __eq__(self, other):
         if isinstance(other, QMock):
@@ -661,17 +3049,229 @@ class _CallProxy(object):
             to _CallQueue._pop() to validate it against the current expected
             call and return/raise the corresponding result. if the result
             wasn't an exception, _qmock will then assign the result back to
-            _qmock._last_mock_result so it can be returned from here.
-
-            this isn't thread-safe, but neither is mock.Mock, so whatever.
+            _qmock._mock_results (a threading.local) so it can be returned
+            from here, in this thread.
         """
         _mock_self._real_mock(*args, **kwargs)
-        return _mock_self._qmock._last_mock_result
+        return _mock_self._qmock._mock_results.last
+
+_DEFAULT_SIDE_EFFECT_MAGICS = frozenset(
+    getattr(mock, "_side_effect_methods", ())
+)
+
+class _NativeProxy(object):
+    """
+        a node in the attribute tree of a QMock(engine="native").
+
+        instead of letting mock.Mock walk up a chain of parents to build
+        the call object, each node knows its own call path (eg:
+        "foo().bar") and builds `call` objects directly, passing them
+        straight to CallQueue._pop() and returning the result. so a call
+        costs one `call` object and one pop, no matter how deep the node
+        is.
+
+        child nodes (and assigned attributes) live in `_children`, and the
+        return_value node is created on first use, so identity is stable:
+        (qm.foo is qm.foo) == True. children are only ever added with the
+        atomic dict.setdefault(), so this holds across threads without
+        any locking, even on free-threaded builds.
+
+        magic methods are defined once on the class (see the loop below)
+        instead of per instance, since every node handles its own magic
+        calls the same way.
+    """
+    __slots__ = ("_qmock", "_path", "_self_arg", "_children")
+
+    def __init__(self, root_qmock, path, self_arg=None):
+        """
+            root_qmock: the QMock owning this tree.
+            path: this node's call name, relative to the root.
+            self_arg: the `self` argument of magic method calls. defaults
+                to this node. the root node uses the QMock itself.
+        """
+        object.__setattr__(self, "_qmock", root_qmock)
+        object.__setattr__(self, "_path", path)
+        object.__setattr__(
+            self, "_self_arg", self if self_arg is None else self_arg
+        )
+        # attribute name -> child node or assigned value. the
+        # return_value node is kept under "()", which can't clash with an
+        # attribute name.
+        object.__setattr__(self, "_children", dict())
+
+    def __getattr__(self, name):
+        # only called when normal lookup fails, ie: not for slots, methods
+        # or magic methods.
+        children = self._children
+        try:
+            return children[name]
+        except KeyError:
+            pass
+        if name.startswith("__") and name.endswith("__"):
+            # unsupported magic, eg: copy probing for __deepcopy__.
+            raise AttributeError(name)
+        path = self._path
+        child = _NativeProxy(
+            self._qmock,
+            path + "." + name if path else name
+        )
+        return children.setdefault(name, child)
+
+    def __setattr__(self, name, value):
+        if name in _NativeProxy.__slots__:
+            object.__setattr__(self, name, value)
+            return
+        _record_assignment(self._qmock, self._path, name, value)
+        if name == "return_value":
+            self._qmock._mock_return_cache.clear()
+            self._children["()"] = value
+            return
+        self._qmock._mock_return_cache.clear()
+        if isinstance(value, mock.Base):
+            # attach assigned mocks, like mock.Mock does, so calling them
+            # still goes through the CallQueue, and wrap them like the mock
+            # engine does, so those calls return the popped result.
+            path = self._path
+            mock._check_and_set_parent(
+                self._qmock, value, None, path + "." + name if path else name
+            )
+            value = _CallProxy(root_qmock=self._qmock, real_mock=value)
+        self._children[name] = value
+
+    def __delattr__(self, name):
+        self._qmock._mock_return_cache.clear()
+        try:
+            del self._children[name]
+        except KeyError:
+            raise AttributeError(name)
+        self._qmock._mock_assigned.pop((self._path, name), None)
+
+    def __reduce_ex__(self, protocol):
+        """ see QMock.__reduce_ex__(). """
+        return (_qmock_node, (self._qmock, self._path))
+
+    @property
+    def return_value(self):
+        children = self._children
+        try:
+            return children["()"]
+        except KeyError:
+            return children.setdefault(
+                "()", _NativeProxy(self._qmock, self._path + "()")
+            )
+
+    def __call__(_mock_self, *args, **kwargs):
+        """ use "_mock_self" to allow "self" in kwargs. """
+        return _mock_self._qmock.call_queue._pop(
+            mock._Call((_mock_self._path, args, kwargs))
+        )
+
+    def _call_magic(self, name, args, kwargs):
+        path = self._path
+        return self._qmock.call_queue._pop(mock._Call((
+            path + "." + name if path else name,
+            (self._self_arg,) + args,
+            kwargs
+        )))
+
+    def __eq__(self, other):
+        if isinstance(other, QMock):
+            other = other._mock_call_proxy
+        return self is other
+
+    def __repr__(self):
+        return "<QMock node {0!r} id='{1}'>".format(self._path, id(self))
+
+_PROXY_TYPES = (_CallProxy, _NativeProxy)
+
+def _record_assignment(root_qmock, path, name, value):
+    """ see QMock._mock_assigned. """
+    assigned = root_qmock._mock_assigned
+    # re-assigning moves the attribute to the end, so replaying the
+    # assignments in order always ends with the latest values.
+    assigned.pop((path, name), None)
+    assigned[(path, name)] = value
+
+def _undo_assignment(root_qmock, path, name):
+    """
+        see QMock.mock_reset(). returns the node's mock.Mock, if it has
+        one, which still needs a reset_mock().
+    """
+    node = _qmock_node(root_qmock, path)
+    if isinstance(node, _NativeProxy):
+        node._children.pop("()" if name == "return_value" else name, None)
+    elif isinstance(node, _CallProxy):
+        real_mock = node._real_mock
+        if name == "return_value":
+            # mock.Mock builds a new child mock on the next access.
+            real_mock.return_value = mock.DEFAULT
+            return real_mock
+        # not delattr(), which makes mock.Mock raise AttributeError on the
+        # next access instead of building a new child mock.
+        real_mock.__dict__.pop(name, None)
+        real_mock._mock_children.pop(name, None)
+        if name in mock._all_magics:
+            # assigned magics live on the mock's own class. put back the
+            # MagicProxy that MagicMock starts with, if it has one.
+            if name in mock._magics:
+                setattr(type(real_mock), name, mock.MagicProxy(name, real_mock))
+            elif name in type(real_mock).__dict__:
+                delattr(type(real_mock), name)
+        return real_mock
+    return None
+
+def _restore_node(parent, name, node):
+    """ put a replaced child node back, see QMock.mock_reset(). """
+    if isinstance(parent, _NativeProxy):
+        parent._children[name] = node
+    else:
+        real_mock = parent._real_mock
+        # like _CallProxy.__getattr__() leaves it.
+        real_mock._mock_children[name] = node._real_mock
+        real_mock.__dict__[name] = node
+
+def _node_path(call_proxy):
+    """ the call path of a _CallProxy's node, eg: "foo().bar". """
+    names = list()
+    real_mock = call_proxy._real_mock
+    while isinstance(real_mock, mock.Base):
+        names.append(real_mock._mock_new_name)
+        real_mock = real_mock._mock_new_parent
+    path = ""
+    for name in reversed(names):
+        if name == "()":
+            path += name
+        elif name:
+            path = path + "." + name if path else name
+    return path
+
+# one step of a call path: a return value or an attribute name.
+_PATH_STEP = re.compile(r"\(\)|[^.()]+")
+
+def _qmock_node(root_qmock, path):
+    """ the node at `path` in root_qmock's tree. unpickles nodes. """
+    node = root_qmock._mock_call_proxy
+    for step in _PATH_STEP.findall(path):
+        if step == "()":
+            node = node.return_value
+        else:
+            node = getattr(node, step)
+    return node
+
+def _new_native_magic(name):
+    def magic(self, *args, **kwargs):
+        return self._call_magic(name, args, kwargs)
+    magic.__name__ = name
+    return magic
 
 _BANNED_MAGIC_METHODS = frozenset(
     ("__eq__",)
 )
 
+for _name in mock._magics - _BANNED_MAGIC_METHODS:
+    setattr(_NativeProxy, _name, _new_native_magic(_name))
+del _name
+
 def _new_clone_with_magic_methods(cls):
     """
         for each QMock and _CallProxy, we need to clone the class and
@@ -1,9 +1,31 @@
 from collections import OrderedDict
+import copy
+import gc
+import os
+import pickle
+import platform
+import shutil
 import signal
 import sys
-from threading import Thread
+import sysconfig
+import tempfile
+import textwrap
+from threading import current_thread, Event, Thread, Timer
+import time
 import unittest
 
+try:
+    import contextvars
+except ImportError:
+    # python <3.7
+    contextvars = None
+
+try:
+    import tracemalloc
+except ImportError:
+    # python 2.7
+    tracemalloc = None
+
 import qmock
 from qmock._python_compat import get_thread_id, mock
 
@@ -15,6 +37,12 @@ XML_ETREE_ELEMENTTREE = "xml.etree.ElementTree"
 
 PY2 = sys.version_info[0] < 3
 
+def fetch_all(qm):
+    """ runs in a worker process. see test_pickle_to_worker_process. """
+    result = qm.fetch("a") + qm.fetch("b")
+    qm.call_queue.assert_empty()
+    return result
+
 class QMockErrorsInThreadsTests(unittest.TestCase):
     def test_str(self):
         error = qmock.QMockErrorsInThreads(
@@ -432,6 +460,107 @@ class patchTests(unittest.TestCase):
         f.test_baz()
 
 
+    def test_pooled_class_decorator(self):
+        qmocks = list()
+
+        @qmock.patch(dt=DATETIME_DATE, pooled=True, fail_fast=True)
+        class Foo(object):
+            def test_leaves_state(foo_self, qm):
+                qmocks.append(qm)
+                self.assertTrue(qm.call_queue._fail_fast)
+                qm.call_queue.enable_history()
+                qm.dt.return_value = 5
+                qm.call_queue.push(qmock.call.dt(1, 2, 3), 7)
+                self.assertEqual(datetime.date(1, 2, 3), 7)
+                raise ValueError("exit early")
+
+            def test_starts_clean(foo_self, qm):
+                qmocks.append(qm)
+                self.assertTrue(qm.call_queue._fail_fast)
+                self.assertIsNone(qm.call_queue._history)
+                self.assertIsNot(qm.dt.return_value, 5)
+                qm.call_queue.push(qmock.call.dt(1, 2, 3), 8)
+                self.assertEqual(datetime.date(1, 2, 3), 8)
+
+            @qmock.patch()
+            def test_own_qmock(foo_self, qm):
+                qmocks.append(qm)
+
+        f = Foo()
+        with self.assertRaises(ValueError):
+            f.test_leaves_state()
+        self._assert_no_patches()
+        f.test_starts_clean()
+        f.test_own_qmock()
+        self._assert_no_patches()
+
+        self.assertIs(qmocks[0], qmocks[1])
+        self.assertIsNot(qmocks[0], qmocks[2])
+
+    def test_pooled_tests_start_unconfigured(self):
+        @qmock.patch(dt=DATETIME_DATE, pooled=True)
+        class Foo(object):
+            def test_configures(foo_self, qm):
+                qm.dt.__len__ = lambda dt_self: 3
+                qm.dt.side_effect = ValueError
+                qm.configure_mock(**{"dt.level": 5, "dt.today.return_value": 6})
+                self.assertEqual(len(datetime.date), 3)
+
+            def test_starts_clean(foo_self, qm):
+                qm.call_queue.push(qmock.call.dt.__getattr__("__len__")(qm.dt), 4)
+                qm.call_queue.push(qmock.call.dt(1, 2, 3), 7)
+                qm.call_queue.push(qmock.call.dt.today(), 8)
+                self.assertEqual(len(datetime.date), 4)
+                self.assertEqual(datetime.date(1, 2, 3), 7)
+                self.assertEqual(datetime.date.today(), 8)
+                self.assertIsNot(qm.dt.level, 5)
+
+        f = Foo()
+        f.test_configures()
+        f.test_starts_clean()
+        self._assert_no_patches()
+
+    def test_pooled_tests_keep_patched_nodes(self):
+        nodes = list()
+
+        @qmock.patch(dt=DATETIME_DATE, pooled=True)
+        class Foo(object):
+            def test_replaces(foo_self, qm):
+                nodes.append(qm.dt)
+                qm.dt.today.return_value = 5
+                qm.dt = lambda *args: "replaced"
+                self.assertIsNot(qm.dt, datetime.date)
+
+            def test_starts_clean(foo_self, qm):
+                self.assertIs(qm.dt, nodes[0])
+                self.assertIs(datetime.date, qm.dt)
+                self.assertIsNot(qm.dt.today.return_value, 5)
+                qm.call_queue.push(qmock.call.dt(1, 2, 3), 7)
+                self.assertEqual(datetime.date(1, 2, 3), 7)
+
+        f = Foo()
+        f.test_replaces()
+        f.test_starts_clean()
+        self._assert_no_patches()
+
+    def test_pooled_function_decorator(self):
+        @qmock.patch(dt=DATETIME_DATE, pooled=True)
+        def foo(leave_expectation, qm):
+            qm.call_queue.push(qmock.call.dt(1, 2, 3), 7)
+            if leave_expectation:
+                raise ValueError("exit early")
+            self.assertEqual(datetime.date(1, 2, 3), 7)
+
+        with self.assertRaises(ValueError):
+            foo(True)
+        foo(False)
+        self._assert_no_patches()
+
+    def test_pooled_context_manager(self):
+        with self.assertRaises(ValueError):
+            with qmock.patch(pooled=True):
+                pass
+
     def test_mixed_decorator_patches(self):
         @qmock.patch(dt=DATETIME_DATE, json=JSON_LOADS)
         class Foo(object):
@@ -674,6 +803,208 @@ class patchTests(unittest.TestCase):
         self._assert_no_patches()
         foo()
 
+    #
+    # context_local
+    #
+
+    def test_context_local_function_decorator_succeeds(self):
+        @qmock.patch(dt=DATETIME_DATE, json=JSON_LOADS, context_local=True)
+        def foo(qm):
+            qm.call_queue.push(qmock.call.dt(1, 2, 3), "a")
+            qm.call_queue.push(qmock.call.json("[1,2,3]"), "b")
+            self.assertEqual(datetime.date(1, 2, 3), "a")
+            self.assertEqual(json.loads("[1,2,3]"), "b")
+        self._assert_no_patches()
+
+        foo()
+
+    def test_context_local_context_manager_succeeds(self):
+        with qmock.patch(et=XML_ETREE_ELEMENTTREE, context_local=True) as qm:
+            qm.call_queue.push(qmock.call.et.fromstring("<foo />"), "a")
+            qm.call_queue.push(
+                qmock.call.et.__getattr__("__len__")(qm.et), 3
+            )
+            self.assertEqual(xml.etree.ElementTree.fromstring("<foo />"), "a")
+            self.assertEqual(len(xml.etree.ElementTree), 3)
+
+    def test_context_local_context_manager_raises_on_exit_if_queue_not_empty(self):
+        with self.assertRaises(qmock.CallQueueNotEmpty):
+            with qmock.patch(dt=DATETIME_DATE, context_local=True) as qm:
+                qm.call_queue.push(qmock.call.dt(1, 2, 3), "a")
+
+    def test_context_manager_exits_in_another_thread(self):
+        for context_local in (False, True):
+            patcher = qmock.patch(dt=DATETIME_DATE, context_local=context_local)
+            qm = patcher.__enter__()
+            qm.call_queue.push(qmock.call.dt(1, 2, 3), "a")
+            errors = list()
+
+            def exit_with_error():
+                try:
+                    raise KeyError("test")
+                except KeyError:
+                    patcher.__exit__(*sys.exc_info())
+                    errors.append(sys.exc_info()[1])
+            thread = Thread(target=exit_with_error)
+            thread.start()
+            thread.join()
+
+            self.assertEqual([type(error) for error in errors], [KeyError])
+            self._assert_no_patches()
+            self.assertEqual(qmock._qmock._open_scopes, [])
+            self.assertEqual(qmock._qmock._dispatchers, {})
+
+    @unittest.skipIf(contextvars is None, "contextvars requires python 3.7+")
+    def test_context_manager_exits_in_copied_context(self):
+        for context_local in (False, True):
+            patcher = qmock.patch(dt=DATETIME_DATE, context_local=context_local)
+            context = contextvars.copy_context()
+            with patcher as qm:
+                qm.call_queue.push(qmock.call.dt(1, 2, 3), "a")
+                with self.assertRaises(qmock.CallQueueNotEmpty):
+                    context.run(patcher.__exit__, None, None, None)
+                self._assert_no_patches()
+            self._assert_no_patches()
+            self.assertEqual(qmock._qmock._open_scopes, [])
+            # routes exited elsewhere are emptied, and dropped on the next
+            # exit in this context.
+            open_routes = [
+                route
+                for routes in qmock._qmock._context_routes.get().values()
+                for route in routes
+                if route
+            ]
+            self.assertEqual(open_routes, [])
+
+    def test_context_local_cleans_up_on_bad_patch(self):
+        @qmock.patch(
+            dt=DATETIME_DATE, bad="datetime.BAD", context_local=True
+        )
+        def foo(qm):
+            self.fail("This test function should not run.")
+        self._assert_no_patches()
+
+        self.assertRaises(AttributeError, foo)
+        self.assertEqual(qmock._qmock._dispatchers, {})
+
+    def test_context_local_stacked_decorators(self):
+        @qmock.patch(dt=DATETIME_DATE, context_local=True)
+        @qmock.patch(json=JSON_LOADS, context_local=True)
+        def foo(qm):
+            qm.call_queue.push(qmock.call.dt(1, 2, 3), "a")
+            qm.call_queue.push(qmock.call.json("[1,2,3]"), "b")
+            self.assertEqual(datetime.date(1, 2, 3), "a")
+            self.assertEqual(json.loads("[1,2,3]"), "b")
+        self._assert_no_patches()
+        foo()
+
+    def test_context_local_patches_are_per_thread(self):
+        results = dict()
+        def new_test(n):
+            @qmock.patch(json=JSON_LOADS, context_local=True)
+            def test(qm):
+                qm.call_queue.push(qmock.call.json("[1,2,3]"), n)
+                started.wait()
+                results[n] = json.loads("[1,2,3]")
+            return test
+
+        started = Event()
+        threads = [Thread(target=new_test(n)) for n in range(4)]
+        for thread in threads:
+            thread.start()
+        with qmock.patch(json=JSON_LOADS, context_local=True) as qm:
+            qm.call_queue.push(qmock.call.json("[1,2,3]"), "main")
+            started.set()
+            self.assertEqual(json.loads("[1,2,3]"), "main")
+            for thread in threads:
+                thread.join()
+
+        self.assertEqual(results, {0: 0, 1: 1, 2: 2, 3: 3})
+        self.assertEqual(qmock._qmock._dispatchers, {})
+
+    def test_context_local_unpatched_threads_see_original(self):
+        results = list()
+        with qmock.patch(json=JSON_LOADS, context_local=True) as qm:
+            thread = Thread(
+                target=lambda: results.append(json.loads("[1,2,3]"))
+            )
+            thread.start()
+            thread.join()
+        self.assertEqual(results, [[1, 2, 3]])
+
+    def test_fail_fast_context_manager_aborts_on_errors_in_threads(self):
+        with self.assertRaises(qmock.QMockErrorsInThreads) as assertion:
+            with qmock.patch(dt=DATETIME_DATE, fail_fast=True) as qm:
+                qm.call_queue.push(qmock.call.dt(1, 2, 3), "a")
+                self._force_unexpected_call_in_thread(qm)
+                # aborted, even though it matches the queue
+                datetime.date(1, 2, 3)
+                self.fail("The mocked call should have raised.")
+
+        self._assert_thread_qmock_errors(assertion.exception)
+        self._assert_patched_func_error(
+            assertion.exception, qmock.UnexpectedCall
+        )
+
+    #
+    # timeout
+    #
+
+    def test_timeout_function_decorator_aborts_blocked_call(self):
+        @qmock.patch(json=JSON_LOADS, timeout=0.1)
+        def foo(qm):
+            qm.call_queue.enable_blocking() # waits forever
+            qm.call_queue.enable_history()
+            qm.call_queue.push(qmock.call.json("[1,2,3]"), "a")
+            self.assertEqual(json.loads("[1,2,3]"), "a")
+            json.loads("[4,5,6]")
+        self._assert_no_patches()
+
+        with self.assertRaises(qmock.PatchTimeout) as assertion:
+            foo()
+        lines = str(assertion.exception).split("\n")
+        self.assertEqual(lines[0], "qmock.patch() scope timed out after 0.1s.")
+        self.assertEqual(
+            lines[1], "queue position: 0 expected calls remaining."
+        )
+        self.assertTrue(lines[2].startswith(
+            "last consumed call: call.json('[1,2,3]') -> 'a' (thread "
+        ))
+        self.assertTrue(lines[3].endswith(" inside a mocked call:"))
+        self.assertIn("json.loads(\"[4,5,6]\")", str(assertion.exception))
+
+    def test_timeout_context_manager_interrupts_scope(self):
+        with self.assertRaises(qmock.PatchTimeout) as assertion:
+            with qmock.patch(dt=DATETIME_DATE, timeout=0.1) as qm:
+                qm.call_queue.push(qmock.call.dt(1, 2, 3), "a")
+                while True:
+                    time.sleep(0.01)
+        message = str(assertion.exception)
+        self.assertIn("queue position: 1 expected calls remaining.", message)
+        self.assertIn("    call.dt(1, 2, 3)", message)
+        self.assertIn("no threads inside mocked calls.", message)
+
+    def test_timeout_not_reached(self):
+        @qmock.patch(dt=DATETIME_DATE, timeout=5)
+        def foo(qm):
+            qm.call_queue.push(qmock.call.dt(1, 2, 3), "a")
+            self.assertEqual(datetime.date(1, 2, 3), "a")
+        foo()
+        # the usual final checks still apply.
+        with self.assertRaises(qmock.CallQueueNotEmpty):
+            with qmock.patch(timeout=5) as qm:
+                qm.call_queue.push(qmock.call.foo(), None)
+
+    def test_context_manager_is_reentrant(self):
+        patch = qmock.patch(dt=DATETIME_DATE)
+        with patch as outer_qm:
+            with patch as inner_qm:
+                self.assertIsNot(inner_qm, outer_qm)
+                inner_qm.call_queue.push(qmock.call.dt(1, 2, 3), "inner")
+                self.assertEqual(datetime.date(1, 2, 3), "inner")
+            outer_qm.call_queue.push(qmock.call.dt(1, 2, 3), "outer")
+            self.assertEqual(datetime.date(1, 2, 3), "outer")
+
 class QMockTests(unittest.TestCase):
     def test_root_assigned_attributes(self):
         qm = qmock.QMock()
@@ -824,6 +1155,29 @@ class QMockTests(unittest.TestCase):
 
         qm.call_queue.assert_empty()
 
+    @unittest.skipIf(PY2, "tracemalloc doesn't exist in python 2.7")
+    def test_call_history_is_not_recorded(self):
+        import tracemalloc
+        qm = qmock.QMock()
+        qm.call_queue.stub(qmock.call.foo.bar(1), None)
+        bar = qm.foo.bar
+
+        for _ in range(1000): # warm up
+            bar(1)
+        tracemalloc.start()
+        try:
+            before = tracemalloc.get_traced_memory()[0]
+            for _ in range(5000):
+                bar(1)
+            after = tracemalloc.get_traced_memory()[0]
+        finally:
+            tracemalloc.stop()
+
+        self.assertLess(after - before, 10000) # bytes, not bytes per call
+        self.assertEqual(len(qm.foo.mock_calls), 0)
+        self.assertEqual(len(qm.foo.method_calls), 0)
+        self.assertEqual(len(qm.foo.bar.call_args_list), 0)
+
     def test_mock_calls_returns_proxy(self):
         qm = qmock.QMock()
 
@@ -908,6 +1262,146 @@ class QMockTests(unittest.TestCase):
             qm.return_value.foo.return_value.bar.return_value.baz.barf.return_value
         )
 
+    def _assert_copies(self, engine):
+        qm = qmock.QMock(engine=engine)
+        cq = qm.call_queue
+        cq.enable_history()
+        qm.config.level = 3
+        qm.connect.return_value = qm.session
+        cq.stub(qmock.call.ping(), "pong")
+        cq.push_all(qmock.call.session.query(1).all(), [1, 2])
+        with cq.unordered():
+            first = cq.push(qmock.call.a(), 1)
+            cq.push(qmock.call.b(), 2, after=(first,))
+        cq.push(qmock.call.save(qmock.Subset({"id": 1})), qm.saved)
+        cq.push(qmock.call.rows(), qmock.Stream([1, 2]))
+        self.assertEqual(qm.ping(), "pong")
+
+        copies = [
+            pickle.loads(pickle.dumps(qm, protocol))
+            for protocol in range(pickle.HIGHEST_PROTOCOL + 1)
+        ]
+        copies.append(copy.deepcopy(qm))
+        for qm_copy in copies:
+            self.assertIsNot(qm_copy, qm)
+            self.assertEqual(qm_copy.config.level, 3)
+            self.assertIs(qm_copy.connect.return_value, qm_copy.session)
+            self.assertEqual(qm_copy.session.query(1).all(), [1, 2])
+            with self.assertRaises(qmock.UnexpectedCall):
+                qm_copy.b() # waiting for a()
+            self.assertEqual(qm_copy.a(), 1)
+            self.assertEqual(qm_copy.b(), 2)
+            self.assertIs(qm_copy.save({"id": 1, "x": 2}), qm_copy.saved)
+            self.assertEqual([qm_copy.rows(), qm_copy.rows()], [1, 2])
+            with self.assertRaises(StopIteration):
+                qm_copy.rows()
+            self.assertEqual(qm_copy.ping(), "pong")
+            qm_copy.call_queue.assert_empty()
+            self.assertEqual(
+                [record.call for record in qm_copy.call_queue.history()][:3],
+                [
+                    qmock.call.ping(),
+                    qmock.call.session.query(1),
+                    qmock.call.session.query().all()
+                ]
+            )
+
+        # the original is untouched.
+        self.assertEqual(len(cq._queue), 5)
+        self.assertEqual(len(cq.history()), 1)
+
+    def test_pickle_and_deepcopy(self):
+        self._assert_copies("mock")
+
+    def test_pickle_and_deepcopy_native(self):
+        self._assert_copies("native")
+
+    def test_mock_reset(self):
+        for engine in ("mock", "native"):
+            qm = qmock.QMock(engine=engine)
+            cq = qm.call_queue
+            foo = qm.foo
+            bar = qm.foo.bar
+            qm.config.level = 3
+            qm.connect.return_value = qm.session
+            foo.return_value = 5
+            cq.push(qmock.call.foo.bar(), 1)
+            cq.stub(qmock.call.ping(), "pong")
+            cq.enable_fail_fast()
+            with self.assertRaises(qmock.UnexpectedCall):
+                qm.nope()
+
+            qm.mock_reset()
+            self.assertIs(qm.call_queue, cq)
+            self.assertEqual(cq.pop_errors, [])
+            cq.assert_empty()
+            self.assertIs(qm.foo, foo)
+            self.assertIs(qm.foo.bar, bar)
+            self.assertIsNot(qm.config.level, 3)
+            self.assertIsNot(qm.connect.return_value, qm.session)
+            self.assertIsNot(qm.foo.return_value, 5)
+            with self.assertRaises(qmock.UnexpectedCall):
+                qm.ping()
+            cq.push(qmock.call.foo.bar(), 2)
+            self.assertEqual(bar(), 2)
+
+    def test_pickle_attached_script(self):
+        source = qmock.QMock()
+        source.call_queue.push_all(qmock.call.foo().bar(), 1)
+        source.call_queue.push(qmock.call.baz(), 2)
+        qm = qmock.QMock()
+        qm.call_queue.attach(source.call_queue.freeze())
+        foo = qm.foo()
+
+        for protocol in range(pickle.HIGHEST_PROTOCOL + 1):
+            qm_copy = pickle.loads(pickle.dumps(qm, protocol))
+            self.assertEqual(qm_copy.foo.return_value.bar(), 1)
+            self.assertEqual(qm_copy.baz(), 2)
+            qm_copy.call_queue.assert_empty()
+        self.assertEqual(foo.bar(), 1)
+
+    def test_pickle_node(self):
+        for engine in ("mock", "native"):
+            qm = qmock.QMock(engine=engine)
+            qm.call_queue.push(qmock.call.get(), qm.foo.bar)
+            qm.foo.bar.self = qm.foo.bar
+
+            for node in (pickle.loads(pickle.dumps(qm.foo.bar)),
+                         copy.deepcopy(qm.foo.bar)):
+                self.assertIsNot(node, qm.foo.bar)
+                self.assertIs(node.self, node)
+                self.assertIs(node._qmock.get(), node)
+
+    @unittest.skipIf(PY2, "concurrent.futures doesn't exist in python 2.7")
+    def test_pickle_to_worker_process(self):
+        from concurrent.futures import ProcessPoolExecutor
+        qm = qmock.QMock()
+        qm.call_queue.push(qmock.call.fetch("a"), "A")
+        qm.call_queue.push(qmock.call.fetch("b"), "B")
+
+        with ProcessPoolExecutor(1) as pool:
+            self.assertEqual(pool.submit(fetch_all, qm).result(), "AB")
+        self.assertEqual(len(qm.call_queue._queue), 2)
+
+    def test_mock_return_cache(self):
+        for engine in ("mock", "native"):
+            qm = qmock.QMock(engine=engine)
+            kall = qmock.call.foo(1).bar.baz(2)
+            baz_return = qm.mock_return(kall)
+
+            self.assertIs(
+                qm._mock_return_cache["foo().bar.baz()"], baz_return
+            )
+            self.assertIs(
+                qm._mock_return_cache["foo().bar"], qm.foo.return_value.bar
+            )
+            self.assertIs(qm.mock_return(qmock.call.foo(3).bar.baz()), baz_return)
+
+            qm.foo.return_value.bar = 5 # invalidates
+            self.assertEqual(qm._mock_return_cache, {})
+            self.assertIs(qm.mock_return(qmock.call.foo().bar), 5)
+            self.assertRaises(AttributeError, qm.mock_return, kall)
+
     def test_mock_return_null_call(self):
         qm = qmock.QMock()
 
@@ -917,6 +1411,156 @@ class QMockTests(unittest.TestCase):
             qmock.call
         )
 
+class ThreadSafetyTests(unittest.TestCase):
+    def _assert_results_stay_in_thread(self, engine):
+        qm = qmock.QMock(engine=engine)
+        qm.call_queue.stub(
+            qmock.call.echo(qmock.InstanceOf(int)),
+            factory=lambda value: value
+        )
+        wrong = []
+        def work(value):
+            for _ in range(2000):
+                result = qm.echo(value)
+                if result != value:
+                    wrong.append((value, result))
+
+        threads = [Thread(target=work, args=(i,)) for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(wrong, [])
+        self.assertEqual(len(qm.call_queue.pop_errors), 0)
+
+    def test_results_stay_in_thread(self):
+        self._assert_results_stay_in_thread("mock")
+
+    def test_native_results_stay_in_thread(self):
+        self._assert_results_stay_in_thread("native")
+
+    def test_concurrent_pops_consume_each_expectation_once(self):
+        qm = qmock.QMock(engine="native")
+        for i in range(4000):
+            qm.call_queue.push(qmock.call.foo(), i)
+        results = []
+        def work():
+            for _ in range(1000):
+                results.append(qm.foo())
+
+        threads = [Thread(target=work) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(sorted(results), list(range(4000)))
+        qm.call_queue.assert_empty()
+
+    def test_concurrent_child_creation(self):
+        for engine in ("mock", "native"):
+            qm = qmock.QMock(engine=engine)
+            children = []
+            def work():
+                children.append(qm.foo.bar.return_value)
+
+            threads = [Thread(target=work) for _ in range(8)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+            self.assertEqual(len(set(id(child) for child in children)), 1)
+
+class NativeEngineTests(unittest.TestCase):
+    def test_unknown_engine(self):
+        self.assertRaises(ValueError, qmock.QMock, engine="nope")
+
+    def test_generated_attributes(self):
+        qm = qmock.QMock(engine="native")
+
+        self.assertIs(qm.foo, qm.foo)
+        self.assertIs(qm.foo.bar, qm.foo.bar)
+        self.assertIsNot(qm.foo.bar, qm.baz.bar)
+        self.assertIs(qm.foo.return_value, qm.foo.return_value)
+        with self.assertRaises(qmock.UnexpectedCall):
+            qm.foo.bar() # empty CallQueue
+
+        qm.call_queue.push(qmock.call.foo.bar(1, x=2), 5)
+        qm.call_queue.push(qmock.call(), 6)
+        qm.call_queue.push(qmock.call().foo(), 7)
+
+        self.assertIs(qm.foo.bar(1, x=2), 5)
+        self.assertIs(qm(), 6)
+        self.assertIs(qm.return_value.foo(), 7)
+        qm.call_queue.assert_empty()
+
+    def test_assigned_attributes(self):
+        qm = qmock.QMock(engine="native")
+        qm.foo.bar = 5
+        qm.baz.return_value = 6
+        m = mock.Mock()
+        qm.mocked = m
+
+        self.assertIs(qm.foo.bar, 5)
+        self.assertIs(qm.mock_return(qmock.call.baz()), 6)
+        with self.assertRaises(qmock.UnexpectedCall):
+            m() # attached
+        qm.call_queue.push(qmock.call.mocked(1), "a")
+        qm.call_queue.push(qmock.call.mocked.bar(2), "b")
+        self.assertEqual(qm.mocked(1), "a")
+        self.assertEqual(qm.mocked.bar(2), "b")
+        self.assertTrue(qm.mocked == m)
+        qm.call_queue.assert_empty()
+
+        del qm.foo.bar
+        self.assertIsNot(qm.foo.bar, 5)
+
+    def test_mock_return_and_push_all(self):
+        qm = qmock.QMock(engine="native")
+        kall = qmock.call(x=1).foo(y=2).bar(5).baz.barf(z={6: 7}, w=8)
+
+        self.assertIs(
+            qm.mock_return(kall),
+            qm.return_value.foo.return_value.bar.return_value.baz.barf
+                .return_value
+        )
+        qm.call_queue.push_all(kall, 9)
+        self.assertIs(qm(x=1).foo(y=2).bar(5).baz.barf(z={6: 7}, w=8), 9)
+        qm.call_queue.assert_empty()
+
+    def test_magic_methods(self):
+        qm = qmock.QMock(engine="native")
+        cq = qm.call_queue
+        cq.push(qmock.call.__getattr__("__str__")(qm), "test")
+        cq.push(qmock.call.foo.__getattr__("__lt__")(qm.foo, 5), "lt")
+        cq.push(qmock.call.__getattr__("__enter__")(qm), qm.foo)
+        cq.push(qmock.call.foo(), 7357)
+        cq.push(qmock.call.__getattr__("__exit__")(qm, None, None, None), None)
+        cq.push(
+            qmock.call.rows.__getattr__("__iter__")(qm.rows),
+            qmock.Stream([1, 2])
+        )
+
+        self.assertEqual(str(qm), "test")
+        self.assertEqual(qm.foo < 5, "lt")
+        with qm as foo:
+            self.assertEqual(foo(), 7357)
+        self.assertEqual([row for row in qm.rows], [1, 2])
+        with self.assertRaises(qmock.UnexpectedCall):
+            len(qm.foo)
+        cq.assert_empty()
+
+    def test_eq(self):
+        alpha = qmock.QMock(engine="native")
+        bravo = qmock.QMock(engine="native")
+
+        self.assertTrue(alpha == alpha)
+        self.assertFalse(alpha == bravo)
+        self.assertTrue(alpha.foo == alpha.foo)
+        self.assertFalse(alpha.foo == alpha.bar)
+
 class CallQueueTests(unittest.TestCase):
     def test_push_attribute_call(self):
         qm = qmock.QMock()
@@ -941,11 +1585,11 @@ class CallQueueTests(unittest.TestCase):
 
         self.assertEqual(
             tuple(
-                (expected_call, self._copy_mock_side_effect(mock_result))
-                for expected_call, mock_result in cq._queue
+                (expectation.call, expectation.result)
+                for expectation in cq._queue
             ),
             (
-                (qmock.call.foo(), ("bar",)),
+                (qmock.call.foo(), "bar"),
             )
         )
 
@@ -975,25 +1619,25 @@ class CallQueueTests(unittest.TestCase):
 
         self.assertEqual(
             tuple(
-                (expected_call, self._copy_mock_side_effect(mock_result))
-                for expected_call, mock_result in cq._queue
+                (expectation.call, expectation.result)
+                for expectation in cq._queue
             ),
             (
                 (
                     qmock.call(x=1),
-                    (qm.return_value,)
+                    qm.return_value
                 ),
                 (
                     qmock.call(x=1).foo(y=2),
-                    (qm.return_value.foo.return_value,)
+                    qm.return_value.foo.return_value
                 ),
                 (
                     qmock.call(x=1).foo(y=2).bar(5),
-                    (qm.return_value.foo.return_value.bar.return_value,)
+                    qm.return_value.foo.return_value.bar.return_value
                 ),
                 (
                     qmock.call(x=1).foo(y=2).bar(5).baz.barf(z={6: 7}, w=8),
-                    (10,)
+                    10
                 )
             )
         )
@@ -1072,12 +1716,1474 @@ class CallQueueTests(unittest.TestCase):
         cq.assert_empty()
         self.assertEqual(len(cq.pop_errors), 0)
 
-    def _copy_mock_side_effect(self, m):
-        """
-            mock.Mock.side_effect is stored as a <tupleiterator>,
-            so iterating consumes it. so we'll consume it, store a copy,
-            re-populate it, and return the copy
-        """
-        side_effect = tuple(m.side_effect)
-        m.side_effect = side_effect
-        return side_effect
+    def test_blocking_pop_waits_for_push(self):
+        qm = qmock.QMock()
+        cq = qm.call_queue
+        cq.enable_blocking(timeout=5)
+
+        feeder = Timer(0.01, cq.push, (qmock.call.foo(), 7357))
+        feeder.start()
+        self.assertEqual(qm.foo(), 7357)
+        feeder.join()
+
+        cq.assert_empty()
+        self.assertEqual(len(cq.pop_errors), 0)
+
+    def test_blocking_pop_raises_after_timeout(self):
+        qm = qmock.QMock()
+        cq = qm.call_queue
+        cq.enable_blocking(timeout=0.01)
+
+        self.assertRaises(qmock.UnexpectedCall, cq._pop, qmock.call.foo())
+
+        self.assertEqual(len(cq.pop_errors), 1)
+        self.assertEqual(
+            str(cq.pop_errors[0].error),
+            "Queue is empty after waiting 0.01s. call: call.foo()"
+        )
+
+    def test_blocking_push_raises_when_full(self):
+        qm = qmock.QMock()
+        cq = qm.call_queue
+        cq.enable_blocking(maxsize=1, timeout=0.01)
+
+        cq.push(qmock.call.foo(), 1)
+        self.assertRaises(qmock.CallQueueFull, cq.push, qmock.call.foo(), 2)
+
+        self.assertEqual(len(cq._queue), 1)
+
+    def test_blocking_push_streams_from_feeder_thread(self):
+        qm = qmock.QMock()
+        cq = qm.call_queue
+        cq.enable_blocking(maxsize=2, timeout=5)
+
+        max_queue_lengths = []
+        def feed():
+            for i in range(20):
+                cq.push(qmock.call.foo(i), i)
+                max_queue_lengths.append(len(cq._queue))
+
+        feeder = Thread(target=feed)
+        feeder.start()
+        self.assertEqual([qm.foo(i) for i in range(20)], list(range(20)))
+        feeder.join()
+
+        self.assertLessEqual(max(max_queue_lengths), 2)
+        cq.assert_empty()
+        self.assertEqual(len(cq.pop_errors), 0)
+
+    def test_pop_waits_for_latency(self):
+        qm = qmock.QMock()
+        cq = qm.call_queue
+        cq.push(qmock.call.foo(), 7357, latency=0.02)
+        cq.push(qmock.call.bar(), ValueError("test"), latency=lambda: 0.02)
+
+        start = time.time()
+        self.assertEqual(qm.foo(), 7357)
+        self.assertGreaterEqual(time.time() - start, 0.02)
+
+        start = time.time()
+        with self.assertRaises(ValueError):
+            qm.bar()
+        self.assertGreaterEqual(time.time() - start, 0.02)
+
+        cq.assert_empty()
+
+    def test_push_all_latency_only_applies_to_final_call(self):
+        qm = qmock.QMock()
+        cq = qm.call_queue
+        cq.push_all(qmock.call.foo().bar(), 7357, latency=0.5)
+
+        self.assertEqual(
+            tuple(expectation.latency for expectation in cq._queue),
+            (None, 0.5)
+        )
+
+    @unittest.skipIf(PY2, "asyncio requires Python 3")
+    def test_pop_awaitable_result(self):
+        import asyncio
+
+        qm = qmock.QMock()
+        cq = qm.call_queue
+        cq.push(qmock.call.foo(), 7357, latency=0.01, awaitable=True)
+        cq.push(qmock.call.bar(), ValueError("test"), awaitable=True)
+
+        # `async def` is a SyntaxError on python 2.7, which still has to
+        # import this module.
+        namespace = {"qm": qm}
+        exec(textwrap.dedent("""
+            async def target():
+                foo = await qm.foo()
+                try:
+                    await qm.bar()
+                except ValueError as ex:
+                    return foo, str(ex)
+        """), namespace)
+
+        loop = asyncio.new_event_loop()
+        try:
+            self.assertEqual(
+                loop.run_until_complete(namespace["target"]()),
+                (7357, "test")
+            )
+        finally:
+            loop.close()
+
+        cq.assert_empty()
+
+    def test_stub_is_not_consumed(self):
+        qm = qmock.QMock()
+        cq = qm.call_queue
+        cq.stub(qmock.call.foo(1, x="y"), 7357)
+        cq.stub(qmock.call.bar(), ValueError("test"))
+
+        for _ in range(3):
+            self.assertEqual(qm.foo(1, x="y"), 7357)
+            with self.assertRaises(ValueError):
+                qm.bar()
+
+        cq.assert_empty()
+        self.assertEqual(len(cq.pop_errors), 0)
+
+    def test_stub_replaces_previous_stub(self):
+        qm = qmock.QMock()
+        cq = qm.call_queue
+        cq.stub(qmock.call.foo(1), "old")
+        cq.stub(qmock.call.foo(1), "new")
+
+        self.assertEqual(qm.foo(1), "new")
+
+    def test_stub_with_unindexable_args(self):
+        qm = qmock.QMock()
+        cq = qm.call_queue
+        cq.stub(qmock.call.foo([1, 2]), "list")
+        cq.stub(qmock.call.foo(mock.ANY, 3), "any")
+        cq.stub(qmock.call.foo(qm.bar), "qmock")
+
+        self.assertEqual(qm.foo([1, 2]), "list")
+        self.assertEqual(qm.foo("whatever", 3), "any")
+        self.assertEqual(qm.foo(qm.bar), "qmock")
+
+        cq.assert_empty()
+        self.assertEqual(len(cq.pop_errors), 0)
+
+    def test_stub_falls_through_to_queue(self):
+        qm = qmock.QMock()
+        cq = qm.call_queue
+        cq.stub(qmock.call.foo(1), "stub")
+        cq.push(qmock.call.foo(2), "queue")
+
+        self.assertEqual(qm.foo(1), "stub")
+        self.assertEqual(qm.foo(2), "queue")
+        with self.assertRaises(qmock.UnexpectedCall):
+            qm.foo(2)
+
+        self.assertEqual(len(cq.pop_errors), 1)
+
+    def test_stub_attribute_call(self):
+        qm = qmock.QMock()
+        cq = qm.call_queue
+
+        self.assertRaises(qmock.BadCall, cq.stub, qmock.call.foo, "bar")
+
+    def test_push_factory(self):
+        built = []
+        def build(x, y=0):
+            built.append((x, y))
+            return x + y
+        qm = qmock.QMock()
+        cq = qm.call_queue
+        cq.push(qmock.call.foo(1, y=2), factory=build)
+        cq.push(qmock.call.foo(3), factory=build)
+        cq.push(qmock.call.foo(4), factory=build)
+
+        self.assertEqual(built, [])
+        self.assertEqual(qm.foo(1, y=2), 3)
+        self.assertEqual(qm.foo(3), 3)
+        self.assertEqual(built, [(1, 2), (3, 0)])
+        with self.assertRaises(qmock.UnexpectedCall):
+            qm.foo(5)
+        self.assertEqual(built, [(1, 2), (3, 0)]) # never built for foo(4)
+
+    def test_push_factory_with_matchers_and_stubs(self):
+        qm = qmock.QMock()
+        cq = qm.call_queue
+        cq.stub(qmock.call.double(qmock.InstanceOf(int)), factory=lambda x: 2 * x)
+        cq.push_all(qmock.call.foo().bar(mock.ANY), factory=str)
+        cq.push(qmock.call.fail(), factory=lambda: ValueError("test"))
+
+        self.assertEqual(qm.double(2), 4)
+        self.assertEqual(qm.double(21), 42)
+        self.assertEqual(qm.foo().bar(7), "7")
+        with self.assertRaises(ValueError):
+            qm.fail()
+        cq.assert_empty()
+
+    def test_push_factory_and_result(self):
+        qm = qmock.QMock()
+        cq = qm.call_queue
+
+        self.assertRaises(
+            ValueError, cq.push, qmock.call.foo(), 1, factory=lambda: 2
+        )
+
+    def test_stream_iter(self):
+        produced = []
+        def rows():
+            for i in range(100000):
+                produced.append(i)
+                yield i
+        qm = qmock.QMock()
+        cq = qm.call_queue
+        cq.push(
+            qmock.call.cursor.__getattr__("__iter__")(qm.cursor),
+            qmock.Stream(rows())
+        )
+
+        iterator = iter(qm.cursor)
+        self.assertEqual(produced, [])
+        for row in iterator:
+            self.assertEqual(len(produced), row + 1) # lazy
+        self.assertEqual(len(produced), 100000)
+        cq.assert_empty()
+
+    def test_stream_items(self):
+        qm = qmock.QMock()
+        cq = qm.call_queue
+        cq.push(qmock.call.__getattr__("__next__")(qm), qmock.Stream("ab"))
+        cq.push(qmock.call.fetchone(), qmock.Stream([1, 2]))
+        cq.push(qmock.call.close(), None)
+
+        self.assertEqual(next(qm), "a")
+        self.assertEqual(next(qm), "b")
+        with self.assertRaises(StopIteration):
+            next(qm)
+        self.assertEqual(qm.fetchone(), 1)
+        self.assertEqual(qm.fetchone(), 2)
+        with self.assertRaises(StopIteration):
+            qm.fetchone()
+        self.assertIsNone(qm.close())
+        cq.assert_empty()
+
+    def test_stream_items_across_threads(self):
+        for engine in ("mock", "native"):
+            qm = qmock.QMock(engine=engine)
+            cq = qm.call_queue
+            # the latency keeps each item in flight while the others pop.
+            cq.push(
+                qmock.call.fetchone(),
+                qmock.Stream(range(400)),
+                latency=0.001
+            )
+            cq.push(qmock.call.close(), None)
+            rows = list()
+
+            def worker():
+                for _ in range(100):
+                    rows.append(qm.fetchone())
+            threads = [Thread(target=worker) for _ in range(4)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+            self.assertEqual(cq.pop_errors, [])
+            self.assertEqual(sorted(rows), list(range(400)))
+            with self.assertRaises(StopIteration):
+                qm.fetchone()
+            self.assertIsNone(qm.close())
+            cq.assert_empty()
+
+    def test_stream_stub(self):
+        qm = qmock.QMock()
+        cq = qm.call_queue
+        cq.stub(qmock.call.page(), qmock.Stream([1, 2]))
+
+        self.assertEqual(qm.page(), 1)
+        self.assertEqual(qm.page(), 2)
+        for _ in range(2):
+            with self.assertRaises(StopIteration):
+                qm.page()
+
+    def test_stream_validate(self):
+        qm = qmock.QMock()
+        cq = qm.call_queue
+        cq.push(
+            qmock.call.fetchone(),
+            qmock.Stream([1, "2"], validate=qmock.InstanceOf(int))
+        )
+        cq.push(
+            qmock.call.__getattr__("__iter__")(qm),
+            qmock.Stream([1, -1], validate=lambda row: row > 0)
+        )
+
+        self.assertEqual(qm.fetchone(), 1)
+        with self.assertRaises(AssertionError):
+            qm.fetchone()
+        self.assertEqual(
+            [type(record.error) for record in cq.pop_errors],
+            [AssertionError]
+        )
+        with self.assertRaises(AssertionError):
+            for _ in qm:
+                pass
+
+    def test_stream_in_unordered_group(self):
+        qm = qmock.QMock()
+        cq = qm.call_queue
+        with cq.unordered():
+            cq.push(qmock.call.__getattr__("__iter__")(qm), qmock.Stream([1]))
+            self.assertRaises(
+                ValueError, cq.push, qmock.call.fetchone(), qmock.Stream([1])
+            )
+
+    def test_history(self):
+        qm = qmock.QMock()
+        cq = qm.call_queue
+        cq.enable_history(size=3)
+        cq.stub(qmock.call.ping(), "pong")
+        for i in range(5):
+            cq.push(qmock.call.foo(i), i)
+
+        for i in range(4):
+            qm.foo(i)
+        qm.ping()
+
+        records = cq.history()
+        self.assertEqual(
+            [(record.call, record.result) for record in records],
+            [
+                (qmock.call.foo(2), 2),
+                (qmock.call.foo(3), 3),
+                (qmock.call.ping(), "pong")
+            ]
+        )
+        self.assertEqual(
+            set(record.thread_id for record in records),
+            set([get_thread_id()])
+        )
+        self.assertEqual(len(cq._history), 3) # bounded
+
+        with self.assertRaises(qmock.UnexpectedCall) as assertion:
+            qm.foo(0)
+        lines = str(assertion.exception).split("\n")
+        self.assertEqual(
+            lines[0],
+            "Call does not match expectation. actual: call.foo(0);"
+            " expected: call.foo(4)"
+        )
+        self.assertEqual(lines[1], "last 3 consumed calls (oldest first):")
+        self.assertTrue(lines[2].startswith("    call.foo(2) -> 2 (thread "))
+        self.assertTrue(lines[4].startswith("    call.ping() -> 'pong' ("))
+
+    def test_history_disabled(self):
+        qm = qmock.QMock()
+        cq = qm.call_queue
+        cq.push(qmock.call.foo(), None)
+        qm.foo()
+
+        self.assertEqual(cq.history(), [])
+        self.assertRaises(ValueError, cq.enable_history, 0)
+
+    def test_chain(self):
+        qm = qmock.QMock()
+        cq = qm.call_queue
+        query = cq.chain(qmock.call.query().filter(x=0).limit(5).all())
+
+        query.push([None, qmock.call(x=1), None, None], ["a"])
+        query.push([None, qmock.call(x=2), qmock.call(10), None], ["b", "c"])
+
+        self.assertEqual(qm.query().filter(x=1).limit(5).all(), ["a"])
+        self.assertEqual(qm.query().filter(x=2).limit(10).all(), ["b", "c"])
+        cq.assert_empty()
+
+        query.push([None, qmock.call(x=3), None, None], [])
+        with self.assertRaises(qmock.UnexpectedCall):
+            qm.query().filter(x=4)
+        self.assertEqual(len(cq.pop_errors), 1)
+
+    def test_chain_matches_push_all(self):
+        qm = qmock.QMock()
+        cq = qm.call_queue
+        cq.chain(qmock.call.foo(1).bar(x=2)).push([None, None], 3)
+        cq.push_all(qmock.call.foo(1).bar(x=2), 3)
+        pushed = [(e.call, e.result) for e in cq._queue]
+
+        self.assertEqual(pushed[:2], pushed[2:])
+
+    def test_chain_errors(self):
+        qm = qmock.QMock()
+        cq = qm.call_queue
+
+        self.assertRaises(qmock.BadCall, cq.chain, qmock.call.foo().bar)
+        template = cq.chain(qmock.call.foo().bar())
+        self.assertRaises(ValueError, template.push, [None], 1)
+        self.assertEqual(len(cq._queue), 0)
+
+    def test_chain_unordered(self):
+        qm = qmock.QMock()
+        cq = qm.call_queue
+        template = cq.chain(qmock.call.open(0).read(0))
+        with cq.unordered():
+            template.push([qmock.call(1), qmock.call(1)], "one")
+            template.push([qmock.call(2), qmock.call(2)], "two")
+
+        handle_2 = qm.open(2)
+        handle_1 = qm.open(1)
+        self.assertEqual(handle_1.read(1), "one")
+        self.assertEqual(handle_2.read(2), "two")
+        cq.assert_empty()
+
+    def test_chain_honors_assigned_attributes(self):
+        qm = qmock.QMock()
+        cq = qm.call_queue
+        session = qmock.QMock()
+        qm.connect.return_value = session
+        cq.chain(qmock.call.connect().query()).push([None, None], 5)
+
+        self.assertIs(cq._queue[0].result, session)
+        self.assertIs(qm.connect(), session)
+
+    def _expectation_file(self, expectations):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, "expectations.json")
+        with open(path, "w") as f:
+            json.dump({"expectations": expectations}, f)
+        return path
+
+    def test_load(self):
+        path = self._expectation_file([
+            {"call": "connect", "args": ["db"], "result_node": "session"},
+            {
+                "chain": [
+                    {"call": "session.query", "args": ["users"]},
+                    {"call": "all"}
+                ],
+                "result": [1, 2]
+            },
+            {"unordered": [
+                {"id": "a", "call": "read", "args": ["a"], "result": 1},
+                {"call": "read", "args": ["b"], "result": 2},
+                {"call": "merge", "after": ["a"], "result": 3}
+            ]},
+            {"stub": True, "call": "ping", "result": "pong"},
+            {"call": "fail", "raise": {"type": "KeyError", "args": ["x"]}}
+        ])
+        qm = qmock.QMock()
+        qm.call_queue.load(path)
+
+        self.assertIs(qm.connect("db"), qm.session)
+        self.assertEqual(qm.session.query("users").all(), [1, 2])
+        self.assertEqual(qm.read("a"), 1)
+        self.assertEqual(qm.merge(), 3)
+        self.assertEqual(qm.ping(), "pong")
+        self.assertEqual(qm.read("b"), 2)
+        with self.assertRaises(KeyError):
+            qm.fail()
+        qm.call_queue.assert_empty()
+
+    def test_load_matches_push_all(self):
+        path = self._expectation_file([{
+            "chain": [
+                {"call": "foo", "args": [1]},
+                {"call": "bar.baz", "kwargs": {"x": 2}}
+            ],
+            "result": 3
+        }])
+        qm = qmock.QMock()
+        cq = qm.call_queue
+        cq.load(path)
+        cq.push_all(qmock.call.foo(1).bar.baz(x=2), 3)
+        pushed = [(e.call, e.result) for e in cq._queue]
+
+        self.assertEqual(pushed[:2], pushed[2:])
+
+    def test_load_caches_by_content(self):
+        path = self._expectation_file([{"call": "foo", "result": 1}])
+        cache_dir = os.path.join(os.path.dirname(path), "__qmock_cache__")
+        qm = qmock.QMock()
+        qm.call_queue.load(path)
+        self.assertEqual(len(os.listdir(cache_dir)), 1)
+
+        # a cached load doesn't parse the file again.
+        qm.call_queue.load(path)
+        self.assertEqual(len(os.listdir(cache_dir)), 1)
+        self.assertEqual([qm.foo(), qm.foo()], [1, 1])
+
+        # changed content is compiled (and cached) again.
+        with open(path, "w") as f:
+            json.dump({"expectations": [{"call": "foo", "result": 2}]}, f)
+        qm.call_queue.load(path)
+        self.assertEqual(len(os.listdir(cache_dir)), 2)
+        self.assertEqual(qm.foo(), 2)
+
+    def test_load_ignores_tampered_caches(self):
+        path = self._expectation_file([{"call": "foo", "result": 1}])
+        cache_dir = os.path.join(os.path.dirname(path), "__qmock_cache__")
+        qmock.QMock().call_queue.load(path)
+        cache_path = os.path.join(cache_dir, os.listdir(cache_dir)[0])
+
+        tampered = [
+            # a pickle that would run `exit()` if it were unpickled.
+            b"cbuiltins\nexit\n(tR.",
+            json.dumps(
+                [["push", ["foo", [], {}, ["raise", "exit", []], None, False, []]]]
+            ).encode("utf-8"),
+            json.dumps([["push", ["foo", [], {}, ["value", 2], None]]])
+            .encode("utf-8")
+        ]
+        for content in tampered:
+            with open(cache_path, "wb") as f:
+                f.write(content)
+            qm = qmock.QMock()
+            qm.call_queue.load(path)
+            self.assertEqual(qm.foo(), 1)
+
+    def test_load_errors(self):
+        qm = qmock.QMock()
+        bad_files = [
+            [{"call": "foo bar"}],
+            [{"call": "foo", "unknown": 1}],
+            [{"call": "foo", "after": ["a"]}],
+            [{"unordered": [{"call": "foo", "after": ["a"]}]}],
+            [{"call": "foo", "result": 1, "result_node": "bar"}],
+            [{"call": "foo", "raise": {"type": "NotAnException"}}],
+            [{"stub": True, "chain": [{"call": "foo"}]}],
+            [{"chain": ["foo"]}],
+            [{"chain": [["foo"]]}],
+            [{"chain": [{"call": "foo", "result": 1}]}],
+            [{"call": "foo", "latency": "1s"}],
+            [{"call": "foo", "latency": -1}],
+            [{"call": "foo", "id": "a"}],
+            [{"unordered": [{"call": "foo", "id": ["a"]}]}],
+            [{"unordered": [{"call": "foo", "after": "a"}]}],
+            [{"call": "foo", "raise": {"type": "KeyError", "args": "x"}}],
+            [{"call": "foo", "raise": {"type": "KeyError", "message": "x"}}],
+            ["foo"]
+        ]
+        for expectations in bad_files:
+            with self.assertRaises(qmock.ExpectationFileError):
+                qm.call_queue.load(self._expectation_file(expectations))
+        self.assertEqual(len(qm.call_queue._queue), 0)
+
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, "expectations.json")
+        for document in ([], {"expectations": {"call": "foo"}}):
+            with open(path, "w") as f:
+                json.dump(document, f)
+            with self.assertRaises(qmock.ExpectationFileError):
+                qm.call_queue.load(path)
+
+    def _frozen_script(self):
+        qm = qmock.QMock()
+        cq = qm.call_queue
+        cq.push(qmock.call.connect("db"), qm.session)
+        cq.push_all(qmock.call.session.query("users").all(), [1, 2])
+        with cq.unordered():
+            a = cq.push(qmock.call.read("a"), 1)
+            cq.push(qmock.call.read("b"), 2)
+            cq.push(qmock.call.merge(), 3, after=(a,))
+        cq.stub(qmock.call.ping(), "pong")
+        return cq.freeze()
+
+    def test_attach_script(self):
+        script = self._frozen_script()
+        self.assertEqual(len(script), 6)
+
+        for engine in ("mock", "native"):
+            qm = qmock.QMock(engine=engine)
+            cq = qm.call_queue
+            cq.push(qmock.call.first(), 0)
+            cq.attach(script)
+            cq.push(qmock.call.last(), 4)
+
+            self.assertEqual(qm.first(), 0)
+            # node results belong to the QMock consuming the script.
+            self.assertIs(qm.connect("db"), qm.session)
+            self.assertEqual(qm.session.query("users").all(), [1, 2])
+            self.assertEqual(qm.read("b"), 2)
+            self.assertEqual(qm.ping(), "pong")
+            with self.assertRaises(qmock.CallQueueNotEmpty):
+                cq.assert_empty()
+            self.assertEqual(qm.read("a"), 1)
+            self.assertEqual(qm.merge(), 3)
+            self.assertEqual(qm.last(), 4)
+            cq.assert_empty()
+
+    def test_attach_script_shares_expectations(self):
+        source = qmock.QMock()
+        source.call_queue.push(qmock.call.foo(1), [1])
+        script = source.call_queue.freeze()
+        qm_1 = qmock.QMock()
+        qm_2 = qmock.QMock()
+        qm_1.call_queue.attach(script)
+        qm_2.call_queue.attach(script)
+
+        self.assertIs(qm_1.foo(1), qm_2.foo(1))
+        self.assertEqual(len(source.call_queue._queue), 1)
+        with self.assertRaises(qmock.UnexpectedCall):
+            qm_1.foo(1)
+
+    def test_script_load(self):
+        path = self._expectation_file([
+            {"call": "connect", "result_node": "session"},
+            {"chain": [{"call": "session.query"}, {"call": "all"}],
+             "result": [1]},
+            {"stub": True, "call": "ping", "result": "pong"}
+        ])
+        script = qmock.Script.load(path)
+        qm = qmock.QMock()
+        qm.call_queue.attach(script)
+
+        self.assertIs(qm.connect(), qm.session)
+        self.assertEqual(qm.ping(), "pong")
+        self.assertEqual(qm.session.query().all(), [1])
+        qm.call_queue.assert_empty()
+
+    def test_script_errors(self):
+        script = self._frozen_script()
+        with self.assertRaises(AttributeError):
+            script._steps = ()
+
+        qm = qmock.QMock()
+        cq = qm.call_queue
+        with cq.unordered():
+            self.assertRaises(ValueError, cq.freeze)
+            self.assertRaises(ValueError, cq.attach, script)
+        cq.push(qmock.call.rows(), qmock.Stream([1, 2]))
+        self.assertRaises(ValueError, cq.freeze)
+
+    def _run_scheduled(self, *workers):
+        threads = [Thread(target=worker) for worker in workers]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    def test_scheduling_follows_queue_order(self):
+        qm = qmock.QMock()
+        cq = qm.call_queue
+        cq.enable_scheduling(2, settle=0.01)
+        cq.enable_history(10)
+        cq.push(qmock.call.b(1), None)
+        cq.push(qmock.call.a(1), None)
+        cq.push(qmock.call.a(2), None)
+        cq.push(qmock.call.b(2), None)
+
+        def worker_a():
+            qm.a(1)
+            qm.a(2)
+        def worker_b():
+            qm.b(1)
+            qm.b(2)
+        self._run_scheduled(worker_a, worker_b)
+
+        cq.assert_empty()
+        self.assertEqual(len(cq.pop_errors), 0)
+        self.assertEqual(
+            [record.call for record in cq.history()],
+            [qmock.call.b(1), qmock.call.a(1), qmock.call.a(2), qmock.call.b(2)]
+        )
+
+    def test_scheduling_order_ignores_ids_in_reprs(self):
+        qm = qmock.QMock()
+        cq = qm.call_queue
+        cq.enable_scheduling(3, settle=0.01)
+        cq.enable_history(10)
+        # default reprs include id(), so highest id first is never
+        # repr order.
+        keys = sorted((object() for _ in range(3)), key=id, reverse=True)
+        with cq.unordered():
+            for key in keys:
+                cq.push(qmock.call.get(key), None)
+
+        self._run_scheduled(*[lambda key=key: qm.get(key) for key in keys])
+
+        cq.assert_empty()
+        self.assertEqual(
+            [record.call for record in cq.history()],
+            [qmock.call.get(key) for key in keys]
+        )
+
+    def test_scheduling_ties_go_by_thread(self):
+        def run(seed, reverse):
+            qm = qmock.QMock()
+            cq = qm.call_queue
+            cq.enable_scheduling(2, seed=seed, settle=0.01)
+            cq.push(qmock.call.fetch(), "first")
+            cq.push(qmock.call.fetch(), "second")
+            results = dict()
+
+            def worker():
+                results[current_thread().name] = qm.fetch()
+            threads = [
+                Thread(target=worker, name=name) for name in ("a", "b")
+            ]
+            # start order shouldn't matter.
+            for thread in reversed(threads) if reverse else threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            cq.assert_empty()
+            return results
+
+        for seed in (None, 3):
+            runs = [run(seed, reverse) for reverse in (False, True) * 3]
+            self.assertEqual(sorted(runs[0].values()), ["first", "second"])
+            for results in runs[1:]:
+                self.assertEqual(results, runs[0])
+
+    def test_scheduling_seeded_interleavings(self):
+        def run(seed):
+            qm = qmock.QMock()
+            cq = qm.call_queue
+            cq.enable_scheduling(3, seed=seed, settle=0.01)
+            cq.enable_history(10)
+            with cq.unordered():
+                for name in ("x", "y", "z"):
+                    first = cq.push(qmock.call.get(name), None)
+                    cq.push(qmock.call.put(name), None, after=(first,))
+            def worker(name):
+                return lambda: qm.put(qm.get(name) or name)
+            self._run_scheduled(worker("x"), worker("y"), worker("z"))
+            cq.assert_empty()
+            return [record.call for record in cq.history()]
+
+        self.assertEqual(run(7), run(7))
+        self.assertGreater(len(set(str(run(seed)) for seed in range(8))), 1)
+
+    def test_scheduling_releases_stuck_calls(self):
+        qm = qmock.QMock()
+        cq = qm.call_queue
+        cq.enable_scheduling(1, settle=0.01)
+        cq.push(qmock.call.a(), None)
+        errors = list()
+
+        def worker():
+            try:
+                qm.b()
+            except qmock.UnexpectedCall as ex:
+                errors.append(ex)
+        self._run_scheduled(worker)
+
+        self.assertEqual(len(errors), 1)
+        self.assertRaises(ValueError, cq.enable_scheduling, 0)
+
+    def _sampled_calls(self, cq, calls, **sampling):
+        cq.enable_sampling(**sampling)
+        for i in range(calls):
+            cq.push(qmock.call.foo(i), i)
+        return cq
+
+    def test_sampling(self):
+        qm = qmock.QMock()
+        cq = self._sampled_calls(qm.call_queue, 10, every=3)
+
+        # unsampled calls aren't compared, but results stay in order.
+        self.assertEqual(qm.foo(0), 0)
+        self.assertEqual(qm.bar(), 1)
+        self.assertEqual(qm.baz(), 2)
+        self.assertEqual(qm.foo(3), 3)
+        self.assertEqual(qm.bar(), 4)
+        self.assertEqual(qm.bar(), 5)
+        with self.assertRaises(qmock.UnexpectedCall):
+            qm.foo(42)
+        self.assertEqual(len(cq.pop_errors), 1)
+        for i in range(7, 10):
+            self.assertEqual(qm.foo(i), i)
+        cq.assert_empty()
+        with self.assertRaises(qmock.UnexpectedCall):
+            qm.bar()
+
+    def test_sampling_seed(self):
+        def sampled(seed):
+            qm = qmock.QMock()
+            self._sampled_calls(qm.call_queue, 20, every=5, seed=seed)
+            validated = list()
+            for i in range(20):
+                try:
+                    qm.bar()
+                except qmock.UnexpectedCall:
+                    validated.append(i)
+            return validated
+
+        self.assertEqual(sampled(7), sampled(7))
+        self.assertEqual(len(sampled(7)), 4)
+        self.assertGreater(len(set(sampled(seed)[0] for seed in range(8))), 1)
+
+    def test_sampling_paths(self):
+        qm = qmock.QMock()
+        cq = qm.call_queue
+        cq.enable_sampling(paths=["db.query"])
+        cq.push(qmock.call.foo(), 1)
+        cq.push(qmock.call.db.query("select"), 2)
+        cq.stub(qmock.call.ping(), "pong")
+
+        self.assertEqual(qm.bar(), 1)
+        self.assertEqual(qm.ping(), "pong")
+        with self.assertRaises(qmock.UnexpectedCall):
+            qm.db.query("delete")
+        self.assertEqual(len(cq.pop_errors), 1)
+
+    def test_sampling_validates_locked_queues(self):
+        qm = qmock.QMock()
+        cq = qm.call_queue
+        cq.enable_sampling(every=100, seed=1)
+        with cq.unordered():
+            cq.push(qmock.call.foo(), 1)
+            cq.push(qmock.call.bar(), 2)
+
+        self.assertEqual(qm.bar(), 2)
+        with self.assertRaises(qmock.UnexpectedCall):
+            qm.baz()
+        self.assertEqual(qm.foo(), 1)
+
+    def test_sampling_errors(self):
+        cq = qmock.QMock().call_queue
+        self.assertRaises(ValueError, cq.enable_sampling)
+        self.assertRaises(ValueError, cq.enable_sampling, 0)
+        cq.enable_scheduling(1)
+        self.assertRaises(ValueError, cq.enable_sampling, 2)
+
+    def test_pickle_sampling(self):
+        qm = qmock.QMock()
+        self._sampled_calls(qm.call_queue, 4, every=2)
+
+        qm_copy = pickle.loads(pickle.dumps(qm))
+        with self.assertRaises(qmock.UnexpectedCall):
+            qm_copy.bar()
+        self.assertEqual(qm_copy.bar(), 1)
+
+    def test_fail_fast(self):
+        qm = qmock.QMock()
+        cq = qm.call_queue
+        cq.enable_fail_fast()
+        cq.push(qmock.call.foo(), 1)
+        cq.push(qmock.call.bar(), 2)
+
+        thread = Thread(target=qm.baz)
+        thread.start()
+        thread.join()
+
+        with self.assertRaises(qmock.UnexpectedCall) as assertion:
+            qm.bar()
+        self.assertTrue(
+            str(assertion.exception).startswith("Queue aborted by a QMock error")
+        )
+        self.assertEqual(len(cq.pop_errors), 1)
+        self.assertRaises(qmock.CallQueueNotEmpty, cq.assert_empty)
+
+    def test_fail_fast_wakes_blocked_calls(self):
+        qm = qmock.QMock()
+        cq = qm.call_queue
+        cq.enable_fail_fast()
+        cq.enable_blocking() # waits forever for the next expectation
+        errors = list()
+
+        def waiter():
+            try:
+                qm.foo()
+            except qmock.UnexpectedCall as ex:
+                errors.append(ex)
+        thread = Thread(target=waiter)
+        thread.start()
+        time.sleep(0.05)
+        cq.push(qmock.call.bar(), None)
+        thread.join(5)
+
+        self.assertFalse(thread.is_alive())
+        self.assertEqual(len(errors), 1)
+        self.assertEqual(len(cq.pop_errors), 1)
+
+    def test_fail_fast_wakes_scheduled_calls(self):
+        qm = qmock.QMock()
+        cq = qm.call_queue
+        cq.enable_fail_fast()
+        cq.enable_scheduling(2, timeout=0.2)
+        cq.push(qmock.call.a(), None)
+        cq.push(qmock.call.b(), None)
+        errors = list()
+
+        def worker(name):
+            def run():
+                try:
+                    getattr(qm, name)()
+                except qmock.UnexpectedCall as ex:
+                    errors.append(ex)
+            return run
+        # neither call can proceed, so one is failed after the timeout
+        # and the other must be woken by the abort.
+        threads = [Thread(target=worker(name)) for name in ("b", "c")]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(5)
+
+        self.assertEqual(len(errors), 2)
+        self.assertEqual(len(cq.pop_errors), 1)
+
+    def test_listener_events(self):
+        qm = qmock.QMock()
+        cq = qm.call_queue
+        listener = RecordingListener()
+        cq.add_listener(listener)
+
+        cq.push(qmock.call.foo(), 7357)
+        cq.push(qmock.call.foo(), 7357)
+        self.assertEqual(qm.foo(), 7357)
+        with self.assertRaises(qmock.UnexpectedCall):
+            qm.bar()
+        with self.assertRaises(qmock.UnexpectedCall):
+            qm.foo()
+        cq.assert_empty()
+
+        self.assertEqual(
+            [name for name, _ in listener.events],
+            ["on_push", "on_push", "on_match", "on_mismatch", "on_empty",
+             "on_assert_empty"]
+        )
+        events = [event for _, event in listener.events]
+        self.assertEqual(events[0], (qmock.call.foo(), 7357))
+        self.assertEqual(events[2].actual_call, qmock.call.foo())
+        self.assertEqual(events[2].expected_call, qmock.call.foo())
+        self.assertEqual(events[2].thread_id, get_thread_id())
+        self.assertGreaterEqual(events[2].duration, 0)
+        self.assertEqual(events[3].actual_call, qmock.call.bar())
+        self.assertIs(events[3].error, cq.pop_errors[0].error)
+        self.assertIs(events[4].error, cq.pop_errors[1].error)
+        self.assertEqual(events[5].remaining, 0)
+
+    def test_listener_without_handlers(self):
+        qm = qmock.QMock()
+        cq = qm.call_queue
+        cq.add_listener(object())
+
+        cq.push(qmock.call.foo(), 7357)
+        self.assertEqual(qm.foo(), 7357)
+        cq.assert_empty()
+
+    def test_remove_listener(self):
+        qm = qmock.QMock()
+        cq = qm.call_queue
+        alpha = RecordingListener()
+        bravo = RecordingListener()
+        cq.add_listener(alpha)
+        cq.add_listener(bravo)
+
+        cq.remove_listener(alpha)
+        cq.push(qmock.call.foo(), 7357)
+
+        self.assertEqual(len(alpha.events), 0)
+        self.assertEqual(len(bravo.events), 1)
+
+        cq.remove_listener(bravo)
+
+        self.assertIsNone(cq._listeners)
+
+    def test_unordered_group_any_order(self):
+        qm = qmock.QMock()
+        cq = qm.call_queue
+        cq.push(qmock.call.start(), None)
+        with cq.unordered():
+            cq.push(qmock.call.warm("a"), 1)
+            cq.push(qmock.call.warm("b"), 2)
+            cq.push(qmock.call.warm([3]), 3) # unindexed
+        cq.push(qmock.call.write(), 4)
+
+        self.assertIsNone(qm.start())
+        with self.assertRaises(qmock.UnexpectedCall):
+            qm.write() # group isn't finished
+        self.assertEqual(qm.warm([3]), 3)
+        self.assertEqual(qm.warm("b"), 2)
+        self.assertEqual(qm.warm("a"), 1)
+        self.assertEqual(qm.write(), 4)
+
+        cq.assert_empty()
+        self.assertEqual(len(cq.pop_errors), 1)
+        self.assertEqual(
+            str(cq.pop_errors[0].error),
+            "Call does not match any expectation in unordered group."
+            " actual: call.write(); expected one of: call.warm('a'),"
+            " call.warm('b'), call.warm([3])"
+        )
+
+    def test_unordered_group_dependencies(self):
+        qm = qmock.QMock()
+        cq = qm.call_queue
+        with cq.unordered():
+            a = cq.push(qmock.call.read("a"), 1)
+            b = cq.push(qmock.call.read("b"), 2)
+            cq.push(qmock.call.merge(), 3, after=(a, b))
+            cq.push(qmock.call.log(), None)
+
+        self.assertEqual(qm.read("b"), 2)
+        with self.assertRaises(qmock.UnexpectedCall):
+            qm.merge()
+        self.assertIsNone(qm.log())
+        self.assertEqual(qm.read("a"), 1)
+        self.assertEqual(qm.merge(), 3)
+
+        cq.assert_empty()
+        self.assertEqual(len(cq.pop_errors), 1)
+        self.assertEqual(
+            str(cq.pop_errors[0].error),
+            "Call is blocked by unconsumed dependencies. actual:"
+            " call.merge(); waiting for: call.read('a')"
+        )
+
+    def test_unordered_group_push_all_chains(self):
+        qm = qmock.QMock()
+        cq = qm.call_queue
+        with cq.unordered():
+            cq.push_all(qmock.call.foo().bar(), 1)
+            cq.push(qmock.call.baz(), 2)
+
+        with self.assertRaises(qmock.UnexpectedCall):
+            qm.foo.return_value.bar()
+        self.assertIs(qm.foo(), qm.foo.return_value)
+        self.assertEqual(qm.baz(), 2)
+        self.assertEqual(qm.foo.return_value.bar(), 1)
+
+    def test_unordered_group_remaining(self):
+        qm = qmock.QMock()
+        cq = qm.call_queue
+        with cq.unordered():
+            cq.push(qmock.call.foo(), 1)
+            cq.push(qmock.call.bar(), 2)
+        cq.push(qmock.call.baz(), 3)
+
+        with self.assertRaises(qmock.CallQueueNotEmpty) as assertion:
+            cq.assert_empty()
+        self.assertEqual(
+            str(assertion.exception),
+            "Queue is not empty; 3 expected calls remaining."
+        )
+
+    def test_unordered_group_bad_after(self):
+        qm = qmock.QMock()
+        cq = qm.call_queue
+        outside = cq.push(qmock.call.foo(), 1)
+
+        self.assertRaises(
+            ValueError, cq.push, qmock.call.bar(), 2, after=(outside,)
+        )
+        with cq.unordered():
+            self.assertRaises(
+                ValueError, cq.push, qmock.call.bar(), 2, after=(outside,)
+            )
+            with self.assertRaises(ValueError):
+                with cq.unordered():
+                    pass
+
+class RecordingListener(object):
+    def __init__(self):
+        self.events = []
+
+    def on_push(self, event):
+        self.events.append(("on_push", event))
+
+    def on_match(self, event):
+        self.events.append(("on_match", event))
+
+    def on_mismatch(self, event):
+        self.events.append(("on_mismatch", event))
+
+    def on_empty(self, event):
+        self.events.append(("on_empty", event))
+
+    def on_assert_empty(self, event):
+        self.events.append(("on_assert_empty", event))
+
+class LatencyProfileTests(unittest.TestCase):
+    def test_is_reproducible(self):
+        percentiles = {50: 0.01, 90: 0.05, 99: 0.25}
+        alpha = qmock.LatencyProfile(percentiles, seed=7)
+        bravo = qmock.LatencyProfile(percentiles, seed=7)
+
+        self.assertEqual(
+            [alpha() for _ in range(100)],
+            [bravo() for _ in range(100)]
+        )
+
+    def test_samples_within_profile(self):
+        profile = qmock.LatencyProfile({50: 0.01, 100: 0.05}, seed=0)
+        samples = sorted(profile() for _ in range(1000))
+
+        self.assertGreaterEqual(samples[0], 0)
+        self.assertLessEqual(samples[-1], 0.05)
+        self.assertLessEqual(samples[499], 0.011)
+        self.assertGreaterEqual(samples[500], 0.009)
+
+    def test_fixed_profile(self):
+        profile = qmock.LatencyProfile({0: 0.01}, seed=0)
+
+        self.assertEqual(set(profile() for _ in range(10)), set([0.01]))
+
+    def test_bad_percentiles(self):
+        self.assertRaises(ValueError, qmock.LatencyProfile, {})
+        self.assertRaises(ValueError, qmock.LatencyProfile, {101: 0.01})
+        self.assertRaises(ValueError, qmock.LatencyProfile, {50: -1})
+
+class MatcherTests(unittest.TestCase):
+    def test_matchers_in_pushed_calls(self):
+        qm = qmock.QMock()
+        cq = qm.call_queue
+        cq.push(
+            qmock.call.save(
+                qmock.InstanceOf(int),
+                qmock.Regex(r"^user-\d+$"),
+                key=qmock.Predicate(lambda value: value > 0)
+            ),
+            "saved"
+        )
+
+        self.assertEqual(qm.save(7, "user-12", key=3), "saved")
+        cq.assert_empty()
+        self.assertEqual(len(cq.pop_errors), 0)
+
+    def test_matcher_mismatches(self):
+        qm = qmock.QMock()
+        cq = qm.call_queue
+        cq.push(qmock.call.save(qmock.InstanceOf(int)), None)
+        cq.push(qmock.call.save(qmock.Regex(r"^a")), None)
+        cq.push(qmock.call.save(qmock.Predicate(bool, "truthy")), None)
+
+        with self.assertRaises(qmock.UnexpectedCall):
+            qm.save("7")
+        with self.assertRaises(qmock.UnexpectedCall):
+            qm.save(7) # not a string
+        with self.assertRaises(qmock.UnexpectedCall):
+            qm.save(0)
+
+        self.assertEqual(len(cq.pop_errors), 3)
+        self.assertEqual(
+            str(cq.pop_errors[2].error),
+            "Call does not match expectation. actual: call.save(0);"
+            " expected: call.save(Predicate(truthy))"
+        )
+
+    def test_root_matcher_call_paths(self):
+        for engine in ("mock", "native"):
+            qm = qmock.QMock(engine=engine)
+            cq = qm.call_queue
+            cq.push(qmock.call(qmock.InstanceOf(int)), "root")
+            cq.push(qmock.call(qmock.InstanceOf(int)), None)
+
+            self.assertEqual(qm(1), "root")
+            with self.assertRaises(qmock.UnexpectedCall):
+                qm.foo(1) # same args, child path
+            self.assertEqual(len(cq.pop_errors), 1)
+
+    def test_nested_matchers(self):
+        qm = qmock.QMock()
+        cq = qm.call_queue
+        expected = qmock.call.send(
+            [1, qmock.InstanceOf(str)],
+            {"id": qmock.InstanceOf(int), "tags": (qmock.Regex("x"),)}
+        )
+        cq.push(expected, 1)
+        cq.push(expected, 2)
+        cq.push(expected, 3)
+
+        self.assertEqual(qm.send([1, "a"], {"id": 5, "tags": ("xy",)}), 1)
+        with self.assertRaises(qmock.UnexpectedCall):
+            qm.send((1, "a"), {"id": 5, "tags": ("xy",)}) # tuple != list
+        with self.assertRaises(qmock.UnexpectedCall):
+            qm.send([1, "a"], {"id": 5, "tags": ("xy",), "extra": 0})
+
+    def test_subset(self):
+        payload = dict(("field{0}".format(i), i) for i in range(1000))
+        payload["status"] = "ok"
+        qm = qmock.QMock()
+        cq = qm.call_queue
+        matcher = qmock.Subset({"status": "ok", "field7": qmock.InstanceOf(int)})
+        cq.push(qmock.call.post(matcher), 1)
+        cq.push(qmock.call.post(matcher), 2)
+        cq.push(qmock.call.post(matcher), 3)
+
+        self.assertEqual(qm.post(payload), 1)
+        self.assertEqual(
+            qm.post(mock.Mock(status="ok", field7=7)), 2 # attributes
+        )
+        with self.assertRaises(qmock.UnexpectedCall):
+            qm.post({"status": "ok"})
+
+        self.assertEqual(matcher, {"status": "ok", "field7": 0})
+        self.assertNotEqual(matcher, {"status": "error", "field7": 0})
+
+    def test_matchers_in_stubs_and_unordered_groups(self):
+        qm = qmock.QMock()
+        cq = qm.call_queue
+        cq.stub(qmock.call.get(qmock.Regex("^cache:")), "cached")
+        with cq.unordered():
+            cq.push(qmock.call.put(qmock.InstanceOf(int)), "int")
+            cq.push(qmock.call.put(qmock.InstanceOf(str)), "str")
+
+        self.assertEqual(qm.get("cache:1"), "cached")
+        self.assertEqual(qm.put("a"), "str")
+        self.assertEqual(qm.get("cache:2"), "cached")
+        self.assertEqual(qm.put(1), "int")
+
+        cq.assert_empty()
+        self.assertEqual(len(cq.pop_errors), 0)
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+class BufferComparisonTests(unittest.TestCase):
+    def test_buffers(self):
+        qm = qmock.QMock()
+        cq = qm.call_queue
+        data = bytearray(range(256)) * 4096 # 1MB
+        cq.push(qmock.call.write(data), 1)
+        cq.push(qmock.call.write(memoryview(data)), 2)
+        cq.push(qmock.call.write(data), 3)
+
+        self.assertEqual(qm.write(bytearray(data)), 1)
+        self.assertEqual(qm.write(bytes(data)), 2)
+        changed = bytearray(data)
+        changed[-1] = 0
+        with self.assertRaises(qmock.UnexpectedCall):
+            qm.write(changed)
+
+    @unittest.skipIf(PY2, "memoryview.cast() doesn't exist in python 2.7")
+    def test_buffer_shape_and_format(self):
+        qm = qmock.QMock()
+        cq = qm.call_queue
+        data = bytearray(8)
+        cq.push(qmock.call.write(memoryview(data).cast("B", (2, 4))), 1)
+        cq.push(qmock.call.write(memoryview(data).cast("B", (2, 4))), 2)
+        cq.push(qmock.call.write(memoryview(data)), 3)
+
+        self.assertEqual(qm.write(memoryview(bytes(8)).cast("B", (2, 4))), 1)
+        with self.assertRaises(qmock.UnexpectedCall):
+            qm.write(memoryview(bytes(8)).cast("B", (4, 2)))
+        with self.assertRaises(qmock.UnexpectedCall):
+            qm.write(memoryview(bytes(8)).cast("i"))
+
+    def test_mmap(self):
+        import mmap
+        buf = mmap.mmap(-1, 4096)
+        buf.write(b"x" * 4096)
+        qm = qmock.QMock()
+        cq = qm.call_queue
+        cq.push(qmock.call.write(buf), 1)
+
+        self.assertEqual(qm.write(bytearray(b"x" * 4096)), 1)
+        buf.close() # no exported views left behind
+
+    @unittest.skipIf(numpy is None, "numpy is not installed")
+    def test_ndarrays(self):
+        qm = qmock.QMock()
+        cq = qm.call_queue
+        ints = numpy.arange(1000000, dtype=numpy.int64).reshape(1000, 1000)
+        floats = numpy.array([0.0, 1.5, numpy.nan])
+        cq.push(qmock.call.write(ints), 1)
+        cq.push(qmock.call.write(ints), 2)
+        cq.push(qmock.call.write(ints), 3)
+        cq.push(qmock.call.write(floats[:2]), 4)
+        cq.push(qmock.call.write(floats), 5)
+
+        self.assertEqual(qm.write(ints.copy()), 1)
+        self.assertEqual(qm.write(numpy.asfortranarray(ints)), 2)
+        with self.assertRaises(qmock.UnexpectedCall):
+            qm.write(ints.astype(numpy.int32))
+        self.assertEqual(qm.write(numpy.array([-0.0, 1.5])), 4)
+        with self.assertRaises(qmock.UnexpectedCall):
+            qm.write(floats.copy()) # nan != nan
+
+    @unittest.skipIf(numpy is None, "numpy is not installed")
+    def test_unexpected_ndarray(self):
+        qm = qmock.QMock()
+        cq = qm.call_queue
+        cq.push(qmock.call.write(1), None)
+
+        with self.assertRaises(qmock.UnexpectedCall):
+            qm.write(numpy.array([1, 1]))
+        self.assertEqual(len(cq.pop_errors), 1)
+
+    @unittest.skipIf(numpy is None, "numpy is not installed")
+    def test_unexpected_ndarray_with_matchers(self):
+        qm = qmock.QMock()
+        cq = qm.call_queue
+        array = numpy.array([1, 1])
+        expected_calls = [
+            qmock.call.write(qmock.InstanceOf(str), 1),
+            qmock.call.write(qmock.Regex("x"), [1, 2]),
+            qmock.call.write(qmock.Predicate(lambda value: value == 1), 1),
+            qmock.call.write("x", qmock.Subset({"a": 1})),
+            qmock.call.write("x", qmock.Subset({"real": 1})),
+            qmock.call.write(qmock.InstanceOf(str), key=1),
+        ]
+        actual_args = [
+            (("x", array), {}),
+            ((array, [1, array]), {}),
+            ((array, 1), {}),
+            (("x", {"a": array}), {}),
+            (("x", array), {}),
+            (("x",), {"key": array}),
+        ]
+        for expected, (args, kwargs) in zip(expected_calls, actual_args):
+            cq.push(expected, None)
+            with self.assertRaises(qmock.UnexpectedCall):
+                qm.write(*args, **kwargs)
+        self.assertEqual(len(cq.pop_errors), len(expected_calls))
+
+        cq.stub(qmock.call.read(qmock.InstanceOf(str), 1), "stub")
+        with self.assertRaises(qmock.UnexpectedCall):
+            qm.read("x", array)
+
+    @unittest.skipIf(numpy is None, "numpy is not installed")
+    def test_ndarrays_next_to_matchers(self):
+        qm = qmock.QMock()
+        cq = qm.call_queue
+        array = numpy.array([1, 1])
+        cq.push(qmock.call.write(qmock.InstanceOf(str), [1, 2]), None)
+        with self.assertRaises(qmock.UnexpectedCall):
+            qm.write("x", [1, array])
+        self.assertEqual(len(cq.pop_errors), 1)
+
+        cq.push(qmock.call.write(qmock.InstanceOf(str), array), 1)
+        cq.push(qmock.call.write(qmock.InstanceOf(str), array), 2)
+        self.assertEqual(qm.write("x", array.copy()), 1)
+        with self.assertRaises(qmock.UnexpectedCall):
+            qm.write("x", numpy.array([1, 2]))
+
+
+MEMORY_BASELINE = os.path.join(os.path.dirname(__file__), "memory_baseline.json")
+# footprints may grow this much (relative, then bytes) over the baseline.
+MEMORY_TOLERANCE = 0.10
+MEMORY_SLACK = 32
+
+@unittest.skipIf(tracemalloc is None, "tracemalloc is not available")
+class MemoryFootprintTests(unittest.TestCase):
+    """
+        bytes allocated per unit (QMock, node, expectation, patch scope) in
+        fixed scenarios, traced with tracemalloc and checked against the
+        baseline recorded for this interpreter in memory_baseline.json.
+
+        to record (or update) the baseline, eg: after an intended change
+        or for a new python version, run:
+            QMOCK_UPDATE_MEMORY_BASELINE=1 python -m pytest -k MemoryFootprint
+    """
+    @staticmethod
+    def _interpreter():
+        free_threaded = sysconfig.get_config_var("Py_GIL_DISABLED")
+        return "{0}-{1}.{2}{3}".format(
+            platform.python_implementation().lower(),
+            sys.version_info[0],
+            sys.version_info[1],
+            "t" if free_threaded else ""
+        )
+
+    def _footprint(self, count, grow, setup=lambda count: None):
+        """
+            the bytes per unit still allocated after grow(setup(count)),
+            which allocates `count` units. setup() is not traced.
+        """
+        # warm up one-time caches, eg: interned names and clone classes.
+        grow(setup(2))
+        state = setup(count)
+        gc.collect()
+        tracemalloc.start()
+        try:
+            kept = grow(state)
+            gc.collect()
+            size = tracemalloc.get_traced_memory()[0]
+        finally:
+            tracemalloc.stop()
+        del kept
+        return size / float(count)
+
+    def _assert_footprint(self, name, footprint):
+        interpreter = self._interpreter()
+        try:
+            with open(MEMORY_BASELINE) as f:
+                baselines = json.load(f)
+        except IOError:
+            baselines = dict()
+        if os.environ.get("QMOCK_UPDATE_MEMORY_BASELINE"):
+            baselines.setdefault(interpreter, dict())[name] = round(
+                footprint, 1
+            )
+            with open(MEMORY_BASELINE, "w") as f:
+                json.dump(baselines, f, indent=4, sort_keys=True)
+                f.write("\n")
+            return
+        baseline = baselines.get(interpreter, dict()).get(name)
+        if baseline is None:
+            self.skipTest(
+                "No {0} memory baseline for {1}. see MemoryFootprintTests."
+                .format(name, interpreter)
+            )
+        limit = baseline * (1 + MEMORY_TOLERANCE) + MEMORY_SLACK
+        if footprint > limit:
+            self.fail(
+                "{0} grew to {1:.1f} bytes per unit; baseline {2:.1f}, limit"
+                " {3:.1f}.".format(name, footprint, baseline, limit)
+            )
+
+    def _assert_qmocks(self, name, engine):
+        self._assert_footprint(name, self._footprint(
+            100,
+            lambda count: [qmock.QMock(engine=engine) for _ in range(count)],
+            lambda count: count
+        ))
+
+    def test_qmock(self):
+        self._assert_qmocks("qmock", "mock")
+
+    def test_native_qmock(self):
+        self._assert_qmocks("native_qmock", "native")
+
+    def _assert_nodes(self, name, engine):
+        def setup(count):
+            names = ["node_{0}".format(i) for i in range(count)]
+            return qmock.QMock(engine=engine), names
+        def grow(state):
+            qm, names = state
+            return [getattr(qm, node_name) for node_name in names]
+        self._assert_footprint(name, self._footprint(200, grow, setup))
+
+    def test_node(self):
+        # a _CallProxy, its clone class and descriptors, and its MagicMock.
+        self._assert_nodes("node", "mock")
+
+    def test_native_node(self):
+        self._assert_nodes("native_node", "native")
+
+    def test_expectation(self):
+        def setup(count):
+            calls = [qmock.call.foo(i) for i in range(count)]
+            return qmock.QMock().call_queue, calls
+        def grow(state):
+            call_queue, calls = state
+            for i, kall in enumerate(calls):
+                call_queue.push(kall, i)
+            return state
+        self._assert_footprint(
+            "expectation", self._footprint(1000, grow, setup)
+        )
+
+    def _assert_patch_scopes(self, name, **options):
+        def grow(count):
+            for _ in range(count):
+                with qmock.patch(dt=DATETIME_DATE, **options) as qm:
+                    qm.call_queue.push(qmock.call.dt(1, 2, 3), 7)
+                    datetime.date(1, 2, 3)
+        # retained after the scopes exit, ie: leaked.
+        self._assert_footprint(
+            name, self._footprint(50, grow, lambda count: count)
+        )
+
+    def test_patch_scope(self):
+        self._assert_patch_scopes("patch_scope")
+
+    def test_context_local_patch_scope(self):
+        self._assert_patch_scopes(
+            "context_local_patch_scope", context_local=True
+        )